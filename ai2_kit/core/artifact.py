@@ -1,5 +1,6 @@
 from .pydantic import BaseModel
-from typing import Optional, Mapping, TypedDict
+from typing import Optional, Mapping, TypedDict, Union
+from types import MappingProxyType
 import os
 import copy
 
@@ -58,3 +59,110 @@ class Artifact(BaseModel):
 
 
 ArtifactMap = Mapping[str, Artifact]
+
+
+class ArtifactRecord:
+    """
+    A compact and immutable representation of artifact,
+    use it for the large lists of artifacts generated by workflow stages instead of `Artifact`.
+
+    Unlike `Artifact.of`, attrs is not copied on construction,
+    records derived from the same artifact share the same attrs dict,
+    and a new dict is created only when attrs is changed by `with_attrs`.
+    As attrs is shared, it is exposed as a read-only mapping, and nested values must not be modified either.
+    Shared attrs is also pickled only once, which keeps the checkpoint file small.
+
+    Use `to_artifact` to convert it to `Artifact` when a pydantic model is required.
+    """
+
+    __slots__ = ('url', 'key', 'executor', 'format', 'includes', '_attrs')
+
+    url: str
+    key: Optional[str]
+    executor: Optional[str]
+    format: Optional[str]
+    includes: Optional[str]
+
+    def __init__(self,
+                 url: str,
+                 key: Optional[str] = None,
+                 executor: Optional[str] = None,
+                 includes: Optional[str] = None,
+                 attrs: Optional[dict] = None,
+                 format: Optional[str] = None):
+        _set = object.__setattr__
+        _set(self, 'url', url)
+        _set(self, 'key', key)
+        _set(self, 'executor', executor)
+        _set(self, 'format', format)
+        _set(self, 'includes', includes)
+        _set(self, '_attrs', _EMPTY_ATTRS if attrs is None else attrs)
+
+    @classmethod
+    def from_artifact(cls, artifact: Union[Artifact, 'ArtifactRecord', ArtifactDict]) -> 'ArtifactRecord':
+        """Convert an artifact to record, attrs of `Artifact` is copied as it is mutable."""
+        if isinstance(artifact, ArtifactRecord):
+            return artifact
+        if isinstance(artifact, Artifact):
+            artifact = artifact.to_dict()  # attrs has been copied
+        return cls(**artifact)
+
+    @property
+    def attrs(self) -> Mapping:
+        return MappingProxyType(self._attrs)
+
+    def evolve(self, **changes) -> 'ArtifactRecord':
+        """Create a new record with the given fields changed, attrs is shared if it is not changed."""
+        fields = dict(url=self.url, key=self.key, executor=self.executor,
+                      format=self.format, includes=self.includes, attrs=self._attrs)
+        fields.update(changes)
+        return ArtifactRecord(**fields)
+
+    def with_attrs(self, **attrs) -> 'ArtifactRecord':
+        """Create a new record with the given attrs merged into a copy of attrs."""
+        return self.evolve(attrs={**self._attrs, **attrs})
+
+    def join(self, *paths, **kwargs):
+        url = os.path.join(self.url, *paths)
+        return ArtifactRecord(url=url, executor=self.executor, **kwargs)
+
+    def to_dict(self) -> ArtifactDict:
+        """Convert to a dict representation, attrs is copied shallowly."""
+        return {
+            'url': self.url,
+            'attrs': dict(self._attrs),
+            'executor': self.executor,
+            'format': self.format,
+            'includes': self.includes,
+            'key': self.key,
+        }
+
+    def to_artifact(self) -> Artifact:
+        return Artifact.of(url=self.url, key=self.key, executor=self.executor,
+                           includes=self.includes, attrs=self._attrs, format=self.format)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable, use evolve() to create a new one')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __reduce__(self):
+        # the attrs dict is passed as it is, so that the shared one is pickled only once
+        return (ArtifactRecord, (self.url, self.key, self.executor, self.includes, self._attrs, self.format))
+
+    def __eq__(self, other):
+        if not isinstance(other, ArtifactRecord):
+            return NotImplemented
+        return self.__reduce__()[1] == other.__reduce__()[1]
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return (f'ArtifactRecord(url={self.url!r}, key={self.key!r}, executor={self.executor!r}, '
+                f'format={self.format!r}, includes={self.includes!r}, attrs={self._attrs!r})')
+
+
+_EMPTY_ATTRS: dict = {}
+
+AnyArtifact = Union[Artifact, ArtifactRecord]
@@ -0,0 +1,141 @@
+"""
+Index of the metadata of artifacts, so that stages don't need to read the data again to learn basic facts about it.
+
+The index is a SQLite database in the work_dir of the executor, which keeps one row for each artifact url:
+
+* size, mtime: total size and latest modification time of the file or directory
+* content_hash: content hash of the data, the same as the one used by the upload cache
+* frames, formula, natoms: set by the producer of the data if it knows them
+* format: data format of the artifact
+
+Producers fill the index with `index_artifacts` when they write outputs,
+and consumers get the records with `lookup_artifacts` in one call.
+A record is dropped if the size or mtime of the data doesn't match it any more.
+
+The functions are supposed to run on the executor, e.g. with `executor.run_python_fn`.
+"""
+
+from typing import List, Optional, TypedDict
+import sqlite3
+import time
+import os
+
+from .artifact import ArtifactDict
+from .util import hash_path
+
+INDEX_FILE = '.artifact-index.db'
+
+
+def get_index_path(work_dir: str):
+    return os.path.join(work_dir, INDEX_FILE)
+
+
+def __export_remote_functions():
+
+    class IndexRecord(TypedDict):
+        url: str
+        size: int
+        mtime: float
+        content_hash: str
+        frames: Optional[int]
+        formula: Optional[str]
+        natoms: Optional[int]
+        format: Optional[str]
+
+    columns = ['url', 'size', 'mtime', 'content_hash', 'frames', 'formula', 'natoms', 'format']
+
+    def _connect(index_path: str):
+        # the work_dir is usually on a shared file system, on which WAL mode doesn't work,
+        # so the default journal mode is used and the writers wait for each other
+        conn = sqlite3.connect(index_path, timeout=60)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS artifact ('
+                         'url TEXT PRIMARY KEY, size INTEGER, mtime REAL, content_hash TEXT, '
+                         'frames INTEGER, formula TEXT, natoms INTEGER, format TEXT, updated_at REAL)')
+        return conn
+
+    def _stat_path(path: str):
+        """
+        Return the total size and the latest mtime of a file or a directory tree.
+        """
+        st = os.stat(path)
+        size, mtime = (0 if os.path.isdir(path) else st.st_size), st.st_mtime
+        if os.path.isdir(path):
+            for root, _dirs, files in os.walk(path, followlinks=True):
+                mtime = max(mtime, os.stat(root).st_mtime)
+                for file_name in files:
+                    st = os.stat(os.path.join(root, file_name))
+                    size += st.st_size
+                    mtime = max(mtime, st.st_mtime)
+        return size, mtime
+
+    def index_artifacts(index_path: str, artifacts: List[ArtifactDict],
+                        frames: Optional[List[Optional[int]]] = None,
+                        formulas: Optional[List[Optional[str]]] = None,
+                        natoms: Optional[List[Optional[int]]] = None):
+        """
+        Add or update the records of artifacts.
+
+        :param index_path: path of the index file
+        :param artifacts: artifacts to index, the data must exist
+        :param frames: number of frames of each artifact, None if unknown
+        :param formulas: chemical formula of each artifact, None if unknown
+        :param natoms: number of atoms of each artifact, None if unknown
+        """
+        n = len(artifacts)
+        frames, formulas, natoms = frames or [None] * n, formulas or [None] * n, natoms or [None] * n
+        rows = []
+        for a, frame_count, formula, natom_count in zip(artifacts, frames, formulas, natoms):
+            size, mtime = _stat_path(a['url'])
+            rows.append((a['url'], size, mtime, hash_path(a['url']), frame_count, formula, natom_count,
+                         a.get('format'), time.time()))
+        conn = _connect(index_path)
+        try:
+            with conn:
+                conn.executemany(f'INSERT OR REPLACE INTO artifact ({", ".join(columns)}, updated_at) '
+                                 f'VALUES ({", ".join("?" * (len(columns) + 1))})', rows)
+        finally:
+            conn.close()
+
+    def lookup_artifacts(index_path: str, artifacts: List[ArtifactDict], fill: bool = False) -> List[Optional[IndexRecord]]:
+        """
+        Get the records of artifacts, None is returned for the artifacts that are not indexed,
+        or whose data has been changed since they were indexed.
+
+        :param fill: index the artifacts that don't have a valid record, but only stat and hash them,
+            so frames, formula and natoms are left empty
+        """
+        conn = _connect(index_path)
+        try:
+            records: List[Optional[IndexRecord]] = []
+            for a in artifacts:
+                row = conn.execute(f'SELECT {", ".join(columns)} FROM artifact WHERE url = ?', (a['url'],)).fetchone()
+                record = None
+                if row is not None and os.path.exists(a['url']):
+                    record = dict(zip(columns, row))
+                    if _stat_path(a['url']) != (record['size'], record['mtime']):
+                        record = None  # the data has been changed
+                records.append(record)  # type: ignore
+        finally:
+            conn.close()
+
+        if fill:
+            missing = [i for i, record in enumerate(records) if record is None and os.path.exists(artifacts[i]['url'])]
+            if missing:
+                index_artifacts(index_path, [artifacts[i] for i in missing])
+                for i, record in zip(missing, lookup_artifacts(index_path, [artifacts[i] for i in missing])):
+                    records[i] = record
+        return records
+
+    return (
+        IndexRecord,
+        index_artifacts,
+        lookup_artifacts,
+    )
+
+
+(
+    IndexRecord,
+    index_artifacts,
+    lookup_artifacts,
+) = __export_remote_functions()
@@ -1,19 +1,31 @@
-from typing import TypeVar, Union, Callable, NamedTuple, Optional
-from threading import Lock
+from typing import TypeVar, Union, Callable, NamedTuple, Optional, List, Tuple
+from abc import ABC, abstractmethod
+from threading import Lock, local
+from contextlib import contextmanager
+from pydantic import BaseModel
+import dataclasses
 import functools
 import cloudpickle
+import json
+import sqlite3
+import time
 import os
 import inspect
 import fnmatch
 
 from .log import get_logger
-from .util import to_awaitable
+from .artifact import ArtifactRecord
+from .util import to_awaitable, short_hash
+from .trace import call_in_stage
 
 logger = get_logger(__name__)
 
 _lock = Lock()
 _checkpoint_file: Optional[str] = None
-_checkpoint_data: Optional[dict] = None
+_store: Optional['CheckpointStore'] = None
+_input_hash = False
+_max_memo_entries: Optional[int] = None
+_max_memo_size: Optional[int] = None
 
 
 class FnInfo(NamedTuple):
@@ -28,22 +40,252 @@ KeyFn = Callable[[FnInfo], str]
 EMPTY = object()
 
 
-def set_checkpoint_file(path: str):
-    global _checkpoint_file
+class CheckpointStore(ABC):
+    """
+    Storage of checkpoint entries, each entry is a dict with `return`, `is_awaitable` and `info` fields.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, entry: dict):
+        ...
+
+    @abstractmethod
+    def delete(self, keys: List[str]):
+        ...
+
+    @abstractmethod
+    def list_info(self) -> List[Tuple[str, dict]]:
+        """
+        List the keys and infos of all entries without loading their values.
+        """
+        ...
+
+    def evict(self, max_entries: Optional[int] = None, max_size: Optional[int] = None) -> List[str]:
+        """
+        Remove the least recently used memo entries until the limits are met, return the removed keys.
+        Entries that are not created by input hash are never evicted.
+        """
+        return []
+
+
+class PickleCheckpointStore(CheckpointStore):
+    """
+    Legacy store that keeps all entries in one pickle file, which is rewritten on every change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = dict()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.data = cloudpickle.load(f)
+
+    def get(self, key: str):
+        return self.data.get(key, None)
+
+    def set(self, key: str, entry: dict):
+        self.data[key] = entry
+        self._dump()
+
+    def delete(self, keys: List[str]):
+        for key in keys:
+            self.data.pop(key, None)
+        self._dump()
+
+    def list_info(self):
+        return [(key, value['info']) for key, value in self.data.items()]
+
+    def _dump(self):
+        # write to a temporary file and then rename it, so a crash in the middle won't corrupt the file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cloudpickle.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    """
+    Store each entry as a row of a SQLite table, so that writes are incremental and atomic,
+    and the entries can be listed or deleted without loading their values.
+
+    The database runs in WAL mode, so that it can be shared by multiple processes,
+    e.g. several workflows running with the same checkpoint file:
+    readers don't block the writer, and writers wait for each other for at most `timeout` seconds.
+    Each thread and process has its own connection, and nothing is cached in memory,
+    so the entries written by other processes are visible immediately.
+    Note that WAL mode requires the file to be on a local file system.
+    """
+
+    def __init__(self, path: str, timeout: float = 60):
+        self.path = path
+        self.timeout = timeout
+        self._local = local()
+        conn = self._get_conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS checkpoint ('
+                         'key TEXT PRIMARY KEY, fn_name TEXT, call_site TEXT, '
+                         'value BLOB, updated_at REAL)')
+            # columns added for memo entries, files created by previous versions don't have them
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(checkpoint)')}
+            for column, column_type in [('size', 'INTEGER'), ('accessed_at', 'REAL'), ('memo', 'INTEGER')]:
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE checkpoint ADD COLUMN {column} {column_type}')
+
+    def get(self, key: str):
+        conn = self._get_conn()
+        row = conn.execute('SELECT value, memo FROM checkpoint WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1]:
+            with self._transaction() as conn:
+                conn.execute('UPDATE checkpoint SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return cloudpickle.loads(row[0])
+
+    def set(self, key: str, entry: dict):
+        info = entry['info']
+        value = cloudpickle.dumps(entry)
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO checkpoint '
+                         '(key, fn_name, call_site, value, updated_at, size, accessed_at, memo) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, info['fn_name'], info['call_site'], value, now,
+                          len(value), now, int(bool(info.get('input_hash')))))
+
+    def delete(self, keys: List[str]):
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM checkpoint WHERE key = ?', [(key,) for key in keys])
+
+    def list_info(self):
+        rows = self._get_conn().execute('SELECT key, fn_name, call_site FROM checkpoint ORDER BY updated_at')
+        return [(key, {'fn_name': fn_name, 'call_site': call_site}) for key, fn_name, call_site in rows]
+
+    def evict(self, max_entries: Optional[int] = None, max_size: Optional[int] = None):
+        # select and delete in one transaction, so the entries used by other processes in the meantime are kept
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT key, size FROM checkpoint WHERE memo = 1 '
+                                'ORDER BY accessed_at DESC').fetchall()
+            kept_entries, kept_size = 0, 0
+            evicted = []
+            for key, size in rows:
+                # keep the most recently used entries until any limit is reached
+                if (max_entries is not None and kept_entries >= max_entries) or \
+                        (max_size is not None and kept_size + (size or 0) > max_size):
+                    evicted.append(key)
+                    continue
+                kept_entries += 1
+                kept_size += size or 0
+            conn.executemany('DELETE FROM checkpoint WHERE key = ?', [(key,) for key in evicted])
+        return evicted
+
+    def _get_conn(self) -> sqlite3.Connection:
+        # connection can't be shared by threads or inherited by forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # isolation_level=None so that transactions are managed explicitly
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._get_conn()
+        # take the write lock at the beginning, so the reads in the transaction won't be stale
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def open_checkpoint_store(path: str) -> CheckpointStore:
+    """
+    Open the checkpoint file with SQLite store, unless it is an existing pickle file created by previous versions.
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            is_sqlite = f.read(16) == b'SQLite format 3\x00'
+        if not is_sqlite:
+            logger.warning(f'{path} is a pickle checkpoint file, every change will rewrite the whole file, '
+                           'and it must not be shared by multiple processes')
+            return PickleCheckpointStore(path)
+    return SqliteCheckpointStore(path)
+
+
+def set_checkpoint_file(path: str, input_hash: bool = False,
+                        max_memo_entries: Optional[int] = None, max_memo_size: Optional[int] = None):
+    """
+    Set the checkpoint file.
+
+    :param path: path of the checkpoint file
+    :param input_hash: use input hash by default, see `apply_checkpoint`
+    :param max_memo_entries: max number of entries created by input hash, the least recently used ones are evicted
+    :param max_memo_size: max total size in bytes of entries created by input hash
+    """
+    global _checkpoint_file, _input_hash, _max_memo_entries, _max_memo_size
     if _checkpoint_file is not None:
         raise RuntimeError(
             "checkpoint path has been set to {}".format(_checkpoint_file))
     _checkpoint_file = path
+    _input_hash = input_hash
+    _max_memo_entries = max_memo_entries
+    _max_memo_size = max_memo_size
     _load_checkpoint()
 
 
-def apply_checkpoint(key_fn: Union[str, KeyFn], disable = False):
+def hash_inputs(fn_info: FnInfo) -> str:
+    """
+    Hash the function name and the canonical form of its arguments.
+
+    Pydantic models (e.g. configs and `Artifact`), `ArtifactRecord` and dataclasses are hashed by their fields,
+    other objects that can't be serialized (e.g. executors) are hashed by their type only.
+    """
+    data = _canonical({
+        'fn_name': fn_info.fn_name,
+        'args': fn_info.args,
+        'kwargs': fn_info.kwargs,
+    })
+    return short_hash(json.dumps(data, sort_keys=True))
+
+
+def _canonical(obj):
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, BaseModel):
+        return _canonical(obj.dict())
+    if isinstance(obj, ArtifactRecord):
+        return _canonical(obj.to_dict())
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return _canonical({f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)})
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted(json.dumps(_canonical(v), sort_keys=True) for v in obj)
+    return f'<{type(obj).__module__}.{type(obj).__qualname__}>'
+
+
+def apply_checkpoint(key_fn: Union[str, KeyFn], disable = False, input_hash: Optional[bool] = None):
     """
     apply checkpoint for function.
 
-    Note: This checkpoint implementation doesn't support multiprocess.
-    To support multiple process we need to have a dedicated background process to read/write checkpoint,
-    which will require message queue (e.g. nanomsg or nng) to implement it.
+    If `input_hash` is enabled, the hash of the inputs is appended to the key,
+    so the entry is reused only when the inputs are the same, and a new entry is created when they change.
+    The stale entries are evicted by the limits set in `set_checkpoint_file`.
+    The default of `input_hash` is also set by `set_checkpoint_file`.
+
+    Note: The checkpoint file can be shared by multiple processes, e.g. several workflows running at the same time,
+    as long as it is a SQLite checkpoint file on a local file system.
+    Pickle checkpoint files created by previous versions can only be used by one process.
 
     Example:
 
@@ -68,22 +310,26 @@ def apply_checkpoint(key_fn: Union[str, KeyFn], disable = False):
 
             key = key_fn if isinstance(key_fn, str) else key_fn(fn_info)
 
+            # the key of checkpoint is also used as the stage of trace
             if disable or _checkpoint_file is None:
-                return fn(*args, **kwargs)
+                return call_in_stage(key, fn, *args, **kwargs)
+
+            use_input_hash = _input_hash if input_hash is None else input_hash
+            store_key = f'{key}@{hash_inputs(fn_info)}' if use_input_hash else key
 
-            ret = _get_checkpoint(key)
+            ret = _get_checkpoint(store_key)
             if ret is not EMPTY:
                 return ret
 
-            ret = fn(*args, **kwargs)
+            ret = call_in_stage(key, fn, *args, **kwargs)
             if inspect.isawaitable(ret):
                 async def _wrap_fn():
                     _ret = await ret
-                    _set_checkpoint(key, _ret, fn_info, True)
+                    _set_checkpoint(store_key, _ret, fn_info, True, use_input_hash)
                     return _ret
                 return _wrap_fn()
             else:
-                _set_checkpoint(key, ret, fn_info, False)
+                _set_checkpoint(store_key, ret, fn_info, False, use_input_hash)
                 return ret
 
         return wrapper # type: ignore
@@ -91,29 +337,19 @@ def apply_checkpoint(key_fn: Union[str, KeyFn], disable = False):
 
 
 def _load_checkpoint():
-    global _checkpoint_data
-    if _checkpoint_data is not None:
+    global _store
+    if _store is not None:
         return
     assert _checkpoint_file is not None, '_checkpoint_path should not be None!'
-    if os.path.exists(_checkpoint_file):
-        with open(_checkpoint_file, 'rb') as f:
-            _checkpoint_data = cloudpickle.load(f)
-    else:
-        _checkpoint_data = dict()
-
-
-def _dump_checkpoint():
-    assert _checkpoint_data is not None, '_checkpoint_data should not be None!'
-    with open(_checkpoint_file, 'wb') as f:  # type: ignore
-        cloudpickle.dump(_checkpoint_data, f)
+    _store = open_checkpoint_store(_checkpoint_file)
 
 
 def _get_checkpoint(key: str):
     try:
         with _lock:
             _load_checkpoint()
-            assert _checkpoint_data is not None
-            value = _checkpoint_data.get(key, None)
+            assert _store is not None
+            value = _store.get(key)
             if value is None:
                 return EMPTY
             logger.info(f"Hit checkpoint: {key}")
@@ -127,20 +363,24 @@ def _get_checkpoint(key: str):
         return EMPTY
 
 
-def _set_checkpoint(key: str, value, info: FnInfo, is_awaitable: bool = False):
+def _set_checkpoint(key: str, value, info: FnInfo, is_awaitable: bool = False, input_hash: bool = False):
     try:
         with _lock:
-            assert _checkpoint_data is not None
+            assert _store is not None
             # args, kwargs may contain unpickable objects
-            _checkpoint_data[key] = {
+            _store.set(key, {
                 'return': value,
                 'is_awaitable': is_awaitable,
                 'info': {
                     'fn_name': info.fn_name,
                     'call_site': info.call_site,
+                    'input_hash': input_hash,
                 }
-            }
-            _dump_checkpoint()
+            })
+            if input_hash and (_max_memo_entries is not None or _max_memo_size is not None):
+                evicted = _store.evict(_max_memo_entries, _max_memo_size)
+                if evicted:
+                    logger.info('Evict %d stale checkpoint entries', len(evicted))
     except Exception as e:
         logger.error('Fail to set checkpoint', e)
 
@@ -149,10 +389,8 @@ def del_checkpoint(key: str):
     try:
         with _lock:
             _load_checkpoint()
-            assert _checkpoint_data is not None
-            if key in _checkpoint_data:
-                del _checkpoint_data[key]
-                _dump_checkpoint()
+            assert _store is not None
+            _store.delete([key])
     except Exception as e:
         logger.error('Fail to delete checkpoint', e)
 
@@ -165,31 +403,38 @@ class CheckpointCmd:
 
     def ls(self, verbose=False):
         '''list all the checkpoint entries in the checkpoint file'''
-        assert _checkpoint_data is not None
-        for i, (key, value) in enumerate(_checkpoint_data.items()):
+        assert _store is not None
+        for i, (key, info) in enumerate(_store.list_info()):
             if verbose:
                 print('\n'.join([
                     '=' * 80,
                     f'Key:        \t{key}',
-                    f'Call Site:  \t{value["info"]["call_site"]}',
-                    f'Function:   \t{value["info"]["fn_name"]}',
+                    f'Call Site:  \t{info["call_site"]}',
+                    f'Function:   \t{info["fn_name"]}',
                 ]))
             else:
                 print(key)
 
     def rm(self, glob_pattern: str, yes=False, exclude: Optional[str]=None):
         """remove checkpoint entries with the given pattern"""
-        assert _checkpoint_data is not None
+        assert _store is not None
 
-        keys = [ key for key in _checkpoint_data.keys() if fnmatch.fnmatch(key, glob_pattern) ]
+        keys = [ key for key, _ in _store.list_info() if fnmatch.fnmatch(key, glob_pattern) ]
         if exclude is not None:
             keys = [ key for key in keys if not fnmatch.fnmatch(key, exclude) ]
 
+        deleted = []
         for key in keys:
             if not yes:
                 print(f"Delete checkpoint {key}? [y/n]")
                 if input().lower() != 'y':
                     continue
-            del _checkpoint_data[key]
+            deleted.append(key)
+            print(f"Delete checkpoint {key}")
+        _store.delete(deleted)
+
+    def evict(self, max_entries: Optional[int] = None, max_size: Optional[int] = None):
+        """remove the least recently used entries created by input hash until the limits are met"""
+        assert _store is not None
+        for key in _store.evict(max_entries, max_size):
             print(f"Delete checkpoint {key}")
-        _dump_checkpoint()
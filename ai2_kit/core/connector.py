@@ -1,20 +1,50 @@
 from fabric import Connection, Result
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Tuple, IO, Callable, NamedTuple, Literal
 from abc import ABC, abstractmethod
-from io import StringIO
+from io import StringIO, BytesIO
+from threading import Lock, Thread
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import subprocess
+import tarfile
+import fnmatch
+import queue
 import shlex
 import invoke
 import os
 import stat
 import json
 import glob
+import time
+
+from .util import run_in_thread
+from .trace import trace_span
 
 
 class SshConfig(BaseModel):
     host: str
     gateway: Optional['SshConfig']
+    max_connections: int = 1
+    """
+    Max number of ssh connections to the host,
+    commands and file transfers will run concurrently on them.
+    """
+
+
+class PipeProcess(NamedTuple):
+    """
+    A long-running process whose stdin and stdout are exposed as binary streams.
+    Use `wait` to get the exit code and `close` to release the underlying channel or process.
+    """
+    stdin: IO[bytes]
+    stdout: IO[bytes]
+    wait: Callable[[], int]
+    close: Callable[[], None]
+
+
+ArchiveCompress = Literal['gz', 'zstd']
 
 
 class BaseConnector(ABC):
@@ -23,14 +53,39 @@ class BaseConnector(ABC):
     def dump_text(self, text: str, path: str):
         ...
 
+    @abstractmethod
+    def load_bytes(self, path: str) -> bytes:
+        ...
+
     @abstractmethod
     def glob(self, pattern: str) -> List[str]:
         ...
 
+    def glob_many(self, patterns: List[str]) -> List[List[str]]:
+        """
+        Expand multiple glob patterns, return the matched paths of each pattern.
+        Remote connectors should override it to expand all of them in one round trip.
+        """
+        return [self.glob(pattern) for pattern in patterns]
+
     @abstractmethod
     def run(self, script: str, **kwargs) -> Result:
         ...
 
+    # the async variants run the blocking implementation in a thread pool,
+    # so that the event loop won't be blocked by network round trips
+    async def run_async(self, script: str, **kwargs) -> Result:
+        return await run_in_thread(self.run, script, **kwargs)
+
+    async def dump_text_async(self, text: str, path: str):
+        return await run_in_thread(self.dump_text, text, path)
+
+    async def glob_async(self, pattern: str) -> List[str]:
+        return await run_in_thread(self.glob, pattern)
+
+    async def glob_many_async(self, patterns: List[str]) -> List[List[str]]:
+        return await run_in_thread(self.glob_many, patterns)
+
     @abstractmethod
     def upload(self, from_path: str, to_dir: str) -> str:
         ...
@@ -43,7 +98,136 @@ class BaseConnector(ABC):
     def sym_link(self, from_path: str, to_dir: str) -> str:
         ...
 
+    @abstractmethod
+    def popen(self, cmd: str) -> PipeProcess:
+        """
+        Start a command and keep its stdin and stdout open for streaming.
+        stderr is not captured, redirect it in `cmd` if it may be large.
+        """
+        ...
+
+    def upload_archive(self, from_path: str, to_dir: str,
+                       compress: Optional[ArchiveCompress] = None,
+                       includes: Optional[List[str]] = None,
+                       excludes: Optional[List[str]] = None) -> str:
+        """
+        Upload a file or directory as a tar stream over a single channel.
+
+        :param compress: compress the stream with gz or zstd, zstd requires the `zstandard` package locally
+        :param includes: glob patterns relative to from_path, only matched files will be transferred
+        :param excludes: glob patterns relative to from_path, matched files will be skipped
+        """
+        from_path = os.path.normpath(from_path)
+        basename = safe_basename(from_path)
+        to_path = os.path.join(to_dir, basename)
+
+        files = []
+        if os.path.isdir(from_path):
+            for root, _dirs, file_names in os.walk(from_path):
+                for file_name in file_names:
+                    path = os.path.join(root, file_name)
+                    rel_path = os.path.relpath(path, from_path)
+                    if _match_archive_filter(rel_path, includes, excludes):
+                        files.append((path, os.path.join(basename, rel_path)))
+        else:
+            files.append((from_path, basename))
+
+        cmd = f'mkdir -p {shlex.quote(to_dir)} && cd {shlex.quote(to_dir)} && '
+        if compress == 'zstd':
+            cmd += 'zstd -q -d -c | tar -xf -'
+        else:
+            cmd += 'tar -xzf -' if compress == 'gz' else 'tar -xf -'
+
+        bytes_out = sum(os.path.getsize(path) for path, _ in files)
+        with trace_span('connector.upload_archive', 'connector', path=from_path, files=len(files), bytes_out=bytes_out):
+            exit_code = self._write_archive(cmd, files, compress)
+        if exit_code:
+            raise RuntimeError(f'fail to upload {from_path} to {to_dir} as archive, exit code: {exit_code}')
+        return to_path
+
+    def _write_archive(self, cmd: str, files: List[Tuple[str, str]], compress: Optional[ArchiveCompress]) -> int:
+        process = self.popen(cmd)
+        try:
+            stream = process.stdin
+            if compress == 'zstd':
+                stream = _get_zstandard().ZstdCompressor().stream_writer(stream, closefd=False)
+            with tarfile.open(fileobj=stream, mode='w|gz' if compress == 'gz' else 'w|') as tar:
+                for path, arcname in files:
+                    tar.add(path, arcname=arcname, recursive=False)
+            if compress == 'zstd':
+                stream.close()
+            process.stdin.close()
+            return process.wait()
+        finally:
+            process.close()
+
+    def download_archive(self, from_path: str, to_dir: str,
+                         compress: Optional[ArchiveCompress] = None,
+                         includes: Optional[List[str]] = None,
+                         excludes: Optional[List[str]] = None) -> str:
+        """
+        Download a file or directory as a tar stream over a single channel.
+
+        The include and exclude patterns are matched in the same way as `upload_archive`,
+        that is, with `fnmatch` on the paths relative to from_path, for example `*/model_devi.out`.
+        """
+        from_path = os.path.normpath(from_path)
+        basename = safe_basename(from_path)
+        parent = os.path.dirname(from_path) or '.'
+        to_path = os.path.join(to_dir, basename)
+
+        names = None
+        if includes or excludes:
+            # list the remote files and filter them locally,
+            # so that both directions share the same matching rule
+            result = self.run(f'cd {shlex.quote(parent)} && find {shlex.quote(basename)} \\( -type f -o -type l \\) -print0',
+                              hide=True)
+            # a single file is always transferred, the same as upload_archive
+            names = [name for name in result.stdout.split('\0') if name and (
+                name == basename or _match_archive_filter(os.path.relpath(name, basename), includes, excludes))]
+
+        pipeline = f'set -o pipefail && cd {shlex.quote(parent)} && '
+        pipeline += f'tar -cf - {shlex.quote(basename)}' if names is None else 'tar --null --no-recursion -T - -cf -'
+        if compress == 'zstd':
+            pipeline += ' | zstd -q -c'
+        elif compress == 'gz':
+            pipeline += ' | gzip -c'
+        # the login shell of the remote host may not be bash
+        cmd = f'bash -c {shlex.quote(pipeline)}'
+
+        os.makedirs(to_dir, exist_ok=True)
+        with trace_span('connector.download_archive', 'connector', path=from_path):
+            process = self.popen(cmd)
+            try:
+                if names is not None:
+                    # feed the names in another thread in case tar blocks on a full stdout
+                    Thread(target=_write_names, args=(process.stdin, names), daemon=True).start()
+                stream = process.stdout
+                if compress == 'zstd':
+                    stream = _get_zstandard().ZstdDecompressor().stream_reader(stream, closefd=False)
+                with tarfile.open(fileobj=stream, mode='r|gz' if compress == 'gz' else 'r|') as tar:
+                    if hasattr(tarfile, 'tar_filter'):
+                        tar.extractall(to_dir, filter='tar')
+                    else:
+                        tar.extractall(to_dir)
+                exit_code = process.wait()
+            finally:
+                process.close()
+        if exit_code:
+            raise RuntimeError(f'fail to download {from_path} to {to_dir} as archive, exit code: {exit_code}')
+        return to_path
+
 class SshConnector(BaseConnector):
+    """
+    Connector that runs commands and transfers files over ssh.
+
+    A pool of up to `max_connections` authenticated connections is kept,
+    all of them share the same gateway chain, so they are opened under the lock of the pool,
+    or else the threads that open them at the same time would race on the transport of the gateway.
+    Each operation borrows a connection from the pool,
+    so that operations issued from different threads can run concurrently,
+    and each connection reuses its own sftp session.
+    """
 
     @classmethod
     def from_config(cls, config: SshConfig):
@@ -54,23 +238,108 @@ class SshConnector(BaseConnector):
             next_connection.gateway = Connection(host=next_config.host)
             next_connection = next_connection.gateway
             next_config = next_config.gateway
-        return cls(connection)
+        return cls(connection, max_connections=config.max_connections)
 
-    def __init__(self, connection: Connection):
+    def __init__(self, connection: Connection, max_connections: int = 1):
         self._connection = connection
+        self._max_connections = max(1, max_connections)
+        self._connections = [connection]
+        self._idle_connections: 'queue.LifoQueue[Connection]' = queue.LifoQueue()
+        self._idle_connections.put(connection)
+        self._pool_lock = Lock()
+
+    @contextmanager
+    def _borrow(self):
+        try:
+            connection = self._idle_connections.get_nowait()
+        except queue.Empty:
+            connection = None
+            with self._pool_lock:
+                if len(self._connections) < self._max_connections:
+                    # the gateway connection is shared, so the chain of jump hosts is only authenticated once
+                    primary = self._connection
+                    connection = Connection(host=primary.original_host, user=primary.user, port=primary.port,
+                                            config=primary.config, connect_kwargs=primary.connect_kwargs,
+                                            gateway=primary.gateway)
+                    self._connections.append(connection)
+            if connection is None:
+                connection = self._idle_connections.get()
+        try:
+            self._open(connection)
+            yield connection
+        finally:
+            self._idle_connections.put(connection)
+
+    def _open(self, connection: Connection):
+        if not connection.is_connected:
+            with self._pool_lock:
+                # the gateway is opened by the connection if it is not connected yet
+                connection.open()
 
     def dump_text(self, text: str, path: str):
-        f = StringIO(text)
-        self.put(f, path)
+        with trace_span('connector.dump_text', 'connector', path=path, bytes_out=len(text)):
+            f = StringIO(text)
+            self.put(f, path)
+
+    def load_bytes(self, path: str) -> bytes:
+        with trace_span('connector.load_bytes', 'connector', path=path) as span:
+            buf = BytesIO()
+            with self._borrow() as connection:
+                connection.sftp().getfo(path, buf)
+            span['bytes_in'] = buf.tell()
+        return buf.getvalue()
 
     def glob(self, pattern: str):
-        python_script = 'from glob import glob; from json import dumps; print(dumps(glob({})))'.format(repr(pattern))
-        cmd = 'python -c {}'.format(shlex.quote(python_script))
-        result = self.run(cmd, hide=True)
-        return json.loads(result.stdout)
+        with trace_span('connector.glob', 'connector', pattern=pattern) as span:
+            python_script = 'from glob import glob; from json import dumps; print(dumps(glob({})))'.format(repr(pattern))
+            cmd = 'python -c {}'.format(shlex.quote(python_script))
+            result = self.run(cmd, hide=True)
+            paths = json.loads(result.stdout)
+            span['matches'] = len(paths)
+        return paths
+
+    def glob_many(self, patterns: List[str]):
+        if not patterns:
+            return []
+        with trace_span('connector.glob_many', 'connector', patterns=len(patterns)) as span:
+            # the patterns are sent via stdin, so that a lot of them won't exceed the size limit of command line
+            python_script = 'import sys, json; from glob import glob; print(json.dumps([glob(p) for p in json.load(sys.stdin)]))'
+            process = self.popen('python -c {}'.format(shlex.quote(python_script)))
+            try:
+                process.stdin.write(json.dumps(list(patterns)).encode('utf-8'))
+                process.stdin.close()
+                output = process.stdout.read()
+                exit_code = process.wait()
+            finally:
+                process.close()
+            if exit_code:
+                raise RuntimeError(f'fail to expand {len(patterns)} glob patterns, exit code: {exit_code}')
+            paths_list = json.loads(output)
+            span['matches'] = sum(len(paths) for paths in paths_list)
+        return paths_list
 
     def run(self, script, **kwargs) -> Result:
-        return self._connection.run(script, **kwargs)
+        with trace_span('connector.run', 'connector', bytes_out=len(script)) as span:
+            borrow_at = time.time()
+            with self._borrow() as connection:
+                # time spent on waiting for a free connection of the pool
+                span['wait_connection'] = time.time() - borrow_at
+                result = connection.run(script, **kwargs)
+            _trace_result(span, result)
+        return result
+
+    def popen(self, cmd: str) -> PipeProcess:
+        # a channel of a long-running process doesn't occupy the connection,
+        # so it is fine to open it on the primary connection
+        self._open(self._connection)
+        channel = self._connection.transport.open_session()  # type: ignore
+        channel.exec_command(cmd)
+        return PipeProcess(
+            stdin=channel.makefile_stdin('wb'),
+            stdout=channel.makefile('rb'),
+            wait=channel.recv_exit_status,
+            close=channel.close,
+        )
 
     def sym_link(self, from_path: str, to_dir: str) -> str:
         self.mkdir(to_dir)
@@ -89,61 +358,121 @@ class SshConnector(BaseConnector):
         return to_path
 
     def download(self, from_path: str, to_dir: str) -> str:
-        sftp = self.get_sftp()
         os.makedirs(to_dir, exist_ok=True)
         to_path = os.path.join(to_dir, safe_basename(from_path))
-        if stat.S_ISDIR(sftp.lstat(from_path).st_mode):  # type: ignore
+        with self._borrow() as connection:
+            is_dir = stat.S_ISDIR(connection.sftp().lstat(from_path).st_mode)  # type: ignore
+        if is_dir:
             self.get_dir(from_path, to_path)
         else:
-            sftp.get(from_path, to_path)
+            self.get(from_path, to_path)
         return to_path
 
-    def put(self, *args, **kwargs):
-        return self._connection.put(*args, **kwargs)
+    def put(self, local, *args, **kwargs):
+        with trace_span('connector.put', 'connector', bytes_out=_local_size(local)):
+            with self._borrow() as connection:
+                return connection.put(local, *args, **kwargs)
 
     def get(self, *args, **kwargs):
-        return self._connection.get(*args, **kwargs)
+        with trace_span('connector.get', 'connector') as span:
+            with self._borrow() as connection:
+                result = connection.get(*args, **kwargs)
+            span['bytes_in'] = _local_size(result.local)
+        return result
 
-    def mkdir(self, dir_path: str):
-        self._connection.run('mkdir -p {}'.format(shlex.quote(dir_path)))
+    def mkdir(self, *dir_paths: str):
+        self.run('mkdir -p {}'.format(' '.join(shlex.quote(p) for p in dir_paths)))
 
     def put_dir(self, from_dir: str, to_dir: str):
-        self.mkdir(to_dir)
-        for item in os.listdir(from_dir):
-            from_path = os.path.join(from_dir, item)
-            to_path = os.path.join(to_dir, item)
-            if os.path.isdir(from_path):
-                self.put_dir(from_path, to_path)
-            else:
-                self.put(from_path, to_path)
+        # create all the directories in one command and then transfer files concurrently
+        dirs, files = [to_dir], []
+        for root, dir_names, file_names in os.walk(from_dir):
+            rel_root = os.path.relpath(root, from_dir)
+            dirs += [os.path.normpath(os.path.join(to_dir, rel_root, d)) for d in dir_names]
+            files += [(os.path.join(root, f), os.path.normpath(os.path.join(to_dir, rel_root, f))) for f in file_names]
+        self._mkdirs(dirs)
+        self._transfer_files(self.put, files)
+
+    def _mkdirs(self, dirs: List[str]):
+        """
+        Create directories in one command, the paths are sent via stdin,
+        so that a large tree won't exceed the size limit of command line.
+        """
+        process = self.popen('xargs -0 -r mkdir -p')
+        try:
+            process.stdin.write(b'\0'.join(d.encode('utf-8') for d in dirs))
+            process.stdin.close()
+            exit_code = process.wait()
+        finally:
+            process.close()
+        if exit_code:
+            raise RuntimeError(f'fail to create {len(dirs)} directories, exit code: {exit_code}')
 
     def get_dir(self, from_dir: str, to_dir: str):
-        sftp = self.get_sftp()
-        os.makedirs(to_dir, exist_ok=True)
-
-        for item in sftp.listdir_attr(from_dir):
-            from_path = os.path.join(from_dir, item.filename)
-            to_path = os.path.join(to_dir, item.filename)
-            if stat.S_ISDIR(item.st_mode):  # type: ignore
-                self.get_dir(from_path, to_path)
-            else:
-                sftp.get(from_path, to_path)
+        files = []
+        with self._borrow() as connection:
+            sftp = connection.sftp()
+            pending = [(from_dir, to_dir)]
+            while pending:
+                remote_dir, local_dir = pending.pop()
+                os.makedirs(local_dir, exist_ok=True)
+                for item in sftp.listdir_attr(remote_dir):
+                    from_path = os.path.join(remote_dir, item.filename)
+                    to_path = os.path.join(local_dir, item.filename)
+                    if stat.S_ISDIR(item.st_mode):  # type: ignore
+                        pending.append((from_path, to_path))
+                    else:
+                        files.append((from_path, to_path))
+        self._transfer_files(self.get, files)
 
     def get_sftp(self):
         return self._connection.sftp()
 
+    def _transfer_files(self, transfer_fn, files: List[Tuple[str, str]]):
+        if self._max_connections == 1 or len(files) < 2:
+            for from_path, to_path in files:
+                transfer_fn(from_path, to_path)
+            return
+        with ThreadPoolExecutor(max_workers=self._max_connections) as pool:
+            # consume the results to raise errors of transfer
+            list(pool.map(lambda item: transfer_fn(*item), files))
+
 
 class LocalConnector(BaseConnector):
 
     def dump_text(self, text: str, path: str):
-        with open(path, 'w') as f:
-            f.write(text)
+        with trace_span('connector.dump_text', 'connector', path=path, bytes_out=len(text)):
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def load_bytes(self, path: str) -> bytes:
+        with trace_span('connector.load_bytes', 'connector', path=path) as span:
+            with open(path, 'rb') as f:
+                data = f.read()
+            span['bytes_in'] = len(data)
+        return data
 
     def glob(self, pattern: str):
-        return glob.glob(pattern)
+        with trace_span('connector.glob', 'connector', pattern=pattern) as span:
+            paths = glob.glob(pattern)
+            span['matches'] = len(paths)
+        return paths
 
     def run(self, script, **kwargs):
-        return invoke.run(script, **kwargs)
+        with trace_span('connector.run', 'connector', bytes_out=len(script)) as span:
+            result = invoke.run(script, **kwargs)
+            _trace_result(span, result)
+        return result
+
+    def popen(self, cmd: str) -> PipeProcess:
+        # use bash as the shell to keep the same behavior as `run`
+        proc = subprocess.Popen(cmd, shell=True, executable=None if os.name == 'nt' else '/bin/bash',
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        def close():
+            proc.stdin.close()  # type: ignore
+            proc.stdout.close()  # type: ignore
+            proc.wait()
+        return PipeProcess(stdin=proc.stdin, stdout=proc.stdout, wait=proc.wait, close=close)  # type: ignore
 
     def sym_link(self, from_path: str, to_dir: str) -> str:
         os.makedirs(to_dir, exist_ok=True)
@@ -159,6 +488,20 @@ class LocalConnector(BaseConnector):
         return self.sym_link(from_path, to_dir)
 
 
+def _trace_result(span: dict, result):
+    if result is not None:
+        span['bytes_in'] = len(result.stdout or '') + len(result.stderr or '')
+        span['exit_code'] = result.return_code
+
+
+def _local_size(local) -> int:
+    if isinstance(local, str):
+        return os.path.getsize(local) if os.path.isfile(local) else 0
+    if hasattr(local, 'getvalue'):
+        return len(local.getvalue())
+    return 0
+
+
 def get_ln_cmd(from_path: str, to_path: str):
     """
     The reason to `rm -d` to_path is to workaround the limit of ln.
@@ -182,3 +525,26 @@ def safe_basename(path: str, default=''):
     if basename in ('/', '.', '..', ''):
         return default
     return basename
+
+
+def _match_archive_filter(path: str, includes: Optional[List[str]], excludes: Optional[List[str]]):
+    if includes and not any(fnmatch.fnmatch(path, p) for p in includes):
+        return False
+    if excludes and any(fnmatch.fnmatch(path, p) for p in excludes):
+        return False
+    return True
+
+
+def _write_names(stream: IO[bytes], names: List[str]):
+    try:
+        stream.write(b''.join(name.encode() + b'\0' for name in names))
+    finally:
+        stream.close()
+
+
+def _get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstandard is required to use zstd compression, install it with `pip install zstandard`')
+    return zstandard
@@ -1,33 +1,67 @@
-from .queue_system import QueueSystemConfig, BaseQueueSystem, Slurm, Lsf, PBS
+from .queue_system import QueueSystemConfig, BaseQueueSystem, Slurm, Lsf, PBS, Local, JobLimiter
 from .job import JobFuture
-from .artifact import Artifact
-from .connector import SshConfig, BaseConnector, SshConnector, LocalConnector
-from .util import s_uuid
+from .artifact import Artifact, AnyArtifact
+from .connector import SshConfig, BaseConnector, SshConnector, LocalConnector, PipeProcess, ArchiveCompress
+from .connector import get_ln_cmd, safe_basename
+from .util import s_uuid, short_hash, hash_path, hash_paths
+from .trace import trace_span
 from .log import get_logger
 from .pydantic import BaseModel
 
 logger = get_logger(__name__)
 
 
-from typing import Optional, Dict, List, TypeVar, Callable, Mapping, Union
+from typing import Optional, Dict, List, TypeVar, Callable, Mapping, Union, Literal, Iterator
 from abc import ABC, abstractmethod
+from threading import Lock, Condition, get_ident
+from contextlib import contextmanager
 from invoke import Result
 import os
 import shlex
+import shutil
 import base64
 import bz2
 import cloudpickle
 
 
+PythonCodec = Literal['bz2', 'zstd', 'lz4', 'none']
+
+
 class BaseExecutorConfig(BaseModel):
     ssh: Optional[SshConfig]
     queue_system: QueueSystemConfig
     work_dir: str
     python_cmd: str = 'python'
+    python_worker: bool = False
+    """
+    Keep long-lived python processes on the executor to serve `run_python_fn`,
+    so that imported modules stay warm across calls.
+    """
+    python_workers: int = 4
+    """
+    Max number of python worker processes, so that the calls from different threads run in parallel.
+    A worker serves one call at a time, the calls wait for a free worker when all of them are busy.
+    """
+    upload_cache: bool = False
+    """
+    Store uploaded data in a content-addressed directory under work_dir,
+    so that data that has been uploaded before only needs to be linked.
+    """
+    python_codec: PythonCodec = 'bz2'
+    """
+    Compression of the function and the result of `run_python_fn`,
+    zstd and lz4 require the `zstandard` and `lz4` packages on both sides.
+    """
+    python_result_file_threshold: int = 1 << 20
+    """
+    Results of `run_python_fn` larger than this size (in bytes, after compression)
+    are written to a file in tmp_dir and fetched by file transfer instead of stdout.
+    """
 
 ExecutorMap = Mapping[str, BaseExecutorConfig]
 
 FnType = TypeVar('FnType', bound=Callable)
+T = TypeVar('T')
 
 class Executor(ABC):
 
@@ -39,6 +73,12 @@ class Executor(ABC):
     def init(self):
         ...
 
+    def close(self):
+        """
+        Release the resources held by the executor, e.g. the python workers.
+        """
+        ...
+
     @abstractmethod
     def mkdir(self, path: str):
         ...
@@ -51,6 +91,10 @@ class Executor(ABC):
     def run_python_fn(self, fn: FnType, python_cmd=None) -> FnType:
         ...
 
+    @abstractmethod
+    def run_python_iter(self, fn: Callable[..., Iterator[T]], python_cmd=None) -> Callable[..., Iterator[T]]:
+        ...
+
     @abstractmethod
     def dump_text(self, text: str, path: str):
         ...
@@ -63,6 +107,10 @@ class Executor(ABC):
     def glob(self, pattern: str) -> List[str]:
         ...
 
+    @abstractmethod
+    def glob_many(self, patterns: List[str]) -> List[List[str]]:
+        ...
+
     @abstractmethod
     def run(self, script: str, **kwargs) -> Result:
         ...
@@ -72,15 +120,41 @@ class Executor(ABC):
         ...
 
     @abstractmethod
-    def upload(self, from_artifact: Artifact, to_dir: str) -> Artifact:
+    async def submit_async(self, script: str, **kwargs) -> JobFuture:
         ...
 
     @abstractmethod
-    def download(self, from_artifact: Artifact, to_dir: str) -> Artifact:
+    def submit_array(self, scripts: List[str], **kwargs) -> List[JobFuture]:
         ...
 
     @abstractmethod
-    def resolve_artifact(self, artifact: Artifact) -> List[str]:
+    async def submit_array_async(self, scripts: List[str], **kwargs) -> List[JobFuture]:
+        ...
+
+    @abstractmethod
+    def upload(self, from_artifact: AnyArtifact, to_dir: str, stream: bool = False,
+               compress: Optional[ArchiveCompress] = None,
+               includes: Optional[List[str]] = None,
+               excludes: Optional[List[str]] = None) -> Artifact:
+        ...
+
+    @abstractmethod
+    def download(self, from_artifact: AnyArtifact, to_dir: str, stream: bool = False,
+                 compress: Optional[ArchiveCompress] = None,
+                 includes: Optional[List[str]] = None,
+                 excludes: Optional[List[str]] = None) -> Artifact:
+        ...
+
+    @abstractmethod
+    def resolve_artifact(self, artifact: AnyArtifact) -> List[str]:
+        ...
+
+    @abstractmethod
+    def resolve_artifacts(self, artifacts: List[AnyArtifact]) -> List[List[str]]:
+        ...
+
+    @abstractmethod
+    def transfer_from(self, src: 'Executor', paths: List[str]) -> List[str]:
         ...
 
     def setup_workspace(self, workspace_dir: str, dirs: List[str]):
@@ -110,22 +184,45 @@ class HpcExecutor(Executor):
         elif config.queue_system.pbs:
             queue_system = PBS()
             queue_system.config = config.queue_system.pbs
+        elif config.queue_system.local:
+            if not isinstance(connector, LocalConnector):
+                raise ValueError('Local queue system can only be used without ssh!')
+            queue_system = Local()
+            queue_system.config = config.queue_system.local
         if queue_system is None:
             raise ValueError('Queue system config is missing!')
         queue_system.connector = connector
-        return cls(connector, queue_system, config.work_dir, config.python_cmd, name)
+        if config.queue_system.job_limit:
+            queue_system.job_limiter = JobLimiter(config.queue_system.job_limit)
+        return cls(connector, queue_system, config.work_dir, config.python_cmd, name,
+                   python_worker=config.python_worker,
+                   python_workers=config.python_workers,
+                   upload_cache=config.upload_cache,
+                   python_codec=config.python_codec,
+                   python_result_file_threshold=config.python_result_file_threshold)
 
     @property
     def is_local(self):
         return isinstance(self.connector, LocalConnector)
 
-    def __init__(self, connector: BaseConnector, queue_system: BaseQueueSystem, work_dir: str, python_cmd: str, name: str):
+    def __init__(self, connector: BaseConnector, queue_system: BaseQueueSystem, work_dir: str, python_cmd: str, name: str,
+                 python_worker: bool = False,
+                 upload_cache: bool = False,
+                 python_codec: PythonCodec = 'bz2',
+                 python_result_file_threshold: int = 1 << 20,
+                 python_workers: int = 4):
         self.name = name
         self.connector = connector
         self.queue_system = queue_system
         self.work_dir = work_dir
         self.python_cmd = python_cmd
         self.tmp_dir = os.path.join(self.work_dir, '.tmp')  # TODO: make it configurable
+        self._python_worker_enabled = python_worker
+        self._python_workers = python_workers
+        self._python_worker: Optional[PythonWorkerPool] = None
+        self._upload_cache = upload_cache
+        self._python_codec: PythonCodec = python_codec
+        self._python_result_file_threshold = python_result_file_threshold
 
     def init(self):
         # if work_dir is relative path, it will be relative to user home
@@ -136,6 +233,18 @@ class HpcExecutor(Executor):
         self.mkdir(self.work_dir)
         self.mkdir(self.tmp_dir)
 
+        if self._python_worker_enabled:
+            self._python_worker = PythonWorkerPool(self._python_workers, self.connector, self.python_cmd,
+                                                   cwd=self.work_dir, tmp_dir=self.tmp_dir,
+                                                   codec=self._python_codec,
+                                                   result_file_threshold=self._python_result_file_threshold)
+            self._python_worker.start()
+
+    def close(self):
+        if self._python_worker is not None:
+            self._python_worker.close()
+            self._python_worker = None
+
     def mkdir(self, path: str):
         return self.connector.run('mkdir -p {}'.format(shlex.quote(path)))
 
@@ -149,6 +258,9 @@ class HpcExecutor(Executor):
     def glob(self, pattern: str):
         return self.connector.glob(pattern)
 
+    def glob_many(self, patterns: List[str]):
+        return self.connector.glob_many(patterns)
+
     def run(self, script: str, **kwargs):
         return self.connector.run(script, **kwargs)
 
@@ -160,45 +272,278 @@ class HpcExecutor(Executor):
         cd_cwd = f'cd {shlex.quote(cwd)}  &&'
         script_len = len(script)
         logger.info('the size of generated python script is %s', script_len)
-        if script_len < 100_000: # ssh connection will be closed of the size of command is too large
-            return self.connector.run(f'{cd_cwd} {python_cmd} -c {shlex.quote(script)}', hide=True)
-        else:
-            script_path = os.path.join(self.tmp_dir, f'run_python_script_{s_uuid()}.py')
-            self.dump_text(script, script_path)
-            ret = self.connector.run(f'{cd_cwd} {python_cmd} {shlex.quote(script_path)}', hide=True)
-            self.connector.run(f'rm {shlex.quote(script_path)}')
-            return ret
+        with trace_span('executor.run_python_script', 'executor', script_len=script_len):
+            if script_len < 100_000: # ssh connection will be closed of the size of command is too large
+                return self.connector.run(f'{cd_cwd} {python_cmd} -c {shlex.quote(script)}', hide=True)
+            else:
+                script_path = os.path.join(self.tmp_dir, f'run_python_script_{s_uuid()}.py')
+                self.dump_text(script, script_path)
+                ret = self.connector.run(f'{cd_cwd} {python_cmd} {shlex.quote(script_path)}', hide=True)
+                self.connector.run(f'rm {shlex.quote(script_path)}')
+                return ret
 
     def run_python_fn(self, fn: FnType, python_cmd=None, cwd=None) -> FnType:
         def remote_fn(*args, **kwargs):
-            script = fn_to_script(lambda: fn(*args, **kwargs), delimiter='@')
-            ret = self.run_python_script(script=script, python_cmd=python_cmd, cwd=None)
-            _, r = ret.stdout.rsplit('@', 1)
-            return cloudpickle.loads(bz2.decompress(base64.b64decode(r)))
+            worker = self._python_worker
+            with trace_span('executor.run_python_fn', 'executor', fn=getattr(fn, '__name__', repr(fn))) as span:
+                if self._use_python_worker(python_cmd):
+                    assert worker is not None
+                    span['python_worker'] = True
+                    return worker.call(lambda: fn(*args, **kwargs), cwd=self.work_dir if cwd is None else cwd)
+                result_path = os.path.join(self.tmp_dir, f'run_python_fn_{s_uuid()}.result')
+                script = fn_to_script(lambda: fn(*args, **kwargs), delimiter='@',
+                                      codec=self._python_codec, result_path=result_path,
+                                      result_file_threshold=self._python_result_file_threshold)
+                ret = self.run_python_script(script=script, python_cmd=python_cmd, cwd=cwd)
+                _, r = ret.stdout.rsplit('@', 1)
+                return _load_python_result(self.connector, r.strip().encode('ascii'), result_path, self._python_codec)
         return remote_fn  # type: ignore
 
+    def run_python_iter(self, fn: Callable[..., Iterator[T]], python_cmd=None, cwd=None) -> Callable[..., Iterator[T]]:
+        """
+        Run a generator function remotely and stream its items back as they are yielded,
+        so that the caller can start processing before the remote side finishes,
+        and neither side needs to hold the whole result in memory.
+        """
+        def remote_iter(*args, **kwargs):
+            _cwd = self.work_dir if cwd is None else cwd
+            worker = self._python_worker
+            if self._use_python_worker(python_cmd):
+                assert worker is not None
+                yield from worker.iter_call(lambda: fn(*args, **kwargs), cwd=_cwd)
+                return
+
+            script = fn_to_iter_script(lambda: fn(*args, **kwargs), codec=self._python_codec)
+            log_path = os.path.join(self.tmp_dir, f'run_python_iter_{s_uuid()}.log')
+            script_path = None
+            if len(script) < 100_000:
+                run_script = f'-u -c {shlex.quote(script)}'
+            else:
+                script_path = os.path.join(self.tmp_dir, f'run_python_iter_{s_uuid()}.py')
+                self.dump_text(script, script_path)
+                run_script = f'-u {shlex.quote(script_path)}'
+            # stderr must be redirected, or the unread output may block the process
+            cmd = (f'cd {shlex.quote(_cwd)} && {python_cmd or self.python_cmd} {run_script} '
+                   f'2>> {shlex.quote(log_path)}')
+            process = self.connector.popen(cmd)
+            # the files are removed even if the consumer stops early,
+            # except the log of a failed process, which is referred by the error message
+            to_remove = [log_path]
+            try:
+                yield from _iter_frames(process.stdout, self._python_codec, log_path)
+            except Exception:
+                to_remove = []
+                raise
+            finally:
+                process.close()
+                if script_path is not None:
+                    to_remove.append(script_path)
+                if to_remove:
+                    self.connector.run('rm -f ' + ' '.join(map(shlex.quote, to_remove)), warn=True, hide=True)
+        return remote_iter
+
+    def _use_python_worker(self, python_cmd):
+        worker = self._python_worker
+        # the worker is occupied if the current thread is consuming a stream from it,
+        # fallback to start a new process to avoid deadlock
+        return (worker is not None and python_cmd in (None, self.python_cmd)
+                and not worker.is_streaming())
+
     def submit(self, script: str, cwd: str, **kwargs):
         return self.queue_system.submit(script, cwd=cwd, **kwargs)
 
-    def resolve_artifact(self, artifact: Artifact) -> List[str]:
+    async def submit_async(self, script: str, cwd: str, **kwargs):
+        return await self.queue_system.submit_async(script, cwd=cwd, **kwargs)
+
+    def submit_array(self, scripts: List[str], cwd: str):
+        return self.queue_system.submit_array(scripts, cwd=cwd)
+
+    async def submit_array_async(self, scripts: List[str], cwd: str):
+        return await self.queue_system.submit_array_async(scripts, cwd=cwd)
+
+    def resolve_artifact(self, artifact: AnyArtifact) -> List[str]:
         if artifact.includes is None:
             return [artifact.url]
         pattern = os.path.join(artifact.url, artifact.includes)
         return self.glob(pattern)
 
-    def upload(self, from_artifact: Artifact, to_dir: str) -> Artifact:
-        dest_path = self.connector.upload(from_artifact.url, to_dir)
+    def resolve_artifacts(self, artifacts: List[AnyArtifact]) -> List[List[str]]:
+        """
+        Resolve the paths of multiple artifacts, the glob patterns are expanded in one call.
+        """
+        patterns = [os.path.join(a.url, a.includes) for a in artifacts if a.includes is not None]
+        matches = iter(self.glob_many(patterns))
+        return [[a.url] if a.includes is None else next(matches) for a in artifacts]
+
+    def upload(self, from_artifact: AnyArtifact, to_dir: str, stream: bool = False,
+               compress: Optional[ArchiveCompress] = None,
+               includes: Optional[List[str]] = None,
+               excludes: Optional[List[str]] = None) -> Artifact:
+        """
+        Upload artifact to the executor.
+
+        :param stream: transfer the data as a tar stream over one channel instead of file by file,
+            which is much faster for directories with a lot of small files
+        :param compress: compress the tar stream with gz or zstd, only works in stream mode
+        :param includes: only transfer files match those glob patterns, only works in stream mode
+        :param excludes: skip files match those glob patterns, only works in stream mode
+        """
+        attrs = dict(from_artifact.attrs)
+        if self._upload_cache and not self.is_local:
+            content_hash = hash_path(from_artifact.url)
+            dest_path = self._upload_to_cache(from_artifact.url, to_dir, content_hash, stream=stream,
+                                              compress=compress, includes=includes, excludes=excludes)
+            attrs = {**attrs, 'content_hash': content_hash}
+        elif stream:
+            dest_path = self.connector.upload_archive(from_artifact.url, to_dir, compress=compress,
+                                                      includes=includes, excludes=excludes)
+        else:
+            dest_path = self.connector.upload(from_artifact.url, to_dir)
         return Artifact(
             executor=self.name,
             url=dest_path,
-            attrs=from_artifact.attrs,
+            attrs=attrs,
         ) # type: ignore
 
-    def download(self, from_artifact: Artifact, to_dir: str) -> Artifact:
-        dest_path = self.connector.download(from_artifact.url, to_dir)
+    def _upload_to_cache(self, from_path: str, to_dir: str, content_hash: str, stream: bool, **archive_opts):
+        """
+        Upload data to `<work_dir>/.cas/<content_hash>` if it doesn't exist yet,
+        and link it to the destination.
+        """
+        cas_dir = os.path.join(self.work_dir, '.cas')
+        cas_path = os.path.join(cas_dir, content_hash)
+        # the content hash of a filtered upload is different from the original one
+        if archive_opts.get('includes') or archive_opts.get('excludes'):
+            cas_path += '-' + short_hash(repr(sorted(archive_opts.items())))
+
+        if self.run(f'test -e {shlex.quote(cas_path)}', warn=True, hide=True).return_code:
+            # upload to a staging dir and then move it into place,
+            # so that an interrupted upload won't leave broken data in the store
+            staging_dir = os.path.join(cas_dir, f'.staging-{s_uuid()}')
+            if stream:
+                staging_path = self.connector.upload_archive(from_path, staging_dir, **archive_opts)
+            else:
+                staging_path = self.connector.upload(from_path, staging_dir)
+            # the data may have been uploaded by others in the meantime, any other error must be raised,
+            # or else the link below will be broken
+            self.run(f'{{ [ -e {shlex.quote(cas_path)} ] || mv -T {shlex.quote(staging_path)} {shlex.quote(cas_path)}; }} && '
+                     f'rm -rf {shlex.quote(staging_dir)}')
+            logger.info('upload %s to %s', from_path, cas_path)
+        else:
+            logger.info('hit upload cache of %s: %s', from_path, cas_path)
+
+        to_path = os.path.join(to_dir, safe_basename(from_path))
+        self.run(f'mkdir -p {shlex.quote(to_dir)} && {get_ln_cmd(cas_path, to_path)}')
+        return to_path
+
+    def transfer_from(self, src: Executor, paths: List[str]) -> List[str]:
+        """
+        Copy files or directories from another executor, return their paths on this executor.
+
+        The data is stored in `<work_dir>/.cas/<content_hash>`, the same store used by `upload_cache`,
+        so data that has been transferred before won't be transferred again.
+        All the missing data is sent as one tar stream, which is relayed by the local process,
+        and then linked to `<work_dir>/.artifacts/<src_name>/<src_path>` to keep its name.
+        """
+        assert isinstance(src, HpcExecutor), 'only HpcExecutor is supported'
+        if not paths:
+            return []
+        if src is self or (src.is_local and self.is_local):
+            return list(paths)  # they share the same file system
+
+        with trace_span('executor.transfer_from', 'executor', src=src.name, paths=len(paths)) as span:
+            # hash and test the cache in batch, so it only takes one round trip on each side
+            src_paths, hashes = zip(*src.run_python_fn(hash_paths)(paths))
+            cas_dir = os.path.join(self.work_dir, '.cas')
+            missing = set(self._run_in_batches([
+                f'test -e {shlex.quote(os.path.join(cas_dir, h))} || echo {h}' for h in sorted(set(hashes))
+            ], sep='; ').split())
+            to_send = {h: path for path, h in zip(src_paths, hashes) if h in missing}
+            span['transferred'] = len(to_send)
+            if to_send:
+                self._receive_archive(src, to_send, cas_dir)
+                logger.info('transfer %d paths from %s to %s', len(to_send), src.name, cas_dir)
+
+            dest_paths = [os.path.join(self.work_dir, '.artifacts', src.name, path.lstrip('/'))
+                          for path in src_paths]
+            self._run_in_batches([
+                f'mkdir -p {shlex.quote(os.path.dirname(dest_path))} && '
+                f'{get_ln_cmd(os.path.join(cas_dir, h), dest_path)}'
+                for dest_path, h in zip(dest_paths, hashes)
+            ], sep=' && ')
+        return dest_paths
+
+    def _run_in_batches(self, cmds: List[str], sep: str, max_size: int = 50_000):
+        """
+        Run commands joined by sep in as few calls as possible, return the concatenated stdout.
+        The size of each call is limited, as ssh connection will be closed if the command is too large.
+        """
+        stdout, batch, size = '', [], 0
+        for i, cmd in enumerate(cmds):
+            batch.append(cmd)
+            size += len(cmd) + len(sep)
+            if size >= max_size or i == len(cmds) - 1:
+                stdout += self.run(sep.join(batch), hide=True).stdout
+                batch, size = [], 0
+        return stdout
+
+    def _receive_archive(self, src: 'HpcExecutor', files: Dict[str, str], cas_dir: str):
+        """
+        Pipe a tar stream of the files from the source executor to this one,
+        and move them into the content-addressed store, files is a dict of content hash to source path.
+        """
+        # name the entries by content hash with symlinks, and dereference them when archiving
+        src_staging_dir = os.path.join(src.tmp_dir, f'transfer-{s_uuid()}')
+        src._run_in_batches([
+            f'mkdir -p {shlex.quote(src_staging_dir)}',
+            *(f'ln -s {shlex.quote(path)} {shlex.quote(os.path.join(src_staging_dir, h))}'
+              for h, path in files.items()),
+        ], sep=' && ')
+        src_cmd = f'cd {shlex.quote(src_staging_dir)} && ls -1 | tar -chf - -T -'
+        # extract to a staging dir and then move into place, so an interrupted transfer won't leave broken data
+        staging_dir = os.path.join(cas_dir, f'.staging-{s_uuid()}')
+        dst_cmd = f'mkdir -p {shlex.quote(staging_dir)} && tar -C {shlex.quote(staging_dir)} -xf -'
+
+        src_process = src.connector.popen(src_cmd)
+        try:
+            dst_process = self.connector.popen(dst_cmd)
+            try:
+                shutil.copyfileobj(src_process.stdout, dst_process.stdin, 1 << 20)
+                dst_process.stdin.close()
+                src_code, dst_code = src_process.wait(), dst_process.wait()
+            finally:
+                dst_process.close()
+        finally:
+            src_process.close()
+            src.run(f'rm -rf {shlex.quote(src_staging_dir)}', hide=True)
+
+        if src_code or dst_code:
+            self.run(f'rm -rf {shlex.quote(staging_dir)}', hide=True)
+            raise RuntimeError(f'fail to transfer data from {src.name} to {self.name}, '
+                               f'exit code: {src_code}, {dst_code}')
+        # the data may have been transferred by others in the meantime, any other error must be raised
+        self._run_in_batches([
+            *(f'{{ [ -e {shlex.quote(os.path.join(cas_dir, h))} ] || '
+              f'mv -T {shlex.quote(os.path.join(staging_dir, h))} {shlex.quote(os.path.join(cas_dir, h))}; }}'
+              for h in files),
+            f'rm -rf {shlex.quote(staging_dir)}',
+        ], sep=' && ')
+
+    def download(self, from_artifact: AnyArtifact, to_dir: str, stream: bool = False,
+                 compress: Optional[ArchiveCompress] = None,
+                 includes: Optional[List[str]] = None,
+                 excludes: Optional[List[str]] = None) -> Artifact:
+        """
+        Download artifact from the executor, see `upload` for the meaning of the options.
+        """
+        if stream:
+            dest_path = self.connector.download_archive(from_artifact.url, to_dir, compress=compress,
+                                                        includes=includes, excludes=excludes)
+        else:
+            dest_path = self.connector.download(from_artifact.url, to_dir)
         return Artifact(
             url=dest_path,
-            attrs=from_artifact.attrs,
+            attrs=dict(from_artifact.attrs),
         ) # type: ignore
 
 
@@ -226,13 +571,367 @@ class ExecutorManager:
         return self._executors[name]
 
 
-def fn_to_script(fn: Callable, delimiter='@'):
-    dumped_fn = base64.b64encode(bz2.compress(cloudpickle.dumps(fn, protocol=cloudpickle.DEFAULT_PROTOCOL), 5))
+def fn_to_script(fn: Callable, delimiter='@', codec: PythonCodec = 'bz2',
+                 result_path: Optional[str] = None, result_file_threshold: int = 1 << 20):
+    """
+    Generate a python script to run the function and print its result.
+
+    The result is printed as base64 string after the delimiter,
+    if result_path is set and the size of the result exceeds result_file_threshold,
+    the result will be written to result_path instead, and a marker will be printed.
+    """
+    dumped_fn = base64.b64encode(_compress(codec, cloudpickle.dumps(fn, protocol=cloudpickle.DEFAULT_PROTOCOL)))
+    import_stmt, compress_expr, decompress_expr = _CODEC_SNIPPETS[codec]
     script = [
-        f'''import base64,bz2,sys,cloudpickle as cp''',
-        f'''r=cp.loads(bz2.decompress(base64.b64decode({repr(dumped_fn)})))()''',
-        f'''sys.stdout.flush()''',  # ensure all output is printed
-        f'''print({repr(delimiter)}+base64.b64encode(bz2.compress(cp.dumps(r, protocol=cp.DEFAULT_PROTOCOL),5)).decode('ascii'))''',
+        f'''import base64,sys,cloudpickle as cp''',
+        import_stmt,
+        f'''r=cp.loads({decompress_expr.format('base64.b64decode(' + repr(dumped_fn) + ')')})()''',
         f'''sys.stdout.flush()''',  # ensure all output is printed
+        f'''d={compress_expr.format('cp.dumps(r, protocol=cp.DEFAULT_PROTOCOL)')}''',
     ]
-    return ';'.join(script)
+    if result_path is None:
+        script.append(f'''print({repr(delimiter)}+base64.b64encode(d).decode('ascii'))''')
+    else:
+        script += [
+            f'''if len(d) > {result_file_threshold}:''',
+            f'''    open({repr(result_path)},'wb').write(d)''',
+            f'''    print({repr(delimiter)}+{repr(_RESULT_IN_FILE.decode())})''',
+            f'''else:''',
+            f'''    print({repr(delimiter)}+base64.b64encode(d).decode('ascii'))''',
+        ]
+    script.append(f'''sys.stdout.flush()''')  # ensure all output is printed
+    return '\n'.join(line for line in script if line)
+
+
+def fn_to_iter_script(fn: Callable, codec: PythonCodec = 'bz2'):
+    """
+    Generate a python script to run a generator function and stream its items.
+
+    Each item is written to stdout as a framed record once it is yielded,
+    and the stream is terminated by an end frame or an error frame with the traceback.
+    Other output of the function is redirected to stderr to keep the stream clean.
+    """
+    dumped_fn = base64.b64encode(_compress(codec, cloudpickle.dumps(fn, protocol=cloudpickle.DEFAULT_PROTOCOL)))
+    import_stmt, compress_expr, decompress_expr = _CODEC_SNIPPETS[codec]
+    script = [
+        f'''import base64,os,sys,traceback,cloudpickle as cp''',
+        import_stmt,
+        f'''out=os.fdopen(os.dup(1),'wb')''',
+        f'''os.dup2(2,1)''',
+        f'''try:''',
+        f'''    for r in cp.loads({decompress_expr.format('base64.b64decode(' + repr(dumped_fn) + ')')})():''',
+        f'''        d={compress_expr.format('cp.dumps(r, protocol=cp.DEFAULT_PROTOCOL)')}''',
+        f'''        sys.stdout.flush()''',
+        f'''        out.write({repr(_ITEM_FRAME)}+base64.b64encode(d)+b'\\n')''',
+        f'''        out.flush()''',
+        f'''    out.write({repr(_END_FRAME)}+b'\\n')''',
+        f'''except BaseException:''',
+        f'''    out.write({repr(_ERROR_FRAME)}+base64.b64encode(traceback.format_exc().encode())+b'\\n')''',
+        f'''out.flush()''',
+    ]
+    return '\n'.join(line for line in script if line)
+
+
+def _iter_frames(stdout, codec: PythonCodec, log_path: str):
+    for line in iter(stdout.readline, b''):
+        line = line.strip()
+        if line.startswith(_ITEM_FRAME):
+            yield cloudpickle.loads(_decompress(codec, base64.b64decode(line[1:])))
+        elif line == _END_FRAME:
+            return
+        elif line.startswith(_ERROR_FRAME):
+            raise RuntimeError('remote python function failed:\n' + base64.b64decode(line[1:]).decode())
+    raise RuntimeError(f'remote python process exited unexpectedly, see {log_path} for details')
+
+
+# markers that are not in the alphabet of base64,
+# indicate the result has been written to file
+_RESULT_IN_FILE = b'!'
+# or the frames of a stream of items
+_ITEM_FRAME = b'>'
+_END_FRAME = b'.'
+_ERROR_FRAME = b'?'
+
+# import statement, compress expression and decompress expression of each codec,
+# they are used to generate the remote script
+_CODEC_SNIPPETS = {
+    'bz2': ('import bz2', 'bz2.compress({}, 5)', 'bz2.decompress({})'),
+    'zstd': ('import zstandard', 'zstandard.ZstdCompressor().compress({})', 'zstandard.ZstdDecompressor().decompress({})'),
+    'lz4': ('import lz4.frame', 'lz4.frame.compress({})', 'lz4.frame.decompress({})'),
+    'none': ('', '{}', '{}'),
+}
+
+
+def _compress(codec: PythonCodec, data: bytes) -> bytes:
+    if codec == 'bz2':
+        return bz2.compress(data, 5)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data)
+    if codec == 'none':
+        return data
+    raise ValueError(f'unknown codec: {codec}')
+
+
+def _decompress(codec: PythonCodec, data: bytes) -> bytes:
+    if codec == 'bz2':
+        return bz2.decompress(data)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    if codec == 'none':
+        return data
+    raise ValueError(f'unknown codec: {codec}')
+
+
+class PythonWorker:
+    """
+    A long-lived python process that serves pickled function calls,
+    so that the cost of starting python and importing modules is only paid once.
+
+    The protocol is line based: each request is a base64 encoded pickle of (fn, cwd, result_path, iterate),
+    and each response is a base64 encoded pickle of (ok, result or traceback),
+    or a marker to indicate the response is too large and has been written to result_path.
+    If iterate is set, the items yielded by fn are sent as item frames before the response.
+    The stdout of the worker is reserved for the protocol,
+    all other output of the remote function is redirected to a log file.
+    """
+
+    def __init__(self, connector: BaseConnector, python_cmd: str, cwd: str, tmp_dir: str,
+                 codec: PythonCodec = 'bz2', result_file_threshold: int = 1 << 20):
+        self._connector = connector
+        self._python_cmd = python_cmd
+        self._cwd = cwd
+        self._tmp_dir = tmp_dir
+        self._codec: PythonCodec = codec
+        self._result_file_threshold = result_file_threshold
+        self._log_path = os.path.join(tmp_dir, f'python_worker_{s_uuid()}.log')
+        self._process: Optional[PipeProcess] = None
+        self._lock = Lock()
+        self._streaming_thread: Optional[int] = None
+
+    def start(self):
+        import_stmt, compress_expr, decompress_expr = _CODEC_SNIPPETS[self._codec]
+        script = _PYTHON_WORKER_SCRIPT.format(
+            import_stmt=import_stmt,
+            compress=compress_expr.format('cp.dumps(o, protocol=cp.DEFAULT_PROTOCOL)'),
+            decompress=decompress_expr.format('d'),
+            threshold=self._result_file_threshold,
+            marker=repr(_RESULT_IN_FILE),
+            item_frame=repr(_ITEM_FRAME),
+        )
+        cmd = ' '.join([
+            f'cd {shlex.quote(self._cwd)} &&',
+            f'{self._python_cmd} -u -c {shlex.quote(script)}',
+            f'2>> {shlex.quote(self._log_path)}',
+        ])
+        self._process = self._connector.popen(cmd)
+        logger.info('python worker started, log file: %s', self._log_path)
+
+    def call(self, fn: Callable, cwd: str):
+        result_path = os.path.join(self._tmp_dir, f'python_worker_{s_uuid()}.result')
+        with self._lock, trace_span('python_worker.call', 'executor') as span:
+            span['bytes_out'] = self._send(fn, cwd, result_path, iterate=False)
+            response = self._readline()
+            span['bytes_in'] = len(response)
+        ok, result = _load_python_result(self._connector, response, result_path, self._codec)
+        if not ok:
+            raise RuntimeError(f'remote python function failed:\n{result}')
+        return result
+
+    def iter_call(self, fn: Callable, cwd: str):
+        """
+        Call a generator function and yield its items once they arrive.
+        The worker is occupied until the stream is exhausted,
+        if the stream is closed early the worker will be restarted on next call.
+        """
+        result_path = os.path.join(self._tmp_dir, f'python_worker_{s_uuid()}.result')
+        with self._lock:
+            self._streaming_thread = get_ident()
+            try:
+                self._send(fn, cwd, result_path, iterate=True)
+                completed = False
+                try:
+                    while True:
+                        response = self._readline()
+                        if not response.startswith(_ITEM_FRAME):
+                            break
+                        yield cloudpickle.loads(_decompress(self._codec, base64.b64decode(response[1:])))
+                    completed = True
+                finally:
+                    if not completed:
+                        # the rest of the stream cannot be skipped without reading it
+                        self._abort()
+            finally:
+                self._streaming_thread = None
+        ok, result = _load_python_result(self._connector, response, result_path, self._codec)
+        if not ok:
+            raise RuntimeError(f'remote python function failed:\n{result}')
+
+    def is_streaming(self):
+        """
+        Return True if the current thread is consuming a stream from the worker.
+        """
+        return self._streaming_thread == get_ident()
+
+    def _send(self, fn: Callable, cwd: str, result_path: str, iterate: bool):
+        if self._process is None:
+            self.start()
+        assert self._process is not None
+        dumped = cloudpickle.dumps((fn, cwd, result_path, iterate), protocol=cloudpickle.DEFAULT_PROTOCOL)
+        request = base64.b64encode(_compress(self._codec, dumped))
+        try:
+            self._process.stdin.write(request + b'\n')
+            self._process.stdin.flush()
+        except Exception:
+            self._abort()
+            raise
+        return len(request)
+
+    def _readline(self) -> bytes:
+        assert self._process is not None
+        try:
+            response = self._process.stdout.readline()
+        except Exception:
+            self._abort()
+            raise
+        if not response.strip():
+            self._abort()
+            raise RuntimeError(f'python worker exited unexpectedly, see {self._log_path} for details')
+        return response.strip()
+
+    def close(self):
+        with self._lock:
+            self._abort()
+
+    def _abort(self):
+        if self._process is not None:
+            try:
+                self._process.close()
+            except Exception as e:
+                logger.warning('fail to close python worker: %s', e)
+            self._process = None
+
+
+class PythonWorkerPool:
+    """
+    A pool of python workers, so that the calls from different threads run in parallel.
+    A new worker is started when all the started ones are busy, until there are `size` of them,
+    after that the calls wait for a free worker.
+    """
+
+    def __init__(self, size: int, connector: BaseConnector, python_cmd: str, cwd: str, tmp_dir: str,
+                 codec: PythonCodec = 'bz2', result_file_threshold: int = 1 << 20):
+        self._size = max(size, 1)
+        self._new_worker = lambda: PythonWorker(connector, python_cmd, cwd=cwd, tmp_dir=tmp_dir, codec=codec,
+                                                result_file_threshold=result_file_threshold)
+        self._workers: List[PythonWorker] = []
+        self._idle: List[PythonWorker] = []
+        self._cond = Condition()
+
+    def start(self):
+        """
+        Start the first worker, the others are started on demand.
+        """
+        with self._cond:
+            if not self._workers:
+                worker = self._new_worker()
+                worker.start()
+                self._workers.append(worker)
+                self._idle.append(worker)
+
+    @contextmanager
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and len(self._workers) >= self._size:
+                self._cond.wait()
+            if self._idle:
+                worker = self._idle.pop()
+            else:
+                # the process is started by the first call
+                worker = self._new_worker()
+                self._workers.append(worker)
+        try:
+            yield worker
+        finally:
+            with self._cond:
+                self._idle.append(worker)
+                self._cond.notify()
+
+    def call(self, fn: Callable, cwd: str):
+        with self._acquire() as worker:
+            return worker.call(fn, cwd)
+
+    def iter_call(self, fn: Callable, cwd: str):
+        with self._acquire() as worker:
+            yield from worker.iter_call(fn, cwd)
+
+    def is_streaming(self):
+        """
+        Return True if the current thread is consuming a stream from any worker of the pool.
+        """
+        with self._cond:
+            workers = list(self._workers)
+        return any(worker.is_streaming() for worker in workers)
+
+    def close(self):
+        with self._cond:
+            workers, self._workers, self._idle = self._workers, [], []
+        for worker in workers:
+            worker.close()
+
+
+def _load_python_result(connector: BaseConnector, data: bytes, result_path: str, codec: PythonCodec):
+    if data == _RESULT_IN_FILE:
+        # large result is transferred by file to avoid pushing it through stdout
+        data = connector.load_bytes(result_path)
+        connector.run(f'rm -f {shlex.quote(result_path)}')
+    else:
+        data = base64.b64decode(data)
+    return cloudpickle.loads(_decompress(codec, data))
+
+
+_PYTHON_WORKER_SCRIPT = '''\
+import base64, os, sys, traceback
+import cloudpickle as cp
+{import_stmt}
+dumps = lambda o: {compress}
+loads = lambda d: cp.loads({decompress})
+out = os.fdopen(os.dup(1), 'wb')
+os.dup2(2, 1)  # keep the protocol channel clean
+for line in sys.stdin.buffer:
+    line = line.strip()
+    if not line:
+        continue
+    try:
+        fn, cwd, result_path, iterate = loads(base64.b64decode(line))
+        os.chdir(cwd)
+        if iterate:
+            for item in fn():
+                sys.stdout.flush()
+                out.write({item_frame} + base64.b64encode(dumps(item)) + b'\\n')
+                out.flush()
+            data = dumps((True, None))
+        else:
+            data = dumps((True, fn()))
+    except BaseException:
+        data = dumps((False, traceback.format_exc()))
+    ret = base64.b64encode(data)
+    if len(data) > {threshold}:
+        try:
+            with open(result_path, 'wb') as f:
+                f.write(data)
+            ret = {marker}
+        except Exception:
+            traceback.print_exc()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    out.write(ret + b'\\n')
+    out.flush()
+'''
@@ -1,10 +1,19 @@
-from typing import List, Callable, Optional, Awaitable
+from typing import List, Callable, Optional, Awaitable, Dict, Union, Tuple, TYPE_CHECKING
 from enum import Enum
 from abc import abstractmethod
 import time
 import asyncio
 
 from .future import IFuture
+from .script import BashStep, BashSteps, BashTemplate, BashScript, get_step_states, clear_step_status
+from .util import run_in_thread, list_split_by_cost
+from .pydantic import BaseModel
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from .executor import Executor
+
+logger = get_logger(__name__)
 
 # Copy from parsl
 class JobState(bytes, Enum):
@@ -29,6 +38,10 @@ class JobState(bytes, Enum):
     TIMEOUT = (6, True, "TIMEOUT")
     HELD = (7, False, "HELD")
 
+    def __repr__(self):
+        # the default repr of bytes based enum fails in python 3.11+
+        return f'<JobState.{self.name}>'
+
 class TimeoutError(RuntimeError):
     ...
 
@@ -50,6 +63,12 @@ class JobFuture(IFuture[JobState]):
     def resubmit(self) -> 'JobFuture':
         ...
 
+    async def get_job_state_async(self) -> JobState:
+        return await run_in_thread(self.get_job_state)
+
+    async def resubmit_async(self) -> 'JobFuture':
+        return await run_in_thread(self.resubmit)
+
 async def gather_jobs(jobs: List[JobFuture], timeout = float('inf'), max_tries: int = 1, raise_error=True) -> List[JobState]:
     async def wait_job(job: JobFuture) -> JobState:
         state = JobState.UNKNOWN
@@ -65,7 +84,7 @@ async def gather_jobs(jobs: List[JobFuture], timeout = float('inf'), max_tries:
 
             if tries >= max_tries:
                 break
-            job = job.resubmit()
+            job = await job.resubmit_async()
 
         if raise_error:
             raise RuntimeError(f'Job {job} failed with state {state}')
@@ -73,3 +92,142 @@ async def gather_jobs(jobs: List[JobFuture], timeout = float('inf'), max_tries:
             return state
 
     return await asyncio.gather(*[wait_job(job) for job in jobs])
+
+
+def _get_step_paths(steps: BashSteps):
+    return [(None, None) if isinstance(step, str) else (step.cwd, step.checkpoint) for step in steps]
+
+
+async def submit_step_jobs(executor: 'Executor', step_groups: List[BashSteps],
+                           render: Callable[[BashSteps], str], cwd: str) -> List[JobFuture]:
+    """
+    Submit groups of steps as a job array, the jobs should be waited by `gather_step_jobs`.
+    The status files left by the earlier runs are cleared first, so that they won't be charged to the retry budget.
+
+    :param executor: executor to submit the jobs
+    :param step_groups: steps of each job
+    :param render: function to render steps as a job script
+    :param cwd: working directory of the jobs
+    """
+    step_paths = [path for steps in step_groups for path in _get_step_paths(steps)]
+    await run_in_thread(executor.run_python_fn(clear_step_status), step_paths, base_dir=cwd)
+    return await executor.submit_array_async([render(steps) for steps in step_groups], cwd=cwd)
+
+
+async def gather_step_jobs(executor: 'Executor', jobs: List[JobFuture], step_groups: List[BashSteps],
+                           render: Callable[[BashSteps], str], cwd: str,
+                           timeout = float('inf'), max_tries: int = 1):
+    """
+    Wait for jobs that run groups of steps, and resubmit only the unfinished steps of the failed jobs.
+
+    Unlike `gather_jobs`, which resubmits the whole script, the steps of a failed job are checked by their checkpoint
+    and status files, and only the unfinished ones are packed into a new job.
+    Each step has its own retry budget, a step is given up after it has failed `max_tries` times,
+    the steps that have not been started when the job failed won't consume their budget.
+    The status files of the resubmitted steps are cleared, so each failure is only charged once,
+    submit the jobs with `submit_step_jobs` to clear the ones left by the earlier runs as well.
+
+    The new job is rendered by `render` with the same template as the failed one,
+    so it requests the same resources even if it has fewer steps, the header is not resized,
+    only its run time is shorter as the finished steps are skipped.
+
+    :param executor: executor that submits the jobs
+    :param jobs: jobs to wait for, the steps of jobs[i] are step_groups[i]
+    :param step_groups: steps of each job
+    :param render: function to render steps as a job script
+    :param cwd: working directory of the jobs
+    """
+    failures: Dict[int, int] = {}  # id of step -> times of failure
+    given_up: List[Union[str, BashStep]] = []
+
+    async def wait_job(job: JobFuture, steps: BashSteps):
+        while True:
+            try:
+                state = await job.result_async(timeout)
+            except TimeoutError:
+                state = JobState.TIMEOUT
+            if state is JobState.COMPLETED:
+                return
+
+            step_states = await run_in_thread(executor.run_python_fn(get_step_states), _get_step_paths(steps),
+                                              base_dir=cwd)
+            unfinished = [(step, s) for step, s in zip(steps, step_states) if s != 'done']
+            # if no step is known to be started, e.g. the job failed in setup, all steps are charged
+            started = any(s != 'pending' for _, s in unfinished)
+            retry = []
+            for step, s in unfinished:
+                if s != 'pending' or not started:
+                    failures[id(step)] = failures.get(id(step), 0) + 1
+                if failures.get(id(step), 0) >= max_tries:
+                    given_up.append(step)
+                else:
+                    retry.append(step)
+            if not retry:
+                return
+            logger.info(f'Job {job} is {state.name}, resubmit {len(retry)} of its {len(steps)} steps '
+                        'with the same job header')
+            await run_in_thread(executor.run_python_fn(clear_step_status), _get_step_paths(retry), base_dir=cwd)
+            steps = retry
+            job = await executor.submit_async(render(retry), cwd=cwd)
+
+    await asyncio.gather(*[wait_job(job, steps) for job, steps in zip(jobs, step_groups)])
+    if given_up:
+        cwds = [step if isinstance(step, str) else step.cwd for step in given_up]
+        raise RuntimeError(f'{len(given_up)} steps failed after {max_tries} tries: {cwds}')
+
+
+class StepJobsConfig(BaseModel):
+    concurrency: int = 5
+    pilot: bool = False
+    """
+    Run the tasks with `concurrency` pilot jobs, each of them pulls the next pending task until none remain,
+    instead of splitting the tasks into fixed groups in advance.
+    It helps when the run time of tasks varies a lot.
+    """
+
+
+async def run_bash_steps(executor: 'Executor', steps: List[BashStep], keys: List[Tuple[int, int]], stage: str,
+                         template: Optional[BashTemplate], cwd: str, concurrency: int, pilot: bool = False,
+                         max_tries: int = 2, parallelism: int = 1, cores_per_step: Optional[int] = None):
+    """
+    Run the steps of a stage with `concurrency` jobs and record their runtime.
+
+    The costs of steps are predicted by the runtime of their keys and frozen in cwd,
+    then the steps are either pulled by pilot jobs in the order of cost,
+    or split into groups of balanced cost and submitted as a job array,
+    in which case only the unfinished steps of a failed job are resubmitted.
+
+    :param executor: executor to submit the jobs
+    :param steps: steps to run
+    :param keys: (natoms, nsteps) of each step, used to predict and record its runtime
+    :param stage: name of the stage to record the runtime
+    :param template: bash template of the jobs
+    :param cwd: working directory of the jobs, the costs will be saved here
+    :param concurrency: max number of jobs
+    :param pilot: run the steps with pilot jobs
+    :param max_tries: max tries of each step
+    :param parallelism: max number of steps to run at the same time in one job, ignored by pilot jobs
+    :param cores_per_step: number of cores to pin each running step to
+    """
+    # runtime and pilot import the executor, which depends on this module
+    from .runtime import predict_costs, freeze_costs, record_step_runtimes
+    from .pilot import run_pilot_jobs
+
+    costs = freeze_costs(executor, cwd, predict_costs(stage, keys))
+    if pilot:
+        # run the most costly steps first, so that they won't be left to the end
+        steps_by_cost = [steps[i] for i in sorted(range(len(steps)), key=lambda i: costs[i], reverse=True)]
+        await run_pilot_jobs(executor, steps_by_cost, template=template, cwd=cwd, pilots=concurrency,
+                             max_tries=max_tries)
+    else:
+        def render(steps_group: BashSteps):
+            return BashScript(
+                template=template,
+                steps=steps_group,
+                parallelism=parallelism,
+                cores_per_step=cores_per_step,
+            ).render()
+        steps_groups = [g for g in list_split_by_cost(steps, costs, concurrency) if g]
+        jobs = await submit_step_jobs(executor, steps_groups, render, cwd=cwd)
+        await gather_step_jobs(executor, jobs, steps_groups, render, cwd=cwd, max_tries=max_tries)
+    record_step_runtimes(executor, stage, steps, keys)
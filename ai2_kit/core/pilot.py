@@ -0,0 +1,139 @@
+"""
+Run steps with pilot jobs that pull work from a shared queue.
+
+Instead of splitting the steps into fixed groups, a few pilot jobs are submitted,
+each of them claims the next pending step from a queue directory on the cluster,
+runs it and then moves on to the next one until none remain.
+A step is claimed by creating the directory `<queue_dir>/<i>.claim`, which is atomic even on shared file systems,
+so that the long running steps won't leave other jobs idle.
+
+The queue directory records the result of each step:
+
+* `<i>.claim`: the step has been claimed by a pilot job
+* `<i>.done`: the step has been finished successfully
+* `<i>.failed`: the step has been failed
+
+The queue directory is kept in the working directory of the pilots, so it is found again when the stage is restarted.
+As `<i>` is the index of the step, the queue is reset if the list of steps is changed.
+The per-step checkpoints of `BashStep` are still honored, so a step that has been finished won't run again.
+"""
+
+from typing import List, Optional
+import shlex
+import os
+
+from .executor import Executor
+from .job import gather_jobs
+from .script import BashStep, BashSteps, BashTemplate, render_bash_steps
+from .util import short_hash
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+
+def render_pilot_script(template: Optional[BashTemplate], steps: BashSteps, queue_dir: str,
+                        pilot_id: int = 0, tag: str = ''):
+    """
+    Render a script that claims and runs the steps in the queue directory one by one.
+    The pilot exits with non-zero code if any step it runs is failed, after all steps are claimed.
+
+    :param template: bash template of the pilot job
+    :param steps: all the steps in the queue, each step runs in a sub shell
+    :param queue_dir: directory to store the state of steps, must be on a file system shared by all pilots
+    :param pilot_id: id of the pilot, pilots with different id will be rendered as different scripts
+    :param tag: extra tag to distinguish the pilots of different rounds
+    """
+    queue = shlex.quote(queue_dir)
+    cases = []
+    for i, step in enumerate(steps):
+        cases.append('\n'.join([
+            f'{i}) (',
+            render_bash_steps([step]),
+            ') ;;',
+        ]))
+
+    rendered_queue = '\n'.join([
+        f'# pilot {pilot_id} {tag}'.rstrip(),
+        f'__PILOT_QUEUE__={queue}',
+        '__PILOT_FAILED__=0',
+        'mkdir -p "$__PILOT_QUEUE__"',
+        f'for __PILOT_STEP__ in $(seq 0 {len(steps) - 1}); do',
+        '[ -e "$__PILOT_QUEUE__/$__PILOT_STEP__.done" ] && continue',
+        '# claim the step, mkdir is atomic so only one pilot will get it',
+        'mkdir "$__PILOT_QUEUE__/$__PILOT_STEP__.claim" 2>/dev/null || continue',
+        'case $__PILOT_STEP__ in',
+        '\n'.join(cases),
+        'esac',
+        '__EXITCODE__=$?',
+        'if [ $__EXITCODE__ -eq 0 ]; then',
+        '  touch "$__PILOT_QUEUE__/$__PILOT_STEP__.done"',
+        'else',
+        '  echo "step $__PILOT_STEP__ failed with exit code $__EXITCODE__" >&2',
+        '  touch "$__PILOT_QUEUE__/$__PILOT_STEP__.failed"',
+        '  __PILOT_FAILED__=1',
+        'fi',
+        'done',
+    ])
+
+    if template is None:
+        rendered = rendered_queue
+    else:
+        rendered = '\n'.join([
+            template.shebang,
+            template.header,
+            template.setup,
+            rendered_queue,
+            template.teardown,
+        ])
+    # don't use `exit 0` here or else the success indicator appended by queue system won't be created
+    return '\n'.join([
+        rendered,
+        'if [ $__PILOT_FAILED__ -ne 0 ]; then exit 1; fi',
+    ])
+
+
+async def run_pilot_jobs(executor: Executor, steps: List[BashStep], template: Optional[BashTemplate],
+                         cwd: str, pilots: int, max_tries: int = 2):
+    """
+    Run the steps with pilot jobs and wait for all of them to be finished.
+
+    After the pilots of a round exit, the queue directory is checked,
+    the claims of failed steps and of steps whose pilot has been killed are released,
+    and a new round of pilots is submitted for the remaining steps until `max_tries` is reached.
+
+    :param executor: executor to submit the pilot jobs
+    :param steps: steps to run
+    :param template: bash template of the pilot jobs
+    :param cwd: working directory of the pilot jobs, the queue directory will be created here,
+        so it should be the dedicated working directory of the stage
+    :param pilots: max number of pilot jobs
+    :param max_tries: max rounds of pilot jobs
+    """
+    if not steps:
+        return
+    queue_dir = os.path.join(cwd, 'pilot-queue')
+    steps_hash = short_hash(render_bash_steps(steps))
+    # the finished steps are still skipped by their checkpoints after the queue is reset
+    executor.run(f'mkdir -p {shlex.quote(queue_dir)} && cd {shlex.quote(queue_dir)} && '
+                 f'{{ [ "$(cat .steps 2>/dev/null)" = {shlex.quote(steps_hash)} ] || '
+                 f'{{ find . -mindepth 1 -delete && printf %s {shlex.quote(steps_hash)} > .steps; }}; }}', hide=True)
+    pending = list(range(len(steps)))
+
+    for n in range(max_tries):
+        # the tag ensures the pilots of each round are submitted as new jobs
+        scripts = [render_pilot_script(template, steps, queue_dir, pilot_id=i, tag=f'round {n}')
+                   for i in range(min(pilots, len(pending)))]
+        jobs = await executor.submit_array_async(scripts, cwd=cwd)
+        await gather_jobs(jobs, raise_error=False)
+
+        result = executor.run(f'mkdir -p {shlex.quote(queue_dir)} && ls -1 {shlex.quote(queue_dir)}', hide=True)
+        done = {name[:-len('.done')] for name in result.stdout.split() if name.endswith('.done')}
+        pending = [i for i in range(len(steps)) if str(i) not in done]
+        if not pending:
+            return
+        logger.info('%d of %d steps are not finished after round %d of pilots', len(pending), len(steps), n)
+        # all pilots of this round have exited, so the remaining claims are failed or stale
+        stale = ' '.join(f'{i}.claim {i}.failed' for i in pending)
+        executor.run(f'cd {shlex.quote(queue_dir)} && rm -rf {stale}', hide=True)
+
+    raise RuntimeError(f'{len(pending)} steps failed after {max_tries} rounds of pilot jobs, check {queue_dir} for details')
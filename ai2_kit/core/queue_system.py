@@ -1,6 +1,12 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, List, NamedTuple, Tuple, Callable, Set
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from threading import Lock, Thread
+import weakref
+import itertools
+import fnmatch
+import bisect
+import subprocess
+import signal
 import invoke
 import shlex
 import os
@@ -12,9 +18,10 @@ import json
 
 from .connector import BaseConnector
 from .log import get_logger
-from .job import JobFuture, JobState
+from .job import JobFuture, JobState, TimeoutError
 from .checkpoint import apply_checkpoint, del_checkpoint
-from .util import short_hash
+from .util import short_hash, run_in_thread
+from .trace import traced, trace_span, add_async_span, get_stage
 from .pydantic import BaseModel
 
 logger = get_logger(__name__)
@@ -25,27 +32,215 @@ class QueueSystemConfig(BaseModel):
         sbatch_bin: str = 'sbatch'
         squeue_bin: str = 'squeue'
         scancel_bin: str = 'scancel'
+        sacct_bin: str = 'sacct'
         polling_interval: int = 10
+        job_array: bool = False
+        """
+        Submit a group of scripts as a job array with a single `sbatch --array`.
+        """
 
     class LSF(BaseModel):
         bsub_bin: str = 'bsub'
         bjobs_bin: str = 'bjobs'
+        bkill_bin: str = 'bkill'
         polling_interval: int = 10
 
     class PBS(BaseModel):
         qsub_bin: str = 'qsub'
         qstat_bin: str = 'qstat'
         qdel_bin: str = 'qdel'
+        job_array: bool = False
+        """
+        Submit a group of scripts as a job array with a single `qsub -J`.
+        """
+
+    class Local(BaseModel):
+        slots: Optional[int] = None
+        """
+        Total number of cores that can be used by jobs, default to the number of cpu cores.
+        """
+        cores_per_job: int = 1
+        """
+        Number of cores reserved by each job,
+        it can be overridden by adding a `#LOCAL -c <cores>` line to the job script.
+        """
+        polling_interval: int = 2
+
+    class JobLimit(BaseModel):
+        max_jobs: Optional[int] = None
+        """
+        Max number of jobs that are submitted but not finished, including the queued and running ones.
+        Each element of a job array is counted as a job.
+        """
+        max_queued: Optional[int] = None
+        """
+        Max number of jobs that are waiting in the queue.
+        """
+        max_cores: Optional[int] = None
+        """
+        Max number of cores requested by the unfinished jobs, the cores of a job are parsed from its script header.
+        """
+        priorities: Dict[str, int] = dict()
+        """
+        Priority of workflow stages, the key is a glob pattern of stage name, e.g. `*/label-*`, default is 0.
+        When a limit is reached, the waiting submissions of the stage with higher priority are submitted first.
+        """
+        check_interval: float = 1
+        """
+        Interval in seconds to check whether a waiting submission can be submitted.
+        """
 
     slurm: Optional[Slurm]
     lsf: Optional[LSF]
     pbs: Optional[PBS]
+    local: Optional[Local]
+    job_limit: Optional[JobLimit] = None
+    """
+    Limit the jobs submitted by all the stages of workflow, the excess submissions wait locally.
+    """
+
+
+class JobStats(NamedTuple):
+    """
+    Accounting data of a finished job reported by the queue system.
+    """
+    state: JobState
+    elapsed: Optional[float]  # in seconds
+    exit_code: Optional[str]
+
+
+class _PreparedScript(NamedTuple):
+    name: str
+    script: str
+    success_indicator: str
+    running_indicator: str
+
+
+class _Poller:
+    """
+    State of the poller task of a queue system in an event loop.
+    """
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        # it will be set and replaced after each refresh to wake up the waiting futures
+        self.refreshed = asyncio.Event()
+
+
+class JobLimiter:
+    """
+    Limit the number of jobs and cores of a queue system, shared by all the stages that submit jobs to it.
+
+    A submission reserves its jobs before submitting, and waits locally if any limit is reached.
+    The jobs are released when their final states are known.
+    Waiting submissions are served by the priority of their stages, and then in order of arrival.
+    """
+
+    def __init__(self, config: QueueSystemConfig.JobLimit):
+        self.config = config
+        self._lock = Lock()
+        self._jobs: Dict[str, int] = dict()  # job id -> cores
+        self._reserved_jobs = 0
+        self._reserved_cores = 0
+        self._waiters: List[Tuple[int, int]] = []  # sorted list of (-priority, sequence)
+        self._sequence = itertools.count()
+
+    def get_priority(self, stage: str):
+        priorities = [v for k, v in self.config.priorities.items() if fnmatch.fnmatch(stage, k)]
+        return max(priorities, default=0)
+
+    async def acquire(self, cores: List[int], get_states: Callable[[], Dict[str, JobState]]) -> int:
+        """
+        Wait until some of the jobs can be submitted and reserve them.
+        Return the number of the leading jobs that are reserved,
+        the rest of them should be acquired again after the reserved ones are submitted.
+
+        :param cores: cores of each job to submit
+        :param get_states: function to get the last known states of jobs without remote calls,
+            it is used to count the queued jobs
+        """
+        waiter = (-self.get_priority(get_stage()), next(self._sequence))
+        with self._lock:
+            bisect.insort(self._waiters, waiter)
+        try:
+            logged = False
+            while True:
+                with self._lock:
+                    n = self._get_room(cores, get_states()) if self._waiters[0] == waiter else 0
+                    if n > 0:
+                        self._waiters.pop(0)
+                        self._reserved_jobs += n
+                        self._reserved_cores += sum(cores[:n])
+                        return n
+                if not logged:
+                    logger.info(f'Job limit is reached, {len(cores)} jobs are waiting to be submitted')
+                    logged = True
+                await asyncio.sleep(self.config.check_interval)
+        finally:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def bind(self, cores: List[int], job_ids: List[Optional[str]]):
+        """
+        Turn the reserved jobs into submitted jobs, job id is None if the submission is failed.
+        """
+        with self._lock:
+            self._reserved_jobs -= len(cores)
+            self._reserved_cores -= sum(cores)
+            for c, job_id in zip(cores, job_ids):
+                if job_id is not None:
+                    self._jobs[job_id] = c
+
+    def release(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _get_room(self, cores: List[int], states: Dict[str, JobState]) -> int:
+        """
+        Get the number of the leading jobs that can be reserved without exceeding the limits.
+        """
+        n_jobs = len(self._jobs) + self._reserved_jobs
+        n_cores = sum(self._jobs.values()) + self._reserved_cores
+        n_queued = 0
+        if self.config.max_queued is not None:
+            # the jobs whose states are not known yet are treated as queued
+            n_queued = self._reserved_jobs + sum(states.get(job_id) is not JobState.RUNNING for job_id in self._jobs)
+        room = 0
+        for c in cores:
+            if self.config.max_jobs is not None and n_jobs + room + 1 > self.config.max_jobs:
+                break
+            if self.config.max_cores is not None and n_cores + c > self.config.max_cores:
+                break
+            if self.config.max_queued is not None and n_queued + room + 1 > self.config.max_queued:
+                break
+            room += 1
+            n_cores += c
+        # a single job that exceeds the limits on its own is allowed if nothing is running,
+        # or else it will never be submitted
+        if room == 0 and n_jobs == 0:
+            room = 1
+        return room
 
 
 class BaseQueueSystem(ABC):
 
     connector: BaseConnector
 
+    def __init__(self):
+        # guard the cache of job states, as states may be queried from multiple threads
+        self._states_lock = Lock()
+        self._last_states: Dict[str, JobState] = dict()
+        self._last_update_at: float = 0
+        # jobs that are waited by futures, and the final states of jobs,
+        # guarded by a different lock, so it won't be blocked by the slow refresh
+        self._jobs_lock = Lock()
+        self._tracked_jobs: Dict[str, str] = dict()  # job id -> success indicator path
+        self._final_states: Dict[str, JobState] = dict()
+        self._job_stats: Dict[str, JobStats] = dict()
+        self._pollers: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _Poller]' = weakref.WeakKeyDictionary()
+        self.job_limiter: Optional[JobLimiter] = None
+        self._watchers: Set[asyncio.Future] = set()
+
     def get_polling_interval(self) -> int:
         return 10
 
@@ -68,28 +263,237 @@ class BaseQueueSystem(ABC):
     def get_job_id_envvar(self) -> str:
         ...
 
-    @abstractmethod
     def get_job_state(self, job_id: str, success_indicator_path: str) -> JobState:
-        ...
+        with self._jobs_lock:
+            state = self._final_states.get(job_id)
+        if state is None:
+            state = self._poll_job_states({job_id: success_indicator_path})[job_id]
+            self._set_final_states({job_id: state})
+        return state
 
     @abstractmethod
     def cancel(self, job_id: str):
         ...
 
+    async def get_job_state_async(self, job_id: str, success_indicator_path: str) -> JobState:
+        return await run_in_thread(self.get_job_state, job_id, success_indicator_path)
+
+    async def wait_job_async(self, job_id: str, success_indicator_path: str,
+                             timeout: float = float('inf')) -> JobState:
+        """
+        Wait until the job reaches a terminal state.
+
+        All the waiting jobs are polled by a single poller task in the event loop,
+        which refreshes their states in bulk once per polling interval,
+        so the number of remote calls doesn't grow with the number of jobs.
+        """
+        with self._jobs_lock:
+            state = self._final_states.get(job_id)
+            if state is None:
+                self._tracked_jobs[job_id] = success_indicator_path
+        if state is not None:
+            return state
+
+        poller = self._get_poller()
+        timeout_ts = time.time() + timeout
+        while True:
+            refreshed = poller.refreshed
+            with self._jobs_lock:
+                state = self._final_states.get(job_id)
+            if state is not None:
+                return state
+            remaining = timeout_ts - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f'Timeout of polling job: {job_id}')
+            try:
+                await asyncio.wait_for(refreshed.wait(), None if remaining == float('inf') else remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def _get_poller(self):
+        # a poller is bound to an event loop, start a new one if it is not running in the current loop
+        loop = asyncio.get_running_loop()
+        poller = self._pollers.get(loop)
+        if poller is None:
+            poller = self._pollers[loop] = _Poller()
+        if poller.task is None:
+            poller.task = loop.create_task(self._run_poller(poller))
+        return poller
+
+    async def _run_poller(self, poller: _Poller):
+        try:
+            while True:
+                with self._jobs_lock:
+                    jobs = dict(self._tracked_jobs)
+                if not jobs:
+                    break
+                try:
+                    states = await run_in_thread(self._poll_job_states, jobs)
+                    self._set_final_states(states)
+                except Exception as e:
+                    logger.warning(f'Error when polling job states: {e}')
+                refreshed, poller.refreshed = poller.refreshed, asyncio.Event()
+                refreshed.set()
+                await asyncio.sleep(self.get_polling_interval())
+        finally:
+            poller.task = None
+
+    def _set_final_states(self, states: Dict[str, JobState]):
+        with self._jobs_lock:
+            for job_id, state in states.items():
+                if state.terminal:
+                    self._final_states[job_id] = state
+                    self._tracked_jobs.pop(job_id, None)
+
+    def _poll_job_states(self, jobs: Dict[str, str]) -> Dict[str, JobState]:
+        """
+        Get the states of jobs in bulk.
+
+        :param jobs: job id -> success indicator path
+        """
+        all_states = self._get_all_states()
+        states, vanished = dict(), dict()
+        for job_id, success_indicator_path in jobs.items():
+            state = all_states.get(job_id)
+            if state is None:
+                vanished[job_id] = success_indicator_path
+            else:
+                states[job_id] = state
+        if vanished:
+            states.update(self._resolve_vanished_jobs(vanished))
+        return states
+
+    def get_job_stats(self, job_id: str) -> Optional[JobStats]:
+        with self._jobs_lock:
+            return self._job_stats.get(job_id)
+
+    def _get_history_cmd(self, job_ids: List[str]) -> str:
+        """
+        Command to query the accounting data of finished jobs, empty if it is not supported.
+        """
+        return ''
+
+    def _parse_history(self, output: str) -> Dict[str, JobStats]:
+        return dict()
+
+    def _resolve_vanished_jobs(self, jobs: Dict[str, str]) -> Dict[str, JobState]:
+        """
+        Decide the final states of jobs that are not listed by the queue system any more.
+
+        The success indicators and the accounting data of all the jobs are queried in one command.
+        The job is completed if its success indicator exists,
+        otherwise the state reported by the accounting data is used to tell failure from timeout or cancellation.
+        """
+        job_ids = list(jobs.keys())
+        states = dict()
+        # split into chunks to keep the command short
+        for i in range(0, len(job_ids), 500):
+            chunk = job_ids[i:i + 500]
+            files = ' '.join(shlex.quote(jobs[job_id]) for job_id in chunk)
+            cmd = f'for f in {files}; do if [ -f "$f" ]; then echo 1; else echo 0; fi; done'
+            history_cmd = self._get_history_cmd(chunk)
+            if history_cmd:
+                cmd += f'; echo {_HISTORY_DELIMITER}; {history_cmd} 2>/dev/null || true'
+            flags_output, _, history_output = self.connector.run(cmd, hide=True).stdout.partition(_HISTORY_DELIMITER)
+            try:
+                history = self._parse_history(history_output) if history_cmd else dict()
+            except Exception as e:
+                logger.warning(f'Fail to parse the history of jobs: {e}')
+                history = dict()
+
+            for job_id, flag in zip(chunk, flags_output.split()):
+                stats = history.get(job_id)
+                if flag == '1':
+                    state = JobState.COMPLETED
+                elif stats is not None and stats.state is not JobState.COMPLETED:
+                    # it may also be a non-terminal state if the job is requeued
+                    state = stats.state
+                else:
+                    state = JobState.FAILED
+                states[job_id] = state
+                if stats is not None:
+                    with self._jobs_lock:
+                        self._job_stats[job_id] = stats._replace(state=state)
+        return states
+
+    def _get_all_states(self) -> Dict[str, JobState]:
+        with self._states_lock:
+            return self._update_all_states()
+
+    def _update_all_states(self) -> Dict[str, JobState]:
+        """
+        Query the states of all the jobs of current user, the result should be cached for a polling interval.
+        """
+        raise NotImplementedError
+
+    async def submit_async(self, script: str, cwd: str, **kwargs) -> 'QueueJobFuture':
+        jobs = await self._submit_with_limit([script], lambda scripts: [self.submit(scripts[0], cwd=cwd, **kwargs)])
+        return jobs[0]
+
+    async def submit_array_async(self, scripts: List[str], cwd: str) -> List['QueueJobFuture']:
+        return await self._submit_with_limit(scripts, lambda chunk: self.submit_array(chunk, cwd=cwd))
+
+    async def _submit_with_limit(self, scripts: List[str], submit: Callable[[List[str]], List['QueueJobFuture']]):
+        """
+        Submit jobs in a thread, wait for the job limiter if there is one.
+        The scripts are split into chunks that fit the limits, each chunk is submitted as soon as there is room for it.
+        Note that the blocking `submit` and `submit_array` bypass the limiter.
+        """
+        if self.job_limiter is None:
+            return await run_in_thread(submit, scripts)
+        cores = [self.get_job_cores(script) for script in scripts]
+        jobs: List[QueueJobFuture] = []
+        while len(jobs) < len(scripts):
+            start = len(jobs)
+            n = await self.job_limiter.acquire(cores[start:], self._get_cached_states)
+            chunk_jobs: List[QueueJobFuture] = []
+            try:
+                chunk_jobs = await run_in_thread(submit, scripts[start:start + n])
+            finally:
+                self.job_limiter.bind(cores[start:start + n], [job._job_id for job in chunk_jobs] or [None] * n)
+            # watch the jobs in background, so that they are released as soon as they are finished,
+            # even if the caller waits for other submissions before waiting for them
+            for job in chunk_jobs:
+                task = asyncio.ensure_future(job.result_async())
+                self._watchers.add(task)
+                task.add_done_callback(self._watchers.discard)
+            jobs += chunk_jobs
+        return jobs
+
+    def get_job_cores(self, script: str) -> int:
+        """
+        Get the number of cores requested by the job script, it is used to limit the cores of submitted jobs.
+        """
+        return 1
+
+    def _get_cached_states(self) -> Dict[str, JobState]:
+        return self._last_states
+
+    def _on_job_finished(self, job_id: str):
+        if self.job_limiter is not None:
+            self.job_limiter.release(job_id)
+
+    def is_job_array_enabled(self) -> bool:
+        return False
+
+    def get_array_option(self, size: int) -> str:
+        raise NotImplementedError
+
+    def get_array_index_envvar(self) -> str:
+        raise NotImplementedError
+
+    def get_array_element_id(self, array_job_id: str, index: int) -> str:
+        raise NotImplementedError
+
     def _post_submit(self, job: 'QueueJobFuture'):
         ...
 
-    def submit(self,
-               script: str,
-               cwd: str,
-               name: Optional[str] = None,
-               success_indicator: Optional[str] = None,
-               ):
-
+    def _prepare_script(self, script: str,
+                        name: Optional[str] = None,
+                        success_indicator: Optional[str] = None):
         # use hash instead of uuid to ensure idempotence
         if name is None:
             name = 'job-' + short_hash(script) + self.get_script_suffix()
-        quoted_cwd = shlex.quote(cwd)
 
         # a placeholder file that will be created when the script end without error
         if success_indicator is None:
@@ -109,47 +513,142 @@ class BaseQueueSystem(ABC):
             f'echo ${self.get_job_id_envvar()} > {shlex.quote(success_indicator)}',
             '',
         ])
+        return _PreparedScript(name, script, success_indicator, running_indicator)
 
-        script_path = os.path.join(cwd, name)
-        self.connector.run(f'mkdir -p {quoted_cwd}')
-        self.connector.dump_text(script, script_path)
+    @traced('queue_system.submit', 'queue')
+    def submit(self,
+               script: str,
+               cwd: str,
+               name: Optional[str] = None,
+               success_indicator: Optional[str] = None,
+               ):
 
-        # submit script
-        cmd = f"cd {quoted_cwd} && {self.get_submit_cmd()} {shlex.quote(name)}"
+        element = self._prepare_script(script, name, success_indicator)
+        self.connector.run(f'mkdir -p {shlex.quote(cwd)}')
+        job_id = self._recover_jobs([element], cwd)[0]
+        if job_id is None:
+            job_id = self._submit_element(element, cwd)
+        job = self._new_job_future(job_id, element, cwd)
+        self._post_submit(job)
+        return job
 
-        # apply checkpoint
-        submit_cmd_fn = self._submit_cmd
+    def _submit_element(self, element: _PreparedScript, cwd: str) -> str:
+        script_path = os.path.join(cwd, element.name)
+        self.connector.dump_text(element.script, script_path)
+
+        logger.info(f'Submit batch script: {script_path}')
+        cmd = f"cd {shlex.quote(cwd)} && {self.get_submit_cmd()} {shlex.quote(element.name)}"
+        with trace_span('queue_system.submit_script', 'queue', script_len=len(element.script)) as span:
+            job_id = self._submit_script(cmd, script_path, element.script)
+            span['job_id'] = job_id
+        # create running indicator
+        self.connector.dump_text(str(job_id), os.path.join(cwd, element.running_indicator))
+        return job_id
+
+    def _recover_jobs(self, elements: List[_PreparedScript], cwd: str) -> List[Optional[str]]:
+        """
+        Recover the ids of the jobs submitted before, e.g. by the previous run of the workflow,
+        None is returned for the element that should be submitted again.
+
+        The running indicators of all the elements are read in one command,
+        and the states of the recovered jobs are polled in bulk.
+        """
+        # one line for each element
+        files = ' '.join(shlex.quote(e.running_indicator) for e in elements)
+        recover_cmd = f'cd {shlex.quote(cwd)} && for f in {files}; do echo "$(cat "$f" 2>/dev/null)"; done'
+        job_ids: List[Optional[str]] = [job_id.strip() or None for job_id in
+                                        self.connector.run(recover_cmd, hide=True).stdout.splitlines()]
+        job_ids += [None] * (len(elements) - len(job_ids))
+
+        jobs = {job_id: os.path.join(cwd, e.success_indicator) for e, job_id in zip(elements, job_ids) if job_id}
+        with self._jobs_lock:
+            states = {job_id: self._final_states[job_id] for job_id in jobs if job_id in self._final_states}
+        if len(states) < len(jobs):
+            try:
+                polled = self._poll_job_states({k: v for k, v in jobs.items() if k not in states})
+                self._set_final_states(polled)
+                states.update(polled)
+            except Exception as e:
+                logger.warning(f'Fail to recover the states of {len(jobs)} jobs, submit them again: {e}')
+
+        for i, (element, job_id) in enumerate(zip(elements, job_ids)):
+            if job_id is None:
+                continue
+            job_state = states.get(job_id)
+            if job_state in (JobState.PENDING, JobState.RUNNING, JobState.COMPLETED):
+                logger.info(f"{element.name} has been submmited ({job_id}) and in {str(job_state)} state, continue!")
+            else:
+                job_ids[i] = None
+        return job_ids
+
+    @traced('queue_system.submit_array', 'queue')
+    def submit_array(self, scripts: List[str], cwd: str) -> List['QueueJobFuture']:
+        """
+        Submit a group of scripts as a job array,
+        which takes a few round trips no matter how many scripts there are.
+        Each element of the array is tracked by its own future and can be resubmitted individually.
+
+        Scripts are submitted one by one if job array is not supported or not enabled.
+        The header of the first script is used as the header of the array job.
+        The jobs submitted before are recovered in bulk in both cases.
+        """
+        if not scripts:
+            return []
+        quoted_cwd = shlex.quote(cwd)
+        elements = [self._prepare_script(script) for script in scripts]
+        self.connector.run(f'mkdir -p {quoted_cwd}')
+        job_ids = self._recover_jobs(elements, cwd)
+        pending = [i for i, job_id in enumerate(job_ids) if job_id is None]
 
-        # recover running job id
-        # TODO: refactor the following code as function
-        job_id, job_state  = None, JobState.UNKNOWN
-        recover_cmd = f"cd {quoted_cwd} && cat {shlex.quote(running_indicator)}"
-        try:
-            job_id = self.connector.run(recover_cmd, hide=True).stdout.strip()
-            if job_id:
-                success_indicator_path = os.path.join(cwd, success_indicator)
-                job_state = self.get_job_state(job_id, success_indicator_path=success_indicator_path)
-        except:
-            pass
-
-        if job_id and job_state in (JobState.PENDING, JobState.RUNNING, JobState.COMPLETED):
-            logger.info(f"{script_path} has been submmited ({job_id}) and in {str(job_state)} state, continue!")
+        if len(pending) < 2 or not self.is_job_array_enabled():
+            for i in pending:
+                job_ids[i] = self._submit_element(elements[i], cwd)
         else:
-            logger.info(f'Submit batch script: {script_path}')
-            job_id = submit_cmd_fn(cmd)
-            # create running indicator
-            self.connector.dump_text(str(job_id), os.path.join(cwd, running_indicator))
-
-        job = QueueJobFuture(self,
-                             job_id=job_id,
-                             name=name,
-                             script=script,
-                             cwd=cwd,
-                             success_indicator=success_indicator,
-                             polling_interval=self.get_polling_interval() // 2,
-                             )
-        self._post_submit(job)
-        return job
+            array_job_id = self._submit_array(cwd, [elements[i] for i in pending])
+            for k, i in enumerate(pending):
+                job_ids[i] = self.get_array_element_id(array_job_id, k)
+            # create running indicators in one command
+            self.connector.run(f'cd {quoted_cwd} && ' + ' && '.join(
+                f'echo {shlex.quote(job_ids[i])} > {shlex.quote(elements[i].running_indicator)}'  # type: ignore
+                for i in pending))
+        jobs = [self._new_job_future(job_id, element, cwd) for job_id, element in zip(job_ids, elements)]
+        if pending:
+            self._post_submit(jobs[pending[-1]])
+        return jobs
+
+    def _submit_array(self, cwd: str, elements: List[_PreparedScript]) -> str:
+        # the array script dispatches to the script of each element by the array index
+        header, _ = split_script_header(elements[0].script)
+        index_var = self.get_array_index_envvar()
+        lines = [header, self.get_setup_script(), f'case ${index_var} in']
+        for k, element in enumerate(elements):
+            lines += [f'{k})', element.script, ';;']
+        lines += [f'*) echo "unknown array index: ${index_var}"; exit 1 ;;', 'esac', '']
+        script = '\n'.join(lines)
+
+        name = 'array-' + short_hash(script) + self.get_script_suffix()
+        script_path = os.path.join(cwd, name)
+        self.connector.dump_text(script, script_path)
+
+        logger.info(f'Submit array script of {len(elements)} jobs: {script_path}')
+        cmd = f"cd {shlex.quote(cwd)} && {self.get_submit_cmd()} {self.get_array_option(len(elements))} {shlex.quote(name)}"
+        with trace_span('queue_system.submit_script', 'queue', script_len=len(script)) as span:
+            job_id = self._submit_script(cmd, script_path, script)
+            span['job_id'] = job_id
+        return job_id
+
+    def _new_job_future(self, job_id: str, element: _PreparedScript, cwd: str):
+        return QueueJobFuture(self,
+                              job_id=job_id,
+                              name=element.name,
+                              script=element.script,
+                              cwd=cwd,
+                              success_indicator=element.success_indicator,
+                              polling_interval=self.get_polling_interval() // 2,
+                              )
+
+    def _submit_script(self, cmd: str, script_path: str, script: str) -> str:
+        return self._submit_cmd(cmd)
 
     def _submit_cmd(self, cmd: str):
         result = self.connector.run(cmd)
@@ -162,9 +661,6 @@ class BaseQueueSystem(ABC):
 class Slurm(BaseQueueSystem):
     config: QueueSystemConfig.Slurm
 
-    _last_states = defaultdict(lambda: JobState.UNKNOWN)
-    _last_update_at: float = 0
-
     translate_table = {
         'PD': JobState.PENDING,
         'R': JobState.RUNNING,
@@ -195,17 +691,28 @@ class Slurm(BaseQueueSystem):
     def get_job_id_envvar(self) -> str:
         return 'SLURM_JOB_ID'
 
-    def get_job_state(self, job_id: str, success_indicator_path: str) -> JobState:
-        state = self._get_all_states().get(job_id)
-        if state is None:
-            cmd = 'test -f {}'.format(shlex.quote(success_indicator_path))
-            ret = self.connector.run(cmd, warn=True)
-            if ret.return_code:
-                return JobState.FAILED
-            else:
-                return JobState.COMPLETED
-        else:
-            return state
+    def get_job_cores(self, script: str) -> int:
+        args = get_script_directives(script, '#SBATCH')
+        nodes = _to_int(get_directive_option(args, '-N', '--nodes'))
+        ntasks = _to_int(get_directive_option(args, '-n', '--ntasks'))
+        ntasks_per_node = _to_int(get_directive_option(args, None, '--ntasks-per-node'))
+        cpus_per_task = _to_int(get_directive_option(args, '-c', '--cpus-per-task'))
+        if ntasks is None:
+            ntasks = (nodes or 1) * (ntasks_per_node or 1)
+        return ntasks * (cpus_per_task or 1)
+
+    def is_job_array_enabled(self) -> bool:
+        return self.config.job_array
+
+    def get_array_option(self, size: int) -> str:
+        return f'--array=0-{size - 1}'
+
+    def get_array_index_envvar(self) -> str:
+        return 'SLURM_ARRAY_TASK_ID'
+
+    def get_array_element_id(self, array_job_id: str, index: int) -> str:
+        # example: 123_4
+        return f'{array_job_id}_{index}'
 
     def cancel(self, job_id: str):
         cmd = f'{self.config.scancel_bin} {job_id}'
@@ -217,7 +724,40 @@ class Slurm(BaseQueueSystem):
     def _translate_state(self, slurm_state: str) -> JobState:
         return self.translate_table.get(slurm_state, JobState.UNKNOWN)
 
-    def _get_all_states(self) -> Dict[str, JobState]:
+    # states of sacct, the ones that are not listed are treated as FAILED
+    sacct_translate_table = {
+        'PENDING': JobState.PENDING,
+        'RUNNING': JobState.RUNNING,
+        'REQUEUED': JobState.PENDING,
+        'RESIZING': JobState.RUNNING,
+        'SUSPENDED': JobState.HELD,
+        'COMPLETED': JobState.COMPLETED,
+        'CANCELLED': JobState.CANCELLED,
+        'TIMEOUT': JobState.TIMEOUT,
+        'DEADLINE': JobState.TIMEOUT,
+    }
+
+    def _get_history_cmd(self, job_ids: List[str]) -> str:
+        return (f"{self.config.sacct_bin} --noheader --parsable2 --allocations "
+                f"--format=JobID,State,Elapsed,ExitCode -j {','.join(job_ids)}")
+
+    def _parse_history(self, output: str) -> Dict[str, JobStats]:
+        history = dict()
+        for line in output.splitlines():
+            fields = line.strip().split('|')
+            if len(fields) != 4:
+                continue
+            job_id, state, elapsed, exit_code = fields
+            # example: CANCELLED by 1000
+            state = state.split(' ')[0]
+            history[job_id] = JobStats(
+                state=self.sacct_translate_table.get(state, JobState.FAILED),
+                elapsed=parse_elapsed_time(elapsed),
+                exit_code=exit_code,
+            )
+        return history
+
+    def _update_all_states(self) -> Dict[str, JobState]:
         current_ts = time.time()
         if  (current_ts - self._last_update_at) < self.get_polling_interval():
             return self._last_states
@@ -236,7 +776,8 @@ class Slurm(BaseQueueSystem):
                 continue
             job_id, slurm_state = line.split()
             state = self._translate_state(slurm_state)
-            states[job_id] = state
+            for _job_id in expand_slurm_job_id(job_id):
+                states[_job_id] = state
         # update cache
         self._last_update_at = current_ts
         self._last_states = states
@@ -247,6 +788,20 @@ class Lsf(BaseQueueSystem):
 
     config: QueueSystemConfig.LSF
 
+    # finished jobs (DONE) are not translated, so that their states are decided by the success indicators
+    translate_table = {
+        'PEND': JobState.PENDING,
+        'WAIT': JobState.PENDING,
+        'PROV': JobState.PENDING,  # (provisioning)
+        'RUN': JobState.RUNNING,
+        'PSUSP': JobState.HELD,
+        'USUSP': JobState.HELD,
+        'SSUSP': JobState.HELD,
+        'EXIT': JobState.FAILED,
+        'ZOMBI': JobState.FAILED,
+        'UNKWN': JobState.UNKNOWN,
+    }
+
     def get_polling_interval(self):
         return self.config.polling_interval
 
@@ -263,16 +818,42 @@ class Lsf(BaseQueueSystem):
     def get_job_id_envvar(self) -> str:
         return 'LSB_JOBID'
 
-    # TODO
-    def get_job_state(self, job_id: str, success_indicator_path: str) -> JobState:
-        return JobState.UNKNOWN
+    def get_job_cores(self, script: str) -> int:
+        args = get_script_directives(script, '#BSUB')
+        return _to_int(get_directive_option(args, '-n', None)) or 1
 
-    # TODO
     def cancel(self, job_id: str):
-        ...
+        cmd = f'{self.config.bkill_bin} {job_id}'
+        self.connector.run(cmd)
 
-    def _get_all_states(self) -> Dict[str, JobState]:
-        ...
+    def _post_submit(self, job: 'QueueJobFuture'):
+        self._last_update_at = 0
+
+    def _update_all_states(self) -> Dict[str, JobState]:
+        current_ts = time.time()
+        if (current_ts - self._last_update_at) < self.get_polling_interval():
+            return self._last_states
+
+        # -a to include the jobs that finished recently
+        cmd = f"{self.config.bjobs_bin} -a -o 'jobid stat' -noheader"
+        # bjobs exits with non-zero code when there is no job
+        r = self.connector.run(cmd, hide=True, warn=True)
+        if r.return_code and not r.stdout.strip() and 'No ' not in r.stderr:
+            logger.warning(f'Error when calling bjobs: {r.stderr}')
+            return self._last_states
+
+        states: Dict[str, JobState] = dict()
+        for line in r.stdout.splitlines():
+            fields = line.split()
+            if len(fields) != 2:  # skip empty line or message
+                continue
+            job_id, lsf_state = fields
+            if lsf_state in self.translate_table:
+                states[job_id] = self.translate_table[lsf_state]
+        # update cache
+        self._last_update_at = current_ts
+        self._last_states = states
+        return states
 
 
 class PBS(BaseQueueSystem):
@@ -288,9 +869,6 @@ class PBS(BaseQueueSystem):
         'S': JobState.HELD  # Suspended
     }
 
-    _last_states = defaultdict(lambda: JobState.UNKNOWN)
-    _last_update_at: float = 0
-
     def get_setup_script(self) -> str:
         return 'cd $PBS_O_WORKDIR'
 
@@ -306,6 +884,34 @@ class PBS(BaseQueueSystem):
     def get_job_id_envvar(self) -> str:
         return 'PBS_JOBID'
 
+    def get_job_cores(self, script: str) -> int:
+        # e.g. `-l select=2:ncpus=4` or `-l nodes=2:ppn=4`
+        args = get_script_directives(script, '#PBS')
+        cores = 0
+        for i, arg in enumerate(args[:-1]):
+            if arg != '-l':
+                continue
+            for chunk in args[i + 1].split('+'):
+                res = dict(kv.split('=', 1) for kv in re.split(r'[:,]', chunk) if '=' in kv)
+                if not res.keys() & {'select', 'nodes', 'ncpus', 'ppn'}:
+                    continue  # e.g. walltime
+                nodes = _to_int(res.get('select', res.get('nodes'))) or 1
+                cores += nodes * (_to_int(res.get('ncpus', res.get('ppn'))) or 1)
+        return cores or 1
+
+    def is_job_array_enabled(self) -> bool:
+        return self.config.job_array
+
+    def get_array_option(self, size: int) -> str:
+        return f'-J 0-{size - 1}'
+
+    def get_array_index_envvar(self) -> str:
+        return 'PBS_ARRAY_INDEX'
+
+    def get_array_element_id(self, array_job_id: str, index: int) -> str:
+        # example: 123[].server -> 123[4].server
+        return array_job_id.replace('[]', f'[{index}]', 1)
+
     def cancel(self, job_id: str):
         cmd = f'{self.config.qdel_bin} {job_id}'
         self.connector.run(cmd)
@@ -313,24 +919,13 @@ class PBS(BaseQueueSystem):
     def _post_submit(self, job: 'QueueJobFuture'):
         self._last_update_at = 0  # force update stats
 
-    def get_job_state(self, job_id: str, success_indicator_path: str) -> JobState:
-        state = self._get_all_states().get(job_id)
-        if state is None:
-            cmd = 'test -f {}'.format(shlex.quote(success_indicator_path))
-            ret = self.connector.run(cmd, warn=True)
-            if ret.return_code:
-                return JobState.FAILED
-            else:
-                return JobState.COMPLETED
-        else:
-            return state
-
-    def _get_all_states(self) -> Dict[str, JobState]:
+    def _update_all_states(self) -> Dict[str, JobState]:
         current_ts = time.time()
         if (current_ts - self._last_update_at) < self.get_polling_interval():
             return self._last_states
 
-        cmd = f"{self.config.qstat_bin} -f -F json"
+        # -t is required to list the elements of job arrays
+        cmd = f"{self.config.qstat_bin} -f {'-t ' if self.config.job_array else ''}-F json"
         try:
             r = self.connector.run(cmd, hide=True)
         except invoke.exceptions.UnexpectedExit as e:
@@ -348,6 +943,160 @@ class PBS(BaseQueueSystem):
     def _translate_state(self, slurm_state: str) -> JobState:
         return self.translate_table.get(slurm_state, JobState.UNKNOWN)
 
+    def _get_history_cmd(self, job_ids: List[str]) -> str:
+        return f"{self.config.qstat_bin} -x -f -F json {' '.join(shlex.quote(job_id) for job_id in job_ids)}"
+
+    def _parse_history(self, output: str) -> Dict[str, JobStats]:
+        history = dict()
+        output = output.strip()
+        if not output:
+            return history
+        for job_id, job in json.loads(output).get('Jobs', dict()).items():
+            pbs_state = job.get('job_state')
+            exit_status = job.get('Exit_status')
+            if pbs_state in ('F', 'X'):  # finished job or sub job
+                if exit_status == 0:
+                    state = JobState.COMPLETED
+                elif exit_status == -29:  # JOB_EXEC_KILL_WALLTIME
+                    state = JobState.TIMEOUT
+                elif exit_status == 271:  # killed by SIGTERM of qdel
+                    state = JobState.CANCELLED
+                else:
+                    state = JobState.FAILED
+            else:
+                state = self._translate_state(pbs_state)
+            history[job_id] = JobStats(
+                state=state,
+                elapsed=parse_elapsed_time(job.get('resources_used', dict()).get('walltime', '')),
+                exit_code=None if exit_status is None else str(exit_status),
+            )
+        return history
+
+
+class _LocalJob:
+    def __init__(self, job_id: str, script_path: str, cores: int):
+        self.job_id = job_id
+        self.script_path = script_path
+        self.cores = cores
+        self.state = JobState.PENDING
+        self.proc: Optional[subprocess.Popen] = None
+
+
+class Local(BaseQueueSystem):
+    """
+    Run jobs as subprocesses of the current process,
+    which is useful to run workflows on a workstation or to test them without a cluster.
+
+    A job is started when there are enough free cores for it,
+    the job script is executed by bash in its own process group,
+    and its output is written to `<script>.out`.
+    """
+
+    config: QueueSystemConfig.Local
+
+    _core_pattern = re.compile(r'^#LOCAL\s+(?:-c|--cores)\s+(\d+)\s*$', re.MULTILINE)
+
+    def __init__(self):
+        super().__init__()
+        self._jobs: Dict[str, _LocalJob] = dict()
+        self._queue: List[_LocalJob] = []
+        self._used_cores = 0
+        self._counter = 0
+
+    def get_polling_interval(self):
+        return self.config.polling_interval
+
+    def get_script_suffix(self):
+        return '.sh'
+
+    def get_submit_cmd(self):
+        return 'bash'
+
+    def get_job_id_pattern(self):
+        return r'(local-\S+)'
+
+    def get_job_id_envvar(self) -> str:
+        return 'AI2KIT_LOCAL_JOB_ID'
+
+    def get_job_cores(self, script: str) -> int:
+        m = self._core_pattern.search(script)
+        return int(m.group(1)) if m else self.config.cores_per_job
+
+    def get_slots(self):
+        return self.config.slots or os.cpu_count() or 1
+
+    def _get_all_states(self) -> Dict[str, JobState]:
+        # the jobs that are finished or submitted by another process are treated as vanished,
+        # so their final states are decided by the success indicators
+        with self._states_lock:
+            return {job_id: job.state for job_id, job in self._jobs.items()
+                    if job.state is not JobState.COMPLETED}
+
+    def _get_cached_states(self) -> Dict[str, JobState]:
+        return {job_id: job.state for job_id, job in list(self._jobs.items())}
+
+    def _resolve_vanished_jobs(self, jobs: Dict[str, str]) -> Dict[str, JobState]:
+        return {job_id: JobState.COMPLETED if os.path.exists(path) else JobState.FAILED
+                for job_id, path in jobs.items()}
+
+    def cancel(self, job_id: str):
+        with self._states_lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state.terminal:
+                return
+            if job.proc is None:
+                self._queue.remove(job)
+            else:
+                try:
+                    os.killpg(job.proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            job.state = JobState.CANCELLED
+
+    def _submit_script(self, cmd: str, script_path: str, script: str) -> str:
+        cores = self.get_job_cores(script)
+        if cores > self.get_slots():
+            logger.warning(f'{script_path} requires {cores} cores, '
+                           f'but only {self.get_slots()} are available, use all of them instead')
+            cores = self.get_slots()
+        with self._states_lock:
+            self._counter += 1
+            job = _LocalJob(f'local-{os.getpid()}-{self._counter}', script_path, cores)
+            self._jobs[job.job_id] = job
+            self._queue.append(job)
+            self._schedule()
+        return job.job_id
+
+    def _schedule(self):
+        """
+        Start queued jobs that fit in the free cores, must be called with the lock held.
+        """
+        for job in list(self._queue):
+            if self._used_cores + job.cores > self.get_slots():
+                continue
+            self._queue.remove(job)
+            self._used_cores += job.cores
+            env = dict(os.environ)
+            env[self.get_job_id_envvar()] = job.job_id
+            env['AI2KIT_LOCAL_CORES'] = str(job.cores)
+            cwd, name = os.path.split(job.script_path)
+            with open(job.script_path + '.out', 'ab') as out:
+                job.proc = subprocess.Popen(['bash', name], cwd=cwd, env=env, stdout=out,
+                                            stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                            start_new_session=True)
+            job.state = JobState.RUNNING
+            Thread(target=self._wait_job, args=(job,), daemon=True).start()
+
+    def _wait_job(self, job: _LocalJob):
+        assert job.proc is not None
+        job.proc.wait()
+        with self._states_lock:
+            self._used_cores -= job.cores
+            if job.state is not JobState.CANCELLED:
+                # the final state is decided by the success indicator
+                job.state = JobState.COMPLETED
+            self._schedule()
+
 
 class QueueJobFuture(JobFuture):
 
@@ -368,6 +1117,8 @@ class QueueJobFuture(JobFuture):
         self._success_indicator = success_indicator
         self._polling_interval = polling_interval
         self._final_state = None
+        self._final_state_lock = Lock()
+        self._created_at = time.time()
 
     @property
     def success_indicator_path(self):
@@ -380,10 +1131,40 @@ class QueueJobFuture(JobFuture):
         state = self._queue_system.get_job_state(
             self._job_id, self.success_indicator_path)
         if state.terminal:
-            self._final_state = state
+            self._set_final_state(state)
 
         return state
 
+    async def get_job_state_async(self):
+        if self._final_state is not None:
+            return self._final_state
+
+        state = await self._queue_system.get_job_state_async(
+            self._job_id, self.success_indicator_path)
+        if state.terminal:
+            self._set_final_state(state)
+
+        return state
+
+    def get_job_stats(self) -> Optional[JobStats]:
+        """
+        Get the accounting data of the job, e.g. elapsed time and exit code,
+        which is only available after the job is finished and if the queue system supports it.
+        """
+        return self._queue_system.get_job_stats(self._job_id)
+
+    def _set_final_state(self, state: JobState):
+        # the job may be finished by both the background watcher and the caller,
+        # only the first one releases the job and records its span
+        with self._final_state_lock:
+            if self._final_state is not None:
+                return
+            self._final_state = state
+        self._queue_system._on_job_finished(self._job_id)
+        # the lifetime of the job, including the time waiting in the queue
+        add_async_span('job', 'queue', self._job_id, self._created_at, time.time(),
+                       script=self._name, cwd=self._cwd, state=state.name)
+
     def resubmit(self):
         if not self.done():
             raise RuntimeError('Cannot resubmit an unfinished job!')
@@ -396,6 +1177,18 @@ class QueueJobFuture(JobFuture):
             success_indicator=self._success_indicator,
         )
 
+    async def resubmit_async(self):
+        if not self.done():
+            raise RuntimeError('Cannot resubmit an unfinished job!')
+
+        logger.info(f'Resubmit job: {self._job_id}')
+        return await self._queue_system.submit_async(
+            script=self._script,
+            cwd=self._cwd,
+            name=self._name,
+            success_indicator=self._success_indicator,
+        )
+
     def is_success(self):
         return self.get_job_state() is JobState.COMPLETED
 
@@ -410,17 +1203,14 @@ class QueueJobFuture(JobFuture):
 
     async def result_async(self, timeout: float = float('inf')) -> JobState:
         '''
-        Though this is not fully async, as the job submission and state polling are still blocking,
-        but it is already good enough to handle thousands of jobs (I guess).
+        The jobs are polled in bulk by the poller of the queue system,
+        so waiting for a lot of jobs won't issue a lot of remote calls.
         '''
-        timeout_ts = time.time() + timeout
-        while time.time() < timeout_ts:
-            if self.done():
-                return self.get_job_state()
-            else:
-                await asyncio.sleep(self._polling_interval)
-        else:
-            raise RuntimeError(f'Timeout of polling job: {self._job_id}')
+        if self._final_state is not None:
+            return self._final_state
+        state = await self._queue_system.wait_job_async(self._job_id, self.success_indicator_path, timeout)
+        self._set_final_state(state)
+        return state
 
     def __repr__(self):
         return repr(dict(
@@ -433,6 +1223,90 @@ class QueueJobFuture(JobFuture):
         ))
 
 
+_HISTORY_DELIMITER = '__AI2KIT_JOB_HISTORY__'
+
+
+def parse_elapsed_time(elapsed: str) -> Optional[float]:
+    """
+    Parse elapsed time in format of `[DD-[HH:]]MM:SS` to seconds, return None if it is invalid.
+    """
+    m = re.match(r'^(?:(\d+)-)?(?:(\d+):)?(\d+):(\d+)(?:\.\d+)?$', elapsed.strip())
+    if m is None:
+        return None
+    days, hours, minutes, seconds = (int(v) if v else 0 for v in m.groups())
+    return float(((days * 24 + hours) * 60 + minutes) * 60 + seconds)
+
+
+def expand_slurm_job_id(job_id: str) -> List[str]:
+    """
+    Expand the pending elements of job array that are folded by squeue,
+    for example, `123_[1,3-5%2]` will be expanded to `123_1`, `123_3`, `123_4` and `123_5`.
+    """
+    m = re.match(r'^(\d+)_\[([^\]]+)\]$', job_id)
+    if m is None:
+        return [job_id]
+    array_job_id, spec = m.group(1), m.group(2).split('%')[0]
+    job_ids = []
+    for item in spec.split(','):
+        if '-' in item:
+            start, end = item.split('-', 1)
+            job_ids += [f'{array_job_id}_{i}' for i in range(int(start), int(end) + 1)]
+        elif item:
+            job_ids.append(f'{array_job_id}_{item}')
+    return job_ids
+
+
+def split_script_header(script: str):
+    """
+    Split script into the leading comment or empty lines, e.g. the shebang and directives of queue system, and the rest.
+    """
+    lines = script.splitlines()
+    i = 0
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            break
+    else:
+        i = len(lines)
+    return '\n'.join(lines[:i]), '\n'.join(lines[i:])
+
+
+def get_script_directives(script: str, prefix: str) -> List[str]:
+    """
+    Get the arguments of the directive lines in script header, e.g. `#SBATCH -N 1` with prefix `#SBATCH`.
+    """
+    header, _ = split_script_header(script)
+    args = []
+    for line in header.splitlines():
+        line = line.strip()
+        if line.startswith(prefix + ' '):
+            args += shlex.split(line[len(prefix):], comments=True)
+    return args
+
+
+def get_directive_option(args: List[str], short: Optional[str], long: Optional[str]) -> Optional[str]:
+    """
+    Get the value of an option from directive arguments, the last one wins,
+    support the forms of `-n 4`, `-n4`, `--ntasks 4` and `--ntasks=4`.
+    """
+    value = None
+    for i, arg in enumerate(args):
+        next_arg = args[i + 1] if i + 1 < len(args) else None
+        if arg in (short, long):
+            value = next_arg
+        elif long and arg.startswith(long + '='):
+            value = arg[len(long) + 1:]
+        elif short and arg.startswith(short) and not arg.startswith('--') and len(arg) > len(short):
+            value = arg[len(short):]
+    return value
+
+
+def _to_int(value: Optional[str]) -> Optional[int]:
+    # the value may be a range, e.g. `1-2` nodes, take the minimum one
+    m = re.match(r'^\d+', value or '')
+    return int(m.group(0)) if m else None
+
+
 def inject_cmd_to_script(script: str, cmd: str):
     """
     Find the position of first none comment or empty lines,
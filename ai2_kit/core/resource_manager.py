@@ -1,11 +1,10 @@
 from typing import Dict, List, Tuple, Union, Optional, Sequence
-import copy
 
-from .artifact import Artifact, ArtifactMap
+from .artifact import Artifact, ArtifactMap, ArtifactRecord, AnyArtifact
 from .executor import Executor, ExecutorMap, create_executor
 
 
-ArtifactOrKey = Union[Artifact, str]
+ArtifactOrKey = Union[AnyArtifact, str]
 
 class ResourceManager:
 
@@ -22,6 +21,8 @@ class ResourceManager:
         self._executor_configs = executor_configs
         self._default_executor_name = default_executor
         self._executors: Dict[str, Executor] = dict()
+        # (executor, url, includes) -> paths, so that the artifacts in config won't be expanded in every iteration
+        self._glob_memo: Dict[Tuple[str, str, str], List[str]] = dict()
         # runtime check to ensure quick failure
         self.default_executor
 
@@ -49,6 +50,13 @@ class ResourceManager:
 
         return self._executors[name]
 
+    def close(self):
+        """
+        Close the executors that have been created.
+        """
+        for executor in self._executors.values():
+            executor.close()
+
     def get_artifact(self, key: str) -> Artifact:
         # raise error it is by designed, ensure quick failure
         return self._artifacts[key]
@@ -56,23 +64,60 @@ class ResourceManager:
     def get_artifacts(self, keys: List[str]) -> List[Artifact]:
         return [self.get_artifact(key) for key in keys]
 
-    def resolve_artifact(self, artifact: ArtifactOrKey ) -> List[Artifact]:
-        # TODO: support cross executor data resolve in the future
-        if isinstance(artifact, str):
-            artifact = self.get_artifact(artifact)
-        paths = self.default_executor.resolve_artifact(artifact)
-
-        result = [Artifact.of(
-            url=path,
-            format=artifact.format,
+    def resolve_artifact(self, artifact: ArtifactOrKey) -> List[ArtifactRecord]:
+        return self.resolve_artifacts([artifact])
+
+    def resolve_artifacts(self, artifacts: Sequence[ArtifactOrKey]) -> List[ArtifactRecord]:
+        """
+        Resolve artifacts to the paths on the default executor.
+        The results are records that share the attrs of the artifact they are resolved from.
+
+        Artifacts are expanded on their own executors in one call for each executor,
+        and the expanded glob patterns are memorized, as the data they match is not expected to change.
+        Those on other executors are transferred to the default executor,
+        in one batch for each source executor.
+        """
+        items = [ArtifactRecord.from_artifact(self.get_artifact(a) if isinstance(a, str) else a) for a in artifacts]
+        names = [a.executor or self._default_executor_name for a in items]
+
+        # expand the patterns that are not memorized yet
+        pending: Dict[str, List[ArtifactRecord]] = {}
+        for artifact, executor_name in zip(items, names):
+            if artifact.includes is not None and self._get_memo_key(executor_name, artifact) not in self._glob_memo:
+                pending.setdefault(executor_name, []).append(artifact)
+        for executor_name, pending_artifacts in pending.items():
+            paths_list = self.get_executor(executor_name).resolve_artifacts(pending_artifacts)
+            for artifact, paths in zip(pending_artifacts, paths_list):
+                if paths:
+                    self._glob_memo[self._get_memo_key(executor_name, artifact)] = paths
+
+        resolved: List[Tuple[ArtifactRecord, str, List[str]]] = []
+        for artifact, executor_name in zip(items, names):
+            if artifact.includes is None:
+                paths = [artifact.url]
+            else:
+                paths = list(self._glob_memo.get(self._get_memo_key(executor_name, artifact), []))
+            assert len(paths) > 0, f'artifact {artifact} is invalid'
+            resolved.append((artifact, executor_name, paths))
+
+        # map the paths of other executors to the default executor
+        dest_paths: Dict[Tuple[str, str], str] = {}
+        src_paths: Dict[str, List[str]] = {}
+        for _, executor_name, paths in resolved:
+            if executor_name != self._default_executor_name:
+                src_paths.setdefault(executor_name, []).extend(paths)
+        for executor_name, paths in src_paths.items():
+            paths = list(dict.fromkeys(paths))
+            transferred = self.default_executor.transfer_from(self.get_executor(executor_name), paths)
+            dest_paths.update(((executor_name, path), dest) for path, dest in zip(paths, transferred))
+
+        return [artifact.evolve(
+            url=dest_paths.get((executor_name, path), path),
+            key=None,
             includes=None,  # has been consumed
-            attrs=copy.deepcopy(artifact.attrs),
             executor=self.default_executor.name,
-        ) for path in paths]
-
-        assert len(result) > 0, f'artifact {artifact} is invalid'
-        return result
+        ) for artifact, executor_name, paths in resolved for path in paths]
 
-    def resolve_artifacts(self, artifacts: Sequence[ArtifactOrKey]) -> List[Artifact]:
-        # flat map
-        return [x for a in artifacts for x in self.resolve_artifact(a)]
+    def _get_memo_key(self, executor_name: str, artifact: ArtifactRecord):
+        assert artifact.includes is not None
+        return executor_name, artifact.url, artifact.includes
@@ -0,0 +1,171 @@
+"""
+Record the runtime of tasks and predict the cost of new tasks from the history,
+so that tasks can be balanced across jobs by their cost instead of their count.
+
+The runtime is taken from the checkpoint file of `BashStep`, which records the start and end time of the step.
+Records are keyed by stage (e.g. `label-cp2k`), atom count and nsteps.
+They are kept in memory by default, call `set_runtime_db_file` to persist them across runs.
+
+As the records change after each run, the costs used to split the tasks of a stage are saved in its tasks dir
+by `freeze_costs`, so that a restarted stage splits the tasks in the same way and its jobs can be recovered.
+"""
+
+from typing import Dict, List, Optional, Tuple
+from threading import Lock
+import statistics
+import json
+import os
+
+from .executor import Executor
+from .script import BashStep
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+TaskKey = Tuple[int, int]
+"""
+(natoms, nsteps) of a task
+"""
+
+MAX_SAMPLES = 16
+"""
+Max number of runtime samples to keep for each key, the oldest ones are dropped.
+"""
+
+COSTS_FILE = 'task-costs.json'
+
+_lock = Lock()
+_db_file: Optional[str] = None
+_records: Dict[str, Dict[str, List[float]]] = {}  # stage -> "natoms,nsteps" -> runtimes
+
+
+def set_runtime_db_file(path: str):
+    """
+    Load the runtime records from the file, and save the new records to it.
+    """
+    global _db_file, _records
+    with _lock:
+        _db_file = path
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                _records = json.load(f)
+
+
+def record_runtimes(stage: str, keys: List[TaskKey], runtimes: List[Optional[float]]):
+    """
+    Add runtime samples of tasks, the tasks whose runtime is None are ignored.
+    """
+    with _lock:
+        stage_records = _records.setdefault(stage, {})
+        for key, runtime in zip(keys, runtimes):
+            if runtime is None:
+                continue
+            samples = stage_records.setdefault(_format_key(key), [])
+            samples.append(runtime)
+            del samples[:-MAX_SAMPLES]
+        if _db_file is not None:
+            dir_path = os.path.dirname(_db_file)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            with open(_db_file, 'w') as f:
+                json.dump(_records, f)
+
+
+def predict_costs(stage: str, keys: List[TaskKey]) -> List[float]:
+    """
+    Predict the cost of tasks.
+
+    The mean runtime of the same key is used if there is any,
+    otherwise the cost is estimated by the median runtime per atom-step of the stage.
+    If the stage has no record at all, the costs are proportional to natoms * nsteps,
+    which is enough as only the relative costs matter when balancing tasks.
+    """
+    with _lock:
+        stage_records = {k: list(v) for k, v in _records.get(stage, {}).items() if v}
+    rates = [statistics.mean(v) / _work(_parse_key(k)) for k, v in stage_records.items()]
+    rate = statistics.median(rates) if rates else 1.0
+    costs = []
+    for key in keys:
+        samples = stage_records.get(_format_key(key))
+        costs.append(statistics.mean(samples) if samples else rate * _work(key))
+    return costs
+
+
+def freeze_costs(executor: Executor, tasks_dir: str, costs: List[float]) -> List[float]:
+    """
+    Save the costs of the tasks of a stage to its tasks dir when it is run for the first time,
+    and use the saved costs afterwards, so that the split of tasks is deterministic across restarts.
+    """
+    return executor.run_python_fn(load_or_dump_costs)(os.path.join(tasks_dir, COSTS_FILE), costs)
+
+
+def record_step_runtimes(executor: Executor, stage: str, steps: List[BashStep], keys: List[TaskKey]):
+    """
+    Load the runtime of steps from their checkpoint files and record them.
+    """
+    checkpoint_files = [
+        os.path.join(step.cwd or '', step.checkpoint + '.checkpoint') if step.checkpoint else ''
+        for step in steps
+    ]
+    runtimes = executor.run_python_fn(load_step_runtimes)(checkpoint_files)
+    record_runtimes(stage, keys, runtimes)
+    logger.info('%d runtime records of %s are added', sum(r is not None for r in runtimes), stage)
+
+
+def _format_key(key: TaskKey):
+    return f'{key[0]},{key[1]}'
+
+
+def _parse_key(key: str) -> TaskKey:
+    natoms, nsteps = key.split(',')
+    return int(natoms), int(nsteps)
+
+
+def _work(key: TaskKey):
+    return max(key[0], 1) * max(key[1], 1)
+
+
+def __export_remote_functions():
+
+    def load_step_runtimes(checkpoint_files: List[str]) -> List[Optional[float]]:
+        """
+        Load the runtime of steps from checkpoint files in the format of `<start> <end>`,
+        None is returned if the file doesn't exist or doesn't contain the time.
+        """
+        runtimes = []
+        for path in checkpoint_files:
+            runtime = None
+            try:
+                with open(path, 'r') as f:
+                    start, end = f.read().split()
+                runtime = float(end) - float(start)
+            except (OSError, ValueError):
+                pass
+            runtimes.append(runtime)
+        return runtimes
+
+    def load_or_dump_costs(path: str, costs: List[float]) -> List[float]:
+        """
+        Load the costs from the file if it is saved for the same number of tasks, or else save the costs to it.
+        """
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if len(saved) == len(costs):
+                return saved
+        except (OSError, ValueError):
+            pass
+        with open(path, 'w') as f:
+            json.dump(costs, f)
+        return costs
+
+    return (
+        load_step_runtimes,
+        load_or_dump_costs,
+    )
+
+
+(
+    load_step_runtimes,
+    load_or_dump_costs,
+) = __export_remote_functions()
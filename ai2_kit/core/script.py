@@ -1,5 +1,6 @@
-from typing import Optional, List, Union, Sequence
+from typing import Optional, List, Union, Sequence, Tuple
 import shlex
+import os
 
 from .pydantic import BaseModel
 
@@ -38,19 +39,31 @@ class BashStep(BaseModel):
         ])
 
         if self.exit_on_error:
+            if self.checkpoint:
+                # record the exit code in the status file before exit
+                status = shlex.quote(self.checkpoint + '.status')
+                statement = ('__EXITCODE__=$?; if [ $__EXITCODE__ -ne 0 ]; then '
+                             f'echo "failed $__EXITCODE__" > {status}; exit $__EXITCODE__; fi')
+            else:
+                statement = exit_on_error_statment()
             rendered_step = '\n'.join([
                 rendered_step,
-                exit_on_error_statment()
+                statement,
             ])
 
         if self.checkpoint:
             checkpoint = shlex.quote(self.checkpoint + '.checkpoint')
+            status = shlex.quote(self.checkpoint + '.status')
             msg = shlex.quote(f"hit {checkpoint}, skip")
 
             rendered_step = '\n'.join([
                 f'if [ -f {checkpoint} ]; then echo {msg}; else',
+                '__STEP_START__=$(date +%s)',
+                # the status file tells the step has been started but not finished yet, see `get_step_states`
+                f'echo running > {status}',
                 rendered_step,
-                f'touch {checkpoint}; fi  # create checkpoint on success',
+                '# create checkpoint on success, the start and end time are recorded for cost prediction',
+                f'echo "$__STEP_START__ $(date +%s)" > {checkpoint}; rm -f {status}; fi',
             ])
 
         if self.cwd:
@@ -70,21 +83,41 @@ BashSteps = Sequence[Union[str, BashStep]]
 class BashScript(BaseModel):
     template: Optional[BashTemplate]
     steps: BashSteps
+    parallelism: int = 1
+    """
+    Max number of steps to run at the same time.
+    If it is larger than 1, each step runs in a background sub shell,
+    and the script exits with the exit code of the first failed step after all steps are finished.
+    `wait -n` is used to wait for a free slot, which requires bash 4.3 or later.
+    """
+    cores_per_step: Optional[int] = None
+    """
+    Pin the step of each slot to its own `cores_per_step` cores with `taskset`,
+    and set OMP_NUM_THREADS accordingly. Only works when parallelism is larger than 1.
+    """
 
     def render(self):
+        if self.parallelism > 1:
+            rendered_steps = _render_parallel_bash_steps(self.steps, self.parallelism, self.cores_per_step)
+        else:
+            rendered_steps = render_bash_steps(self.steps)
+
         if self.template is None:
-            return _render_bash_steps(self.steps)
+            return rendered_steps
 
         return '\n'.join([
             self.template.shebang,
             self.template.header,
             self.template.setup,
-            _render_bash_steps(self.steps),
+            rendered_steps,
             self.template.teardown,
         ])
 
 
-def _render_bash_steps(steps: BashSteps):
+def render_bash_steps(steps: BashSteps):
+    """
+    Render steps to run one after another, without the header of a job script.
+    """
     rendered_steps = []
 
     for step in steps:
@@ -94,3 +127,118 @@ def _render_bash_steps(steps: BashSteps):
             assert isinstance(step, BashStep)
             rendered_steps.append(step.render())
     return '\n\n'.join(rendered_steps)
+
+
+def _render_parallel_bash_steps(steps: BashSteps, parallelism: int, cores_per_step: Optional[int] = None):
+    header = '\n'.join([
+        '__STEP_STATUS__=$(mktemp -d)',
+        '__SLOT_PIDS__=()',
+        '# find a slot whose step is not running, `jobs -pr` only lists the children of this shell',
+        '__find_slot() {',
+        '  local running=" $(jobs -pr | tr \'\\n\' \' \') "',
+        f'  for ((__SLOT__=0; __SLOT__<{parallelism}; __SLOT__++)); do',
+        '    [[ "$running" != *" ${__SLOT_PIDS__[$__SLOT__]:-none} "* ]] && return 0',
+        '  done',
+        '  return 1',
+        '}',
+    ])
+    if cores_per_step:
+        header = '\n'.join([
+            header,
+            '# the cores allowed by the scheduler, which may not start from 0, the slots are mapped onto them',
+            '__CPU_LIST__=$(sed -n "s/^Cpus_allowed_list:\\s*//p" /proc/self/status 2>/dev/null)',
+            '[ -n "$__CPU_LIST__" ] || __CPU_LIST__=$(taskset -pc $$ 2>/dev/null | sed "s/.*: *//")',
+            '__CPUS__=()',
+            'for __RANGE__ in ${__CPU_LIST__//,/ }; do',
+            '  __CPUS__+=($(seq ${__RANGE__%-*} ${__RANGE__#*-}))',
+            'done',
+        ])
+
+    rendered_steps = []
+    for i, step in enumerate(steps):
+        rendered_step = step if isinstance(step, str) else step.render()
+        if cores_per_step:
+            rendered_step = '\n'.join([
+                f'__CORES__=("${{__CPUS__[@]:$((__SLOT__ * {cores_per_step})):{cores_per_step}}}")',
+                f'if [ ${{#__CORES__[@]}} -lt {cores_per_step} ] || '
+                '! taskset -cp "$(IFS=,; echo "${__CORES__[*]}")" $BASHPID > /dev/null; then',
+                f'  echo "fail to pin step {i} to {cores_per_step} cores of slot $__SLOT__, '
+                f'allowed cores: ${{__CPU_LIST__:-unknown}}" >&2',
+                'fi',
+                f'export OMP_NUM_THREADS={cores_per_step}',
+                rendered_step,
+            ])
+        rendered_steps.append('\n'.join([
+            'until __find_slot; do wait -n; done',
+            '{ (',
+            rendered_step,
+            f'); echo $? > "$__STEP_STATUS__/{i}"; }} &',
+            '__SLOT_PIDS__[$__SLOT__]=$!',
+        ]))
+
+    footer = '\n'.join([
+        'wait',
+        '__EXITCODE__=0',
+        f'for __STEP__ in $(seq 0 {len(steps) - 1}); do',
+        '  __STEP_EXITCODE__=$(cat "$__STEP_STATUS__/$__STEP__" 2>/dev/null || echo 1)',
+        '  if [ "$__STEP_EXITCODE__" -ne 0 ]; then',
+        '    echo "step $__STEP__ failed with exit code $__STEP_EXITCODE__" >&2',
+        '    [ $__EXITCODE__ -eq 0 ] && __EXITCODE__=$__STEP_EXITCODE__',
+        '  fi',
+        'done',
+        'rm -rf "$__STEP_STATUS__"',
+        # don't use `exit 0` here or else the success indicator appended by queue system won't be created
+        'if [ $__EXITCODE__ -ne 0 ]; then exit $__EXITCODE__; fi',
+    ])
+    return '\n\n'.join([header, *rendered_steps, footer])
+
+
+def __export_remote_functions():
+
+    def get_step_states(steps: List[Tuple[Optional[str], Optional[str]]], base_dir: str = '') -> List[str]:
+        """
+        Get the states of steps from their checkpoint and status files.
+
+        :param steps: list of (cwd, checkpoint) of steps
+        :param base_dir: working directory of the job, relative cwd of steps is resolved against it
+        :return: list of states, `done` if the checkpoint exists, `failed` if the step has been started but not finished,
+            `pending` if the step has not been started, and `unknown` if the step has no checkpoint
+        """
+        states = []
+        for cwd, checkpoint in steps:
+            if not checkpoint:
+                states.append('unknown')
+                continue
+            path = os.path.join(base_dir, cwd or '', checkpoint)
+            if os.path.exists(path + '.checkpoint'):
+                states.append('done')
+            elif os.path.exists(path + '.status'):
+                states.append('failed')
+            else:
+                states.append('pending')
+        return states
+
+    def clear_step_status(steps: List[Tuple[Optional[str], Optional[str]]], base_dir: str = ''):
+        """
+        Remove the status files left by the earlier runs of steps, so that they are `pending` until they are started again.
+
+        :param steps: list of (cwd, checkpoint) of steps
+        :param base_dir: working directory of the job, relative cwd of steps is resolved against it
+        """
+        for cwd, checkpoint in steps:
+            if checkpoint:
+                try:
+                    os.remove(os.path.join(base_dir, cwd or '', checkpoint) + '.status')
+                except FileNotFoundError:
+                    pass
+
+    return (
+        get_step_states,
+        clear_step_status,
+    )
+
+
+(
+    get_step_states,
+    clear_step_status,
+) = __export_remote_functions()
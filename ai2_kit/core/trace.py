@@ -0,0 +1,152 @@
+"""
+Record the time spent in executor, connector and queue system operations,
+and export them as a Chrome trace file, which can be viewed with chrome://tracing or https://ui.perfetto.dev
+
+Tracing is disabled by default, call `enable_trace` to turn it on.
+
+Example:
+
+>>> enable_trace()
+>>> with trace_stage('iters-000/label-cp2k'):
+...     with trace_span('connector.run', 'connector', bytes_out=len(cmd)) as span:
+...         result = connector.run(cmd)
+...         span['bytes_in'] = len(result.stdout)
+>>> dump_trace('trace.json')
+"""
+
+from typing import Optional, List, Callable, TypeVar
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock, get_ident
+import functools
+import inspect
+import json
+import time
+import os
+
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+_lock = Lock()
+_events: Optional[List[dict]] = None
+_stage: ContextVar[str] = ContextVar('ai2_kit_trace_stage', default='')
+
+
+def enable_trace():
+    global _events
+    with _lock:
+        if _events is None:
+            _events = []
+
+
+def is_trace_enabled():
+    return _events is not None
+
+
+def dump_trace(path: str):
+    """
+    Write the recorded events to a file in Chrome trace format.
+    """
+    with _lock:
+        events = list(_events or [])
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    logger.info('%d trace events are written to %s', len(events), path)
+
+
+def get_stage():
+    return _stage.get()
+
+
+@contextmanager
+def trace_stage(name: str):
+    """
+    Mark the operations in the context as part of a workflow stage.
+    The stage is stored in a context variable, so it is inherited by tasks and threads started by `run_in_thread`.
+    """
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+@contextmanager
+def trace_span(name: str, cat: str, **args):
+    """
+    Record the wall time of the operations in the context as a complete event.
+    The yielded dict can be used to add more arguments to the event, e.g. bytes_in, bytes_out.
+    """
+    if _events is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = repr(e)
+        raise
+    finally:
+        end = time.time()
+        args['stage'] = _stage.get()
+        _add_event({
+            'name': name, 'cat': cat, 'ph': 'X',
+            'ts': start * 1e6, 'dur': (end - start) * 1e6,
+            'pid': os.getpid(), 'tid': get_ident(),
+            'args': args,
+        })
+
+
+FnType = TypeVar('FnType', bound=Callable)
+
+
+def traced(name: str, cat: str):
+    """
+    Decorator to record each call of the function as a span.
+    """
+    def decorator(fn: FnType) -> FnType:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return fn(*args, **kwargs)
+            with trace_span(name, cat):
+                return fn(*args, **kwargs)
+        return wrapper  # type: ignore
+    return decorator
+
+
+def call_in_stage(stage: str, fn: Callable, *args, **kwargs):
+    """
+    Call the function in a stage, if it returns an awaitable, the stage is also applied when awaiting it.
+    """
+    with trace_stage(stage):
+        ret = fn(*args, **kwargs)
+    if inspect.isawaitable(ret):
+        async def _wrap_fn():
+            with trace_stage(stage):
+                return await ret
+        return _wrap_fn()
+    return ret
+
+
+def add_async_span(name: str, cat: str, id: str, start: float, end: float, **args):
+    """
+    Record a span that is not bound to a thread, e.g. the lifetime of a job in the queue.
+    `start` and `end` are timestamps returned by `time.time()`.
+    """
+    if _events is None:
+        return
+    args['stage'] = _stage.get()
+    common = {'name': name, 'cat': cat, 'id': id, 'pid': os.getpid(), 'tid': 0}
+    _add_event({**common, 'ph': 'b', 'ts': start * 1e6, 'args': args})
+    _add_event({**common, 'ph': 'e', 'ts': end * 1e6})
+
+
+def _add_event(event: dict):
+    with _lock:
+        if _events is not None:
+            _events.append(event)
@@ -1,12 +1,15 @@
 from ruamel.yaml import YAML, ScalarNode, SequenceNode
 from pathlib import Path
-from typing import Tuple, List, TypeVar, Union, Iterable
+from typing import Tuple, List, TypeVar, Union, Iterable, Callable
 from dataclasses import field
 from itertools import zip_longest
 import asyncio
+import contextvars
 
+import functools
 import shortuuid
 import hashlib
+import heapq
 import base64
 import copy
 import os
@@ -126,6 +129,21 @@ def list_split(l: List[T], n: int) -> List[List[T]]:
     return [l[i*k+min(i, m): (i+1)*k+min(i+1, m)] for i in range(n)]
 
 
+def list_split_by_cost(l: List[T], costs: List[float], n: int) -> List[List[T]]:
+    """
+    split list into n chunks with balanced total cost,
+    by assigning the most costly item to the chunk with the least cost (LPT)
+    """
+    assert len(l) == len(costs), 'the size of list and costs should be the same'
+    chunks: List[List[T]] = [[] for _ in range(n)]
+    loads = [(0.0, i) for i in range(n)]  # heap of (total cost, chunk index)
+    for j in sorted(range(len(l)), key=lambda j: costs[j], reverse=True):
+        load, i = heapq.heappop(loads)
+        chunks[i].append(l[j])
+        heapq.heappush(loads, (load + costs[j], i))
+    return chunks
+
+
 def short_hash(s: str) -> str:
     """short hash string"""
     digest = hashlib.sha1(s.encode('utf-8')).digest()
@@ -137,6 +155,17 @@ async def to_awaitable(value: T) -> T:
     return value
 
 
+async def run_in_thread(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking function in the default thread pool of the running event loop,
+    so that it won't block other coroutines.
+    """
+    loop = asyncio.get_running_loop()
+    # copy context to keep context variables, e.g. the trace stage, in the thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
 class JoinTag:
     """a tag to join strings in a list"""
 
@@ -339,6 +368,41 @@ def __export_remote_functions():
         return sort_unique_str_list(paths)
 
 
+    def hash_path(path: str, chunk_size: int = 1 << 20) -> str:
+        """
+        Compute sha256 of a file or a directory tree by content.
+        For directory, the relative paths of files are also taken into account,
+        so that renaming a file changes the hash.
+        """
+        sha256 = hashlib.sha256()
+
+        def update_file(file_path: str):
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha256.update(chunk)
+
+        if not os.path.isdir(path):
+            update_file(path)
+            return sha256.hexdigest()
+
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()  # ensure the order of walk is stable
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                rel_path = os.path.relpath(file_path, path)
+                sha256.update(rel_path.encode('utf-8') + b'\0')
+                update_file(file_path)
+                sha256.update(b'\0')
+        return sha256.hexdigest()
+
+    def hash_paths(paths: List[str]) -> List[Tuple[str, str]]:
+        """
+        Compute the absolute path and the content hash of each path in one call,
+        so that it only takes one round trip when running remotely.
+        """
+        return [(os.path.abspath(path), hash_path(path)) for path in paths]
+
+
     # export functions
     return (
         merge_dict,
@@ -354,6 +418,8 @@ def __export_remote_functions():
         flush_stdio,
         ensure_dir,
         expand_globs,
+        hash_path,
+        hash_paths,
     )
 
 
@@ -371,4 +437,6 @@ def __export_remote_functions():
     flush_stdio,
     ensure_dir,
     expand_globs,
+    hash_path,
+    hash_paths,
 ) = __export_remote_functions()
@@ -1,7 +1,7 @@
-from ai2_kit.core.artifact import Artifact, ArtifactDict
-from ai2_kit.core.script import BashScript, BashStep, BashTemplate
-from ai2_kit.core.job import gather_jobs
-from ai2_kit.core.util import dict_nested_get, list_split, list_sample, dump_json, dump_text
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactDict
+from ai2_kit.core.script import BashStep, BashTemplate
+from ai2_kit.core.job import StepJobsConfig, run_bash_steps
+from ai2_kit.core.util import dict_nested_get, list_sample, dump_json, dump_text
 from ai2_kit.core.log import get_logger
 from ai2_kit.core.pydantic import BaseModel
 
@@ -48,18 +48,17 @@ class CllCp2kInputConfig(BaseModel):
     limit_method: Literal["even", "random", "truncate"] = "even"
 
 
-class CllCp2kContextConfig(BaseModel):
+class CllCp2kContextConfig(StepJobsConfig):
     script_template: BashTemplate
     cp2k_cmd: str = 'cp2k'
     post_cp2k_cmd: str = 'echo "no post_cp2k_cmd"'
-    concurrency: int = 5
 
 
 @dataclass
 class CllCp2kInput:
     config: CllCp2kInputConfig
     mode: TRAINING_MODE
-    system_files: List[Artifact]
+    system_files: List[ArtifactRecord]
     type_map: List[str]
     initiated: bool = False  # FIXME: this seems to be a bad design idea
 
@@ -71,7 +70,7 @@ class CllCp2kContext(BaseCllContext):
 
 @dataclass
 class GenericCp2kOutput(ICllLabelOutput):
-    cp2k_outputs: List[Artifact]
+    cp2k_outputs: List[ArtifactRecord]
 
     def get_labeled_system_dataset(self):
         return self.cp2k_outputs
@@ -122,19 +121,11 @@ async def cll_cp2k(input: CllCp2kInput, ctx: CllCp2kContext) -> GenericCp2kOutpu
         ))
 
     # submit tasks and wait for completion
-    jobs = []
-    for i, steps_group in enumerate(list_split(steps, ctx.config.concurrency)):
-        if not steps_group:
-            continue
-        script = BashScript(
-            template=ctx.config.script_template,
-            steps=steps_group,
-        )
-        job = executor.submit(script.render(), cwd=tasks_dir)
-        jobs.append(job)
-    jobs = await gather_jobs(jobs, max_tries=2)
-
-    cp2k_outputs = [Artifact.of(
+    keys = [(a.get('natoms', 0), 1) for a in cp2k_task_dirs]  # type: ignore
+    await run_bash_steps(executor, steps, keys, 'label-cp2k', template=ctx.config.script_template, cwd=tasks_dir,
+                         concurrency=ctx.config.concurrency, pilot=ctx.config.pilot, max_tries=2)
+
+    cp2k_outputs = [ArtifactRecord(
         url=a['url'],
         format=DataFormat.CP2K_OUTPUT_DIR,
         executor=executor.name,
@@ -210,7 +201,8 @@ def __export_remote_functions():
             task_dirs.append({
                 'url': task_dir,
                 'attrs': data_file['attrs'],
-            })
+                'natoms': len(atoms),  # for cost prediction
+            })  # type: ignore
         return task_dirs
 
     def dump_coord_n_cell(fp, atoms: Atoms):
@@ -1,14 +1,15 @@
-from ai2_kit.core.artifact import Artifact, ArtifactDict
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactDict
+from ai2_kit.core.artifact_index import get_index_path, index_artifacts, lookup_artifacts
 from ai2_kit.core.script import BashTemplate
-from ai2_kit.core.script import BashScript, BashStep
+from ai2_kit.core.script import BashScript, BashStep, render_bash_steps
 from ai2_kit.core.job import gather_jobs
 from ai2_kit.core.log import get_logger
-from ai2_kit.core.util import dict_nested_get, expand_globs, dump_json, list_split, flatten
+from ai2_kit.core.util import dict_nested_get, expand_globs, dump_json, list_split
 from ai2_kit.core.pydantic import BaseModel
 from ai2_kit.tool.dpdata import set_fparam, register_data_types
 
 
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict
 from dataclasses import dataclass
 import os
 import copy
@@ -100,6 +101,14 @@ class CllDeepmdContextConfig(BaseModel):
     script_template: BashTemplate
     dp_cmd: str = 'dp'
     concurrency: int = 5
+    parallelism: int = 1
+    """
+    Max number of models to train at the same time in one job.
+    """
+    cores_per_step: Optional[int] = None
+    """
+    Pin the training of each model to its own cores and set OMP_NUM_THREADS to this value.
+    """
 
 
 @dataclass
@@ -108,8 +117,8 @@ class CllDeepmdInput:
     mode: TRAINING_MODE
     type_map: List[str]
     sel_type: Optional[List[int]]
-    old_dataset: List[Artifact]  # training data used by previous iteration
-    new_dataset: List[Artifact]  # training data used by current iteration
+    old_dataset: List[ArtifactRecord]  # training data used by previous iteration
+    new_dataset: List[ArtifactRecord]  # training data used by current iteration
 
 
 @dataclass
@@ -119,13 +128,13 @@ class CllDeepmdContext(BaseCllContext):
 
 @dataclass
 class GenericDeepmdOutput(ICllTrainOutput):
-    models: List[Artifact]
-    dataset: List[Artifact]
+    models: List[ArtifactRecord]
+    dataset: List[ArtifactRecord]
 
-    def get_mlp_models(self) -> List[Artifact]:
+    def get_mlp_models(self) -> List[ArtifactRecord]:
         return self.models
 
-    def get_training_dataset(self) -> List[Artifact]:
+    def get_training_dataset(self) -> List[ArtifactRecord]:
         return self.dataset
 
 
@@ -139,7 +148,7 @@ async def cll_deepmd(input: CllDeepmdInput, ctx: CllDeepmdContext):
         assert len(model_paths) > 0, f'No fixture models found: {input.config.fixture_models}'
         return GenericDeepmdOutput(
             dataset=input.old_dataset.copy(),
-            models=[Artifact.of(url=url, format=DataFormat.DEEPMD_MODEL)
+            models=[ArtifactRecord(url=url, format=DataFormat.DEEPMD_MODEL)
                     for url in model_paths]
         )
 
@@ -151,7 +160,7 @@ async def cll_deepmd(input: CllDeepmdInput, ctx: CllDeepmdContext):
     init_dataset = ctx.resource_manager.resolve_artifacts(input.config.init_dataset)
     # input dataset contains data that generated by previous iteration
     # it should not contain the initial dataset
-    input_dataset: List[Artifact] = input.old_dataset.copy()
+    input_dataset: List[ArtifactRecord] = input.old_dataset.copy()
 
     # make new dataset from raw data
     new_dataset, outlier_dataset = executor.run_python_fn(make_deepmd_dataset)(
@@ -165,13 +174,17 @@ async def cll_deepmd(input: CllDeepmdInput, ctx: CllDeepmdContext):
         deepmd_input_template=input.config.input_template,
         sel_type=input.sel_type,
         mode=input.mode,
+        index_path=get_index_path(executor.work_dir),
     )
 
-    input_dataset += [ Artifact.of(**a) for a in new_dataset]
+    input_dataset += [ ArtifactRecord(**a) for a in new_dataset]
     # use attrs to distinguish outlier dataset
-    input_dataset += [ Artifact.of(**{**a, 'attrs': {**a['attrs'], 'outlier': True}}) for a in outlier_dataset]
-    # classify dataset
-    train_systems, outlier_systems, validation_systems = _classify_dataset(input_dataset + init_dataset)
+    input_dataset += [ ArtifactRecord(**{**a, 'attrs': {**a['attrs'], 'outlier': True}}) for a in outlier_dataset]
+    # classify dataset, the content hashes in the index are used to find duplicated data
+    records = executor.run_python_fn(lookup_artifacts)(
+        get_index_path(executor.work_dir), [a.to_dict() for a in input_dataset + init_dataset], fill=True)
+    content_hashes = {a.url: r['content_hash'] for a, r in zip(input_dataset + init_dataset, records) if r}
+    train_systems, outlier_systems, validation_systems = _classify_dataset(input_dataset + init_dataset, content_hashes)
 
     # setup deep wannier training job if needed
     dw_input_template = None
@@ -204,7 +217,7 @@ async def cll_deepmd(input: CllDeepmdInput, ctx: CllDeepmdContext):
             template=ctx.config.script_template,
             steps=steps,
         )
-        job = executor.submit(dw_train_script.render(), cwd=tasks_dir)
+        job = await executor.submit_async(dw_train_script.render(), cwd=tasks_dir)
         await gather_jobs([job], max_tries=2)
         logger.info(f'Deep wannier training job finished, output dir: {dw_task_dir}')
 
@@ -220,32 +233,38 @@ async def cll_deepmd(input: CllDeepmdInput, ctx: CllDeepmdContext):
         all_steps.append(steps)
 
     # submit jobs by the number of concurrency
-    jobs = []
+    scripts = []
     for i, steps_group in enumerate(list_split(all_steps, ctx.config.concurrency)):
         if not steps_group:
             continue
         script = BashScript(
             template=ctx.config.script_template,
-            steps=flatten(steps_group)
+            # the steps of a model must run in order, so each model is rendered as one step
+            steps=[render_bash_steps(steps) for steps in steps_group],
+            parallelism=ctx.config.parallelism,
+            cores_per_step=ctx.config.cores_per_step,
         )
-        job = executor.submit(script.render(), cwd=tasks_dir)
-        jobs.append(job)
+        scripts.append(script.render())
+    jobs = await executor.submit_array_async(scripts, cwd=tasks_dir)
 
     await gather_jobs(jobs, max_tries=2)
 
     logger.info(f'All models are trained, output dirs: {dp_task_dirs}')
     return GenericDeepmdOutput(
         dataset=input_dataset.copy(),
-        models=[Artifact.of(
+        models=[ArtifactRecord(
             url=os.path.join(url, DP_FROZEN_MODEL),
             format=DataFormat.DEEPMD_MODEL,
         ) for url in dp_task_dirs]
     )
 
-def _classify_dataset(dataset: List[Artifact]):
+def _classify_dataset(dataset: List[ArtifactRecord], content_hashes: Optional[Dict[str, str]] = None):
     """
     Classify dataset into train, outlier and validation
+
+    :param content_hashes: content hash of the data by url, data with the same hash is only kept once
     """
+    content_hashes = content_hashes or {}
     train_systems: List[str] = []
     outlier_systems: List[str] = []
     validation_systems: List[str] = []
@@ -262,7 +281,12 @@ def _classify_dataset(dataset: List[Artifact]):
     # So we need to check and remove duplicated data
     # TODO: find the root cause of duplicated data and remove this workaround
     def _unique(l: list):
-        r = sorted(set(l))
+        r, seen = [], set()
+        for url in sorted(set(l)):
+            key = content_hashes.get(url, url)
+            if key not in seen:
+                seen.add(key)
+                r.append(url)
         if len(r) != len(l):
             logger.warning(f'Found duplicated data in dataset: {l}')
         return r
@@ -430,6 +454,7 @@ def __export_remote_functions():
         group_by_formula: bool,
         mode: str,
         sel_type: Optional[List[int]],
+        index_path: Optional[str] = None,
     ):
         register_data_types()
 
@@ -488,7 +513,14 @@ def __export_remote_functions():
         dataset_dirs = _write_dp_dataset(dp_system_list=dataset_collection, out_dir=dataset_dir, type_map=type_map)
         outlier_dirs = _write_dp_dataset(dp_system_list=outlier_collection, out_dir=outlier_dir, type_map=type_map)
 
-        return dataset_dirs, outlier_dirs
+        if index_path is not None:
+            written = dataset_dirs + outlier_dirs
+            index_artifacts(index_path, [a for a, _ in written],
+                            frames=[system.get_nframes() for _, system in written],
+                            formulas=[system.formula for _, system in written],
+                            natoms=[system.get_natoms() for _, system in written])
+
+        return [a for a, _ in dataset_dirs], [a for a, _ in outlier_dirs]
 
 
     def _write_dp_dataset_by_formula(dp_system_list: List[Tuple[ArtifactDict, dpdata.LabeledSystem]],
@@ -497,6 +529,7 @@ def __export_remote_functions():
         Write dp dataset that grouping by formula
         Use dpdata.MultipleSystems to merge systems with the same formula
         Use this when group by ancestor not works for you
+        Return the artifacts of the written data and their systems
         """
         if len(dp_system_list) == 0:
             return []
@@ -508,18 +541,28 @@ def __export_remote_functions():
 
         multi_systems.to_deepmd_npy(out_dir, type_map=type_map)  # type: ignore
 
-        return [ {
-            'url': os.path.join(out_dir, fname),
-            'format': DataFormat.DEEPMD_NPY,
-            'attrs': {},  # it is meaning less to set attrs in this case
-        } for fname in os.listdir(out_dir)]
+        # the sub dir of each system is named by its formula or its short name, depending on the version of dpdata,
+        # so the url is taken from the dirs that are actually written
+        written = set(os.listdir(out_dir))
+        results = []
+        for formula, system in multi_systems.systems.items():
+            name = next((n for n in (system.short_name, formula) if n in written), None)
+            if name is None:
+                raise RuntimeError(f'cannot find the data of {formula} in {out_dir}')
+            results.append(({
+                'url': os.path.join(out_dir, name),
+                'format': DataFormat.DEEPMD_NPY,
+                'attrs': {},  # it is meaning less to set attrs in this case
+            }, system))
+        return results
 
 
     def _write_dp_dataset_by_ancestor(dp_system_list: List[Tuple[ArtifactDict, dpdata.LabeledSystem]], out_dir: str, type_map: List[str]):
         """
         write dp dataset that grouping by ancestor
+        Return the artifacts of the written data and their systems
         """
-        output_dirs: List[ArtifactDict] = []
+        output_dirs: List[Tuple[ArtifactDict, dpdata.LabeledSystem]] = []
         for key, dp_system_group in groupby(dp_system_list, key=lambda x: x[0]['attrs']['ancestor']):
             dp_system_group = list(dp_system_group)
             if 0 == len(dp_system_group):
@@ -532,9 +575,9 @@ def __export_remote_functions():
                 dp_system += item[1]
             dp_system.to_deepmd_npy(group_out_dir, set_size=len(dp_system), type_map=type_map)  # type: ignore
             # inherit attrs key from input artifact
-            output_dirs.append({'url': group_out_dir,
-                                'format': DataFormat.DEEPMD_NPY,
-                                'attrs': {**dp_system_group[0][0]['attrs']}})  # type: ignore
+            output_dirs.append(({'url': group_out_dir,
+                                 'format': DataFormat.DEEPMD_NPY,
+                                 'attrs': {**dp_system_group[0][0]['attrs']}}, dp_system))  # type: ignore
         return output_dirs
 
 
@@ -1,7 +1,7 @@
 # This is a class to defined common interface
 
 from abc import abstractmethod, ABC
-from ai2_kit.core.artifact import Artifact, ArtifactMap
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactMap
 from ai2_kit.core.resource_manager import ResourceManager
 from typing import List, Literal
 from dataclasses import dataclass
@@ -18,30 +18,30 @@ class BaseCllContext:
 
 class ICllLabelOutput(ABC):
     @abstractmethod
-    def get_labeled_system_dataset(self) -> List[Artifact]:
+    def get_labeled_system_dataset(self) -> List[ArtifactRecord]:
         ...
 
 class ICllTrainOutput(ABC):
     @abstractmethod
-    def get_mlp_models(self) -> List[Artifact]:
+    def get_mlp_models(self) -> List[ArtifactRecord]:
         ...
 
     @abstractmethod
-    def get_training_dataset(self) -> List[Artifact]:
+    def get_training_dataset(self) -> List[ArtifactRecord]:
         ...
 
 class ICllExploreOutput(ABC):
     @abstractmethod
-    def get_model_devi_dataset(self) -> List[Artifact]:
+    def get_model_devi_dataset(self) -> List[ArtifactRecord]:
         ...
 
 class ICllSelectorOutput(ABC):
     @abstractmethod
-    def get_model_devi_dataset(self) -> List[Artifact]:
+    def get_model_devi_dataset(self) -> List[ArtifactRecord]:
         ...
 
     @abstractmethod
-    def get_new_explore_systems(self) -> List[Artifact]:
+    def get_new_explore_systems(self) -> List[ArtifactRecord]:
         ...
 
     @abstractmethod
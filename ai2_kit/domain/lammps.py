@@ -1,8 +1,8 @@
-from ai2_kit.core.script import BashTemplate, BashStep, BashScript
-from ai2_kit.core.artifact import Artifact, ArtifactDict
+from ai2_kit.core.script import BashTemplate, BashStep
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactDict
 from ai2_kit.core.log import get_logger
-from ai2_kit.core.job import gather_jobs
-from ai2_kit.core.util import list_split, dict_nested_get, dump_json, dump_text
+from ai2_kit.core.job import StepJobsConfig, run_bash_steps
+from ai2_kit.core.util import dict_nested_get, dump_json, dump_text
 from ai2_kit.core.pydantic import BaseModel
 
 from typing import List, Literal, Optional, Mapping, Sequence, Any
@@ -153,11 +153,19 @@ class CllLammpsInputConfig(BaseModel):
         assert var in self.explore_vars or var in self.broadcast_vars, msg
 
 
-class CllLammpsContextConfig(BaseModel):
+class CllLammpsContextConfig(StepJobsConfig):
     script_template: BashTemplate
     lammps_cmd: str = 'lmp'
-    concurrency: int = 5
     ignore_error: bool = False
+    parallelism: int = 1
+    """
+    Max number of tasks to run at the same time in one job,
+    set it to make use of all cores of the allocation when each task only needs a few cores.
+    """
+    cores_per_step: Optional[int] = None
+    """
+    Pin each running task to its own cores and set OMP_NUM_THREADS to this value.
+    """
 
 
 @dataclass
@@ -167,8 +175,8 @@ class CllLammpsInput:
     mass_map: List[float]
     mode: TRAINING_MODE
     preset_template: str
-    new_system_files: List[Artifact]
-    dp_models: Mapping[str, List[Artifact]]
+    new_system_files: List[ArtifactRecord]
+    dp_models: Mapping[str, List[ArtifactRecord]]
     dp_modifier: Optional[dict]
     dp_sel_type: Optional[List[int]]
 
@@ -180,9 +188,9 @@ class CllLammpsContext(BaseCllContext):
 
 @dataclass
 class GenericLammpsOutput(ICllExploreOutput):
-    model_devi_outputs: List[Artifact]
+    model_devi_outputs: List[ArtifactRecord]
 
-    def get_model_devi_dataset(self) -> List[Artifact]:
+    def get_model_devi_dataset(self) -> List[ArtifactRecord]:
         return self.model_devi_outputs
 
 
@@ -246,18 +254,10 @@ async def cll_lammps(input: CllLammpsInput, ctx: CllLammpsContext):
             cwd=task_dir['url'], cmd=cmd, checkpoint='lammps', exit_on_error=not ctx.config.ignore_error))
 
     # submit jobs by the number of concurrency
-    jobs = []
-    for i, steps_group in enumerate(list_split(steps, ctx.config.concurrency)):
-        if not steps_group:
-            continue
-        script = BashScript(
-            template=ctx.config.script_template,
-            steps=steps_group,
-        )
-        job = executor.submit(script.render(), cwd=tasks_dir)
-        jobs.append(job)
-
-    await gather_jobs(jobs, max_tries=2)
+    keys = [(a.get('natoms', 0), input.config.nsteps) for a in task_dirs]  # type: ignore
+    await run_bash_steps(executor, steps, keys, 'explore-lammps', template=ctx.config.script_template, cwd=tasks_dir,
+                         concurrency=ctx.config.concurrency, pilot=ctx.config.pilot,
+                         parallelism=ctx.config.parallelism, cores_per_step=ctx.config.cores_per_step, max_tries=2)
 
     # build outputs
     outputs = []
@@ -268,11 +268,11 @@ async def cll_lammps(input: CllLammpsInput, ctx: CllLammpsContext):
             # ini and fin states have different structures, so their lammps_dump_dir is different
             # their label method is different too, so we need to unpack `fep-ini` and `fep-fin` accordingly
             outputs += [
-                Artifact.of(**common, attrs={
+                ArtifactRecord(**common, attrs={
                     **task_dir['attrs'], 'model_devi_file': 'model_devi_ini.out', 'lammps_dump_dir': 'traj-ini',
                     **task_dir['attrs']['fep-ini'],
                 }),
-                Artifact.of(**common, attrs={
+                ArtifactRecord(**common, attrs={
                     **task_dir['attrs'], 'model_devi_file': 'model_devi_fin.out', 'lammps_dump_dir': 'traj-fin',
                     **task_dir['attrs']['fep-fin'],
                     'ancestor': task_dir['attrs']['ancestor'] + '-fin',  # only fin needs
@@ -283,11 +283,11 @@ async def cll_lammps(input: CllLammpsInput, ctx: CllLammpsContext):
             # ini and fin states have the same structure, so just use the default one,
             # but their label method is different, so we need to unpack `fep-ini` and `fep-fin` accordingly
             outputs += [
-                Artifact.of(**common, attrs={
+                ArtifactRecord(**common, attrs={
                     **task_dir['attrs'], 'model_devi_file': 'model_devi_ini.out',
                     **task_dir['attrs']['fep-ini'],
                 }),
-                Artifact.of(**common, attrs={
+                ArtifactRecord(**common, attrs={
                     **task_dir['attrs'], 'model_devi_file': 'model_devi_fin.out',
                     **task_dir['attrs']['fep-fin'],
                     'ancestor': task_dir['attrs']['ancestor'] + '-fin',  # only fin needs
@@ -295,7 +295,7 @@ async def cll_lammps(input: CllLammpsInput, ctx: CllLammpsContext):
             ]
         else:
             outputs += [
-                Artifact.of(**common, attrs={ **task_dir['attrs'] }),
+                ArtifactRecord(**common, attrs=task_dir['attrs']),
             ]
 
     return GenericLammpsOutput(model_devi_outputs=outputs)
@@ -499,10 +499,29 @@ def __export_remote_functions():
                                   **data_file['attrs'],
                                   'source': data_file['url'],
                                   'efield': lammps_vars.get('EFIELD'),
-                              }})  # type: ignore
+                              },
+                              'natoms': get_lammps_data_natoms(data_file['url']),  # for cost prediction
+                              })  # type: ignore
         return tasks_dir, task_dirs
 
 
+    def get_lammps_data_natoms(data_file: str) -> int:
+        """
+        get the number of atoms from the header of lammps data file, 0 is returned if not found
+        """
+        try:
+            with open(data_file, 'r') as f:
+                for i, line in enumerate(f):
+                    tokens = line.split()
+                    if len(tokens) == 2 and tokens[1] == 'atoms':
+                        return int(tokens[0])
+                    if i > 20:  # the header should be short
+                        break
+        except (OSError, UnicodeDecodeError, ValueError):
+            pass
+        return 0
+
+
     def get_types_template_vars(type_map: List[str], mass_map: List[float],
                                 type_alias: Mapping[str, List[str]], sel_type: Optional[List[int]]):
         """
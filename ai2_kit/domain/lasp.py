@@ -1,8 +1,8 @@
-from ai2_kit.core.script import BashTemplate, BashStep, BashScript
-from ai2_kit.core.artifact import Artifact, ArtifactDict
+from ai2_kit.core.script import BashTemplate, BashStep
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactDict
 from ai2_kit.core.log import get_logger
-from ai2_kit.core.job import gather_jobs
-from ai2_kit.core.util import list_split, merge_dict
+from ai2_kit.core.job import StepJobsConfig, run_bash_steps
+from ai2_kit.core.util import merge_dict
 from ai2_kit.core.pydantic import BaseModel
 
 from typing import List, Optional
@@ -41,10 +41,9 @@ class CllLaspInputConfig(BaseModel):
     """
 
 
-class CllLaspContextConfig(BaseModel):
+class CllLaspContextConfig(StepJobsConfig):
     lasp_cmd: str = 'lasp'
     script_template: BashTemplate
-    concurrency: int = 5
 
 
 @dataclass
@@ -52,8 +51,8 @@ class CllLaspInput:
     config: CllLaspInputConfig
     type_map: List[str]
     mass_map: List[float]
-    models: List[Artifact]
-    new_system_files: List[Artifact]
+    models: List[ArtifactRecord]
+    new_system_files: List[ArtifactRecord]
 
 
 @dataclass
@@ -63,9 +62,9 @@ class CllLaspContext(BaseCllContext):
 
 @dataclass
 class CllLaspOutput(ICllExploreOutput):
-    output_dirs: List[Artifact]
+    output_dirs: List[ArtifactRecord]
 
-    def get_model_devi_dataset(self) -> List[Artifact]:
+    def get_model_devi_dataset(self) -> List[ArtifactRecord]:
         return self.output_dirs
 
 
@@ -111,23 +110,15 @@ async def cll_lasp(input: CllLaspInput, ctx: CllLaspContext):
         steps.append(BashStep(cwd=task_dir['url'], cmd=lasp_cmd, checkpoint='lasp'))
 
     # submit jobs by the number of concurrency
-    jobs = []
-    for i, steps_group in enumerate(list_split(steps, ctx.config.concurrency)):
-        if not steps_group:
-            continue
-        script = BashScript(
-            template=ctx.config.script_template,
-            steps=steps_group,
-        )
-        job = executor.submit(script.render(), cwd=tasks_dir)
-        jobs.append(job)
-    await gather_jobs(jobs, max_tries=2)
+    keys = [(a.get('natoms', 0), lasp_in_data.get('SSW.SSWsteps', 1)) for a in task_dirs]  # type: ignore
+    await run_bash_steps(executor, steps, keys, 'explore-lasp', template=ctx.config.script_template, cwd=tasks_dir,
+                         concurrency=ctx.config.concurrency, pilot=ctx.config.pilot, max_tries=2)
 
     # process outputs
     executor.run_python_fn(process_lasp_outputs)(task_dirs=[a['url'] for a in task_dirs])
 
     output_dirs = [
-        Artifact.of(
+        ArtifactRecord(
             url=task_dir['url'],
             executor=executor.name,
             format=DataFormat.LASP_LAMMPS_OUT_DIR,
@@ -188,7 +179,9 @@ def __export_remote_functions():
                 raise ValueError('At least one potential should be specified.')
             # the `source` field is required as model_devi will use it to update init structures
             task_dirs.append({'url': task_dir,
-                              'attrs': {**artifact['attrs'], 'source': artifact['url']}})
+                              'attrs': {**artifact['attrs'], 'source': artifact['url']},
+                              'natoms': len(atoms),  # for cost prediction
+                              })  # type: ignore
 
             i += 1  # TODO: refactor this
         return task_dirs
@@ -1,5 +1,5 @@
 from asaplib.data.xyz import ASAPXYZ
-from ai2_kit.core.artifact import Artifact, ArtifactDict
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactDict
 from ai2_kit.core.log import get_logger
 from ai2_kit.core.util import dump_json, flush_stdio, limit
 from ai2_kit.core.pydantic import BaseModel
@@ -74,9 +74,9 @@ class CllModelDevSelectorContext(BaseCllContext):
 
 @dataclass
 class CllModelDeviSelectorOutput(ICllSelectorOutput):
-    candidates: List[Artifact]
+    candidates: List[ArtifactRecord]
     passing_rate: float
-    new_explore_systems: List[Artifact]
+    new_explore_systems: List[ArtifactRecord]
 
     def get_model_devi_dataset(self):
         return self.candidates
@@ -84,18 +84,18 @@ class CllModelDeviSelectorOutput(ICllSelectorOutput):
     def get_passing_rate(self) -> float:
         return self.passing_rate
 
-    def get_new_explore_systems(self) -> List[Artifact]:
+    def get_new_explore_systems(self) -> List[ArtifactRecord]:
         return self.new_explore_systems
 
 
 @dataclass
 class CllModelDeviSelectorInput:
     config: CllModelDeviSelectorInputConfig
-    model_devi_data: List[Artifact]
+    model_devi_data: List[ArtifactRecord]
     model_devi_file: str
     type_map: List[str]
 
-    def set_model_devi_dataset(self, data: List[Artifact]):
+    def set_model_devi_dataset(self, data: List[ArtifactRecord]):
         self.model_devi_data = data
 
 
@@ -160,8 +160,8 @@ async def cll_model_devi_selector(input: CllModelDeviSelectorInput, ctx: CllMode
         )
 
     return CllModelDeviSelectorOutput(
-        candidates=[Artifact.of(**a) for a in candidates],
-        new_explore_systems=[Artifact.of(**a) for a in new_systems],
+        candidates=[ArtifactRecord(**a) for a in candidates],
+        new_explore_systems=[ArtifactRecord(**a) for a in new_systems],
         passing_rate=total_good / total,
     )
 
@@ -1,7 +1,7 @@
-from ai2_kit.core.artifact import Artifact, ArtifactDict
-from ai2_kit.core.script import BashScript, BashStep, BashTemplate
-from ai2_kit.core.job import gather_jobs
-from ai2_kit.core.util import dict_nested_get, list_split, list_sample
+from ai2_kit.core.artifact import ArtifactRecord, ArtifactDict
+from ai2_kit.core.script import BashStep, BashTemplate
+from ai2_kit.core.job import StepJobsConfig, run_bash_steps
+from ai2_kit.core.util import dict_nested_get, list_sample
 from ai2_kit.core.log import get_logger
 from ai2_kit.core.pydantic import BaseModel
 
@@ -31,15 +31,14 @@ class CllVaspInputConfig(BaseModel):
     limit: int = 50
     limit_method: Literal["even", "random", "truncate"] = "even"
 
-class CllVaspContextConfig(BaseModel):
+class CllVaspContextConfig(StepJobsConfig):
     script_template: BashTemplate
     vasp_cmd: str = 'vasp_std'
-    concurrency: int = 5
 
 @dataclass
 class CllVaspInput:
     config: CllVaspInputConfig
-    system_files: List[Artifact]
+    system_files: List[ArtifactRecord]
     type_map: List[str]
     initiated: bool = False
 
@@ -51,7 +50,7 @@ class CllVaspContext(BaseCllContext):
 
 @dataclass
 class GenericVaspOutput(ICllLabelOutput):
-    vasp_outputs: List[Artifact]
+    vasp_outputs: List[ArtifactRecord]
 
     def get_labeled_system_dataset(self):
         return self.vasp_outputs
@@ -125,19 +124,11 @@ async def cll_vasp(input: CllVaspInput, ctx: CllVaspContext) -> GenericVaspOutpu
         ))
 
     # submit tasks and wait for completion
-    jobs = []
-    for i, steps_group in enumerate(list_split(steps, ctx.config.concurrency)):
-        if not steps_group:
-            continue
-        script = BashScript(
-            template=ctx.config.script_template,
-            steps=steps_group,
-        )
-        job = executor.submit(script.render(), cwd=tasks_dir)
-        jobs.append(job)
-    jobs = await gather_jobs(jobs, max_tries=2)
-
-    vasp_outputs = [Artifact.of(
+    keys = [(a.get('natoms', 0), 1) for a in vasp_task_dirs]  # type: ignore
+    await run_bash_steps(executor, steps, keys, 'label-vasp', template=ctx.config.script_template, cwd=tasks_dir,
+                         concurrency=ctx.config.concurrency, pilot=ctx.config.pilot, max_tries=2)
+
+    vasp_outputs = [ArtifactRecord(
         url=a['url'],
         format=DataFormat.VASP_OUTPUT_DIR,
         executor=executor.name,
@@ -210,7 +201,8 @@ def __export_remote_functions():
             task_dirs.append({
                 'url': task_dir,
                 'attrs': file['attrs'],
-            })
+                'natoms': len(atoms),  # for cost prediction
+            })  # type: ignore
 
         return task_dirs
 
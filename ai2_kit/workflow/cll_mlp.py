@@ -4,6 +4,8 @@ from ai2_kit.core.log import get_logger
 from ai2_kit.core.util import load_yaml_files, merge_dict
 from ai2_kit.core.resource_manager import ResourceManager
 from ai2_kit.core.checkpoint import set_checkpoint_file, apply_checkpoint
+from ai2_kit.core.trace import enable_trace, dump_trace
+from ai2_kit.core.runtime import set_runtime_db_file
 from ai2_kit.core.pydantic import BaseModel
 from ai2_kit.domain import (
     deepmd,
@@ -94,7 +96,12 @@ class CllWorkflowConfig(BaseModel):
 def run_workflow(*config_files,
                  executor: Optional[str] = None,
                  path_prefix: Optional[str] = None,
-                 checkpoint: Optional[str] = None):
+                 checkpoint: Optional[str] = None,
+                 trace: Optional[str] = None,
+                 runtime_db: Optional[str] = None,
+                 checkpoint_input_hash: bool = False,
+                 max_memo_entries: Optional[int] = None,
+                 max_memo_size: Optional[int] = None):
     """
     Run Closed-Loop Learning (CLL) workflow to train Machine Learning Potential (MLP) models.
 
@@ -103,9 +110,19 @@ def run_workflow(*config_files,
         executor: name of executor, should be defined in config `executors` section
         path_prefix: path prefix for output
         checkpoint: checkpoint file
+        trace: path to write the time spent in executor operations, in Chrome trace format
+        runtime_db: path to keep the runtime of tasks, which is used to balance tasks across jobs
+        checkpoint_input_hash: reuse checkpoint entries only when the inputs of the steps are the same
+        max_memo_entries: max number of checkpoint entries created by input hash, the least recently used ones are evicted
+        max_memo_size: max total size in bytes of checkpoint entries created by input hash
     """
     if checkpoint is not None:
-        set_checkpoint_file(checkpoint)
+        set_checkpoint_file(checkpoint, input_hash=checkpoint_input_hash,
+                            max_memo_entries=max_memo_entries, max_memo_size=max_memo_size)
+    if trace is not None:
+        enable_trace()
+    if runtime_db is not None:
+        set_runtime_db_file(runtime_db)
 
     config_data = load_yaml_files(*config_files)
     config = CllWorkflowConfig.parse_obj(config_data)
@@ -121,7 +138,12 @@ def run_workflow(*config_files,
         artifacts=config.artifacts,
         default_executor=executor,
     )
-    return asyncio.run(cll_mlp_training_workflow(config, resource_manager, executor, path_prefix))
+    try:
+        return asyncio.run(cll_mlp_training_workflow(config, resource_manager, executor, path_prefix))
+    finally:
+        resource_manager.close()
+        if trace is not None:
+            dump_trace(trace)
 
 
 async def cll_mlp_training_workflow(config: CllWorkflowConfig,
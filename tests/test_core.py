@@ -1,9 +1,21 @@
 from pydantic import BaseModel
-from ai2_kit.core.executor import BaseExecutorConfig, ExecutorManager, Slurm, Lsf, SshConnector, HpcExecutor
+from ai2_kit.core.executor import BaseExecutorConfig, ExecutorManager, Slurm, Lsf, SshConnector, LocalConnector, HpcExecutor, PythonWorker
+from ai2_kit.core.queue_system import QueueSystemConfig, JobLimiter, Local
+from ai2_kit.core.executor import fn_to_script, fn_to_iter_script, _load_python_result, _iter_frames
 from ai2_kit.core.util import load_yaml_file
-from ai2_kit.core.artifact import Artifact
-from typing import Dict
+from ai2_kit.core.artifact import Artifact, ArtifactRecord
+from ai2_kit.core.resource_manager import ResourceManager
+from ai2_kit.core.artifact_index import get_index_path, index_artifacts, lookup_artifacts
+from ai2_kit.core.job import JobState, gather_jobs, submit_step_jobs, gather_step_jobs, run_bash_steps
+from ai2_kit.core.pilot import run_pilot_jobs
+from ai2_kit.core.runtime import COSTS_FILE
+from ai2_kit.core.checkpoint import open_checkpoint_store, SqliteCheckpointStore, PickleCheckpointStore, FnInfo, hash_inputs
+from ai2_kit.core.script import BashStep, BashScript
+from typing import Dict, Optional
 from unittest import TestCase
+import asyncio
+import base64
+import os
 from pathlib import Path
 
 
@@ -31,7 +43,31 @@ class TestConfig(TestCase):
 class TestExecutor(TestCase):
 
     def setUp(self):
+        import tempfile, io
+        from unittest import mock
         self.config_file = Path(__file__).parent / 'all-in-one.yaml'
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.work_dir = tmp_dir.name
+        # invoke mirrors stdin, which is not readable when it is captured by pytest
+        patcher = mock.patch('sys.stdin', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _new_executor(self, work_dir: str = '', name: str = '', upload_cache: bool = False,
+                      config: Optional[dict] = None, **queue_system) -> HpcExecutor:
+        """
+        Create and init an executor of local queue system, in the temporary work_dir by default.
+        """
+        executor = HpcExecutor.from_config({
+            'work_dir': work_dir or self.work_dir,
+            'upload_cache': upload_cache,
+            'queue_system': queue_system or {'local': {}},
+            **(config or {}),
+        }, name)
+        executor.init()
+        self.addCleanup(executor.close)
+        return executor
 
     def test_executor_manager(self):
         data = load_yaml_file(self.config_file)
@@ -49,6 +85,457 @@ class TestExecutor(TestCase):
         self.assertIsInstance(executor.queue_system, Lsf)
         self.assertIsInstance(executor.connector, SshConnector)
 
+    def test_local_queue_system(self):
+        work_dir = self.work_dir
+        executor = self._new_executor(local={'slots': 2, 'polling_interval': 2})
+        ok_job = executor.submit('#LOCAL -c 2\necho ok', cwd=os.path.join(work_dir, 'ok'))
+        bad_job = executor.submit('exit 1', cwd=os.path.join(work_dir, 'bad'))
+        self.assertIs(ok_job.result(timeout=30), JobState.COMPLETED)
+        self.assertIs(bad_job.result(timeout=30), JobState.FAILED)
+
+        # all the jobs are waited by the shared poller
+        jobs = [executor.submit(f'echo {i}', cwd=os.path.join(work_dir, 'many')) for i in range(4)]
+        states = asyncio.run(gather_jobs(jobs, timeout=30))
+        self.assertEqual(states, [JobState.COMPLETED] * 4)
+
+    def test_job_finished_once(self):
+        from unittest import mock
+        executor = self._new_executor(local={'polling_interval': 1})
+        job = executor.submit('echo ok', cwd=self.work_dir)
+        with mock.patch('ai2_kit.core.queue_system.add_async_span') as add_async_span:
+            async def wait():
+                # like the watcher of the job limiter and the caller waiting for the same job
+                return await asyncio.gather(job.result_async(30), job.result_async(30))
+            self.assertEqual(asyncio.run(wait()), [JobState.COMPLETED] * 2)
+            self.assertIs(job.get_job_state(), JobState.COMPLETED)
+            add_async_span.assert_called_once()
+
+    def test_submit_array_recovery(self):
+        from unittest import mock
+        from ai2_kit.core.queue_system import Local
+        work_dir = self.work_dir
+        flaky = f'[ -f {work_dir}/flaky ] || {{ touch {work_dir}/flaky; exit 1; }}'
+        scripts = ['echo 0', 'echo 1', flaky]
+        jobs = self._new_executor(local={'slots': 2, 'polling_interval': 1}).submit_array(scripts, cwd=work_dir)
+        states = asyncio.run(gather_jobs(jobs, timeout=30, raise_error=False))
+        self.assertEqual(states, [JobState.COMPLETED, JobState.COMPLETED, JobState.FAILED])
+
+        # restart: the states of all the elements are recovered with one poll, only the failed one is submitted again
+        executor = self._new_executor(local={'slots': 2, 'polling_interval': 1})
+        with mock.patch.object(Local, '_poll_job_states', autospec=True, side_effect=Local._poll_job_states) as poll, \
+                mock.patch.object(Local, '_submit_script', autospec=True, side_effect=Local._submit_script) as submit:
+            new_jobs = executor.submit_array(scripts, cwd=work_dir)
+            poll.assert_called_once()
+            submit.assert_called_once()
+        self.assertEqual([job._job_id for job in new_jobs[:2]], [job._job_id for job in jobs[:2]])
+        self.assertEqual(asyncio.run(gather_jobs(new_jobs, timeout=30)), [JobState.COMPLETED] * 3)
+
+    def test_job_limit(self):
+        work_dir = self.work_dir
+        executor = self._new_executor(local={'slots': 4, 'polling_interval': 1},
+                                      job_limit={'max_jobs': 2, 'check_interval': 0.2})
+        script = 'echo "$(date +%s.%N) 1" >> {0}/log; sleep 1; echo "$(date +%s.%N) -1" >> {0}/log'
+
+        async def run():
+            jobs = await asyncio.gather(*[executor.submit_async(script.format(work_dir) + f' # {i}', cwd=work_dir)
+                                          for i in range(4)])
+            return await gather_jobs(list(jobs), timeout=30)
+
+        self.assertEqual(asyncio.run(run()), [JobState.COMPLETED] * 4)
+        with open(os.path.join(work_dir, 'log')) as f:
+            events = sorted((float(t), int(d)) for t, d in map(str.split, f))
+        running = [sum(d for _, d in events[:i + 1]) for i in range(len(events))]
+        self.assertEqual(max(running), 2)
+
+    def test_job_limit_array(self):
+        from unittest import mock
+        work_dir = self.work_dir
+        executor = self._new_executor(local={'slots': 4, 'polling_interval': 1},
+                                      job_limit={'max_jobs': 2, 'check_interval': 0.2})
+        script = 'echo "$(date +%s.%N) 1" >> {0}/log; sleep 1; echo "$(date +%s.%N) -1" >> {0}/log'
+        scripts = [script.format(work_dir) + f' # {i}' for i in range(5)]
+
+        async def run():
+            jobs = await executor.submit_array_async(scripts, cwd=work_dir)
+            return await gather_jobs(jobs, timeout=30)
+
+        with mock.patch.object(Local, 'submit_array', autospec=True, side_effect=Local.submit_array) as submit_array:
+            self.assertEqual(asyncio.run(run()), [JobState.COMPLETED] * 5)
+        # the array is submitted in pieces that fit the limit
+        sizes = [len(call.args[1]) for call in submit_array.call_args_list]
+        self.assertGreater(len(sizes), 1)
+        self.assertEqual(sum(sizes), 5)
+        self.assertLessEqual(max(sizes), 2)
+        with open(os.path.join(work_dir, 'log')) as f:
+            events = sorted((float(t), int(d)) for t, d in map(str.split, f))
+        running = [sum(d for _, d in events[:i + 1]) for i in range(len(events))]
+        self.assertEqual(max(running), 2)
+
+        # only a single job is allowed to exceed the limits when nothing is running
+        limiter = JobLimiter(QueueSystemConfig.JobLimit(max_cores=4))
+        self.assertEqual(limiter._get_room([8, 8], {}), 1)
+        self.assertEqual(limiter._get_room([2, 2, 2], {}), 2)
+        self.assertEqual(asyncio.run(limiter.acquire([2], dict)), 1)
+        limiter.bind([2], ['1'])
+        self.assertEqual(limiter._get_room([8], {}), 0)
+
+    def test_gather_step_jobs(self):
+        work_dir = self.work_dir
+        executor = self._new_executor(local={'slots': 2, 'polling_interval': 1})
+        flaky = f'[ -f {work_dir}/flaky ] || {{ touch {work_dir}/flaky; exit 1; }}'
+        steps = [BashStep(cmd='echo 0 >> runs', cwd=work_dir, checkpoint='step-0'),
+                 BashStep(cmd=flaky, cwd=work_dir, checkpoint='step-1'),
+                 BashStep(cmd='echo 2 >> runs', cwd=work_dir, checkpoint='step-2')]
+        render = lambda steps: BashScript(template=None, steps=steps).render()
+        jobs = [executor.submit(render(steps), cwd=work_dir)]
+        asyncio.run(gather_step_jobs(executor, jobs, [steps], render, cwd=work_dir, max_tries=2))
+        # the finished step is not run again
+        with open(os.path.join(work_dir, 'runs')) as f:
+            self.assertEqual(f.read().split(), ['0', '2'])
+
+        # the step after the bad one is never started, the status left by an earlier run is not charged
+        bad_steps = [BashStep(cmd='exit 1', cwd=os.path.join(work_dir, 'bad'), checkpoint='step'),
+                     BashStep(cmd='echo ok', cwd=os.path.join(work_dir, 'next'), checkpoint='step')]
+        for step in bad_steps:
+            os.makedirs(step.cwd)
+        Path(work_dir, 'next', 'step.status').write_text('failed 1')
+
+        async def run_bad_steps():
+            jobs = await submit_step_jobs(executor, [bad_steps], render, cwd=work_dir)
+            await gather_step_jobs(executor, jobs, [bad_steps], render, cwd=work_dir, max_tries=2)
+        with self.assertRaises(RuntimeError) as cm:
+            asyncio.run(run_bad_steps())
+        self.assertIn('1 steps failed', str(cm.exception))
+        self.assertNotIn('next', str(cm.exception))
+
+    def test_run_bash_steps(self):
+        executor = self._new_executor(local={'slots': 2, 'polling_interval': 1})
+        for pilot in (False, True):
+            tasks_dir = os.path.join(self.work_dir, f'pilot-{pilot}')
+            steps = [BashStep(cmd=f'echo {i} > out', cwd=os.path.join(tasks_dir, str(i)), checkpoint='step')
+                     for i in range(4)]
+            for step in steps:
+                os.makedirs(step.cwd)  # type: ignore
+            keys = [(i + 1, 1) for i in range(4)]
+            asyncio.run(run_bash_steps(executor, steps, keys, 'test', template=None, cwd=tasks_dir,
+                                       concurrency=2, pilot=pilot))
+            for i in range(4):
+                self.assertEqual(Path(tasks_dir, str(i), 'out').read_text().strip(), str(i))
+            self.assertTrue(os.path.exists(os.path.join(tasks_dir, COSTS_FILE)))
+
+    def test_run_pilot_jobs(self):
+        work_dir = self.work_dir
+        executor = self._new_executor(local={'slots': 2, 'polling_interval': 1})
+        steps = [BashStep(cmd=f'echo {i} > out', cwd=os.path.join(work_dir, str(i)), checkpoint='step')
+                 for i in range(5)]
+        for i in range(5):
+            os.makedirs(os.path.join(work_dir, str(i)))
+        # fail at the first time, so that it will be claimed again in the next round
+        steps.append(BashStep(cmd=f'[ -f {work_dir}/flaky ] || {{ touch {work_dir}/flaky; exit 1; }}'))
+        asyncio.run(run_pilot_jobs(executor, steps, template=None, cwd=work_dir, pilots=2))
+        for i in range(5):
+            self.assertTrue(os.path.exists(os.path.join(work_dir, str(i), 'step.checkpoint')))
+        queue_dir = os.path.join(work_dir, 'pilot-queue')
+        self.assertIn('0.done', os.listdir(queue_dir))
+
+        # the queue is reset when the steps are changed, as the states are indexed by the order of steps
+        steps.append(BashStep(cmd=f'echo new > {work_dir}/new'))
+        asyncio.run(run_pilot_jobs(executor, steps[::-1], template=None, cwd=work_dir, pilots=2))
+        self.assertEqual(Path(work_dir, 'new').read_text().strip(), 'new')
+        self.assertEqual(sorted(f for f in os.listdir(queue_dir) if f.endswith('.done')),
+                         [f'{i}.done' for i in range(len(steps))])
+
+    def test_python_worker_pool(self):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        executor = self._new_executor(config={'python_worker': True, 'python_workers': 2})
+        fn = executor.run_python_fn(lambda t: time.sleep(t) or os.getpid())
+        fn(0)  # warm up
+        start = time.time()
+        with ThreadPoolExecutor(2) as pool:
+            pids = list(pool.map(fn, [1, 1]))
+        # the calls from different threads are served by different workers at the same time
+        self.assertLess(time.time() - start, 1.8)
+        self.assertEqual(len(set(pids)), 2)
+        executor.close()
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                for _ in range(50):
+                    os.kill(pid, 0)
+                    time.sleep(0.1)
+
+    def test_run_python_iter(self):
+        import glob
+
+        def gen(n):
+            for i in range(n):
+                yield i
+            raise ValueError('end')
+
+        executor = self._new_executor()
+        leftovers = lambda: glob.glob(os.path.join(executor.tmp_dir, 'run_python_iter_*'))
+        it = executor.run_python_iter(gen)(3)
+        self.assertEqual(next(it), 0)
+        # the temporary files are removed when the consumer stops early
+        it.close()
+        self.assertEqual(leftovers(), [])
+        # but the log is kept when the remote function fails
+        with self.assertRaises(RuntimeError):
+            list(executor.run_python_iter(gen)(3))
+        self.assertEqual([os.path.splitext(p)[1] for p in leftovers()], ['.log'])
+
+    def test_upload_cache(self):
+        from unittest import mock
+        data_dir = os.path.join(self.work_dir, 'data')
+        os.makedirs(data_dir)
+        for name in ['a.xyz', 'b.xyz']:
+            Path(data_dir, name).write_text('same')
+        with mock.patch.object(HpcExecutor, 'is_local', new_callable=mock.PropertyMock, return_value=False):
+            executor = self._new_executor(os.path.join(self.work_dir, 'hpc'), upload_cache=True)
+            run = executor.run
+            # pretend the data is not in the store yet, like it is uploaded by others at the same time
+            with mock.patch.object(executor, 'run', side_effect=lambda cmd, **kwargs: run(
+                    'false' if cmd.startswith('test -e') else cmd, **kwargs)):
+                for i, name in enumerate(['a.xyz', 'b.xyz', 'a.xyz']):
+                    artifact = executor.upload(Artifact.of(url=os.path.join(data_dir, name)),
+                                               os.path.join(self.work_dir, 'hpc', f'task-{i}'))
+                    self.assertEqual(Path(artifact.url).read_text(), 'same')
+        # the data with the same content is stored only once, and no staging data is left
+        self.assertEqual(len(os.listdir(os.path.join(self.work_dir, 'hpc', '.cas'))), 1)
+
+    def test_transfer_from(self):
+        from unittest import mock
+        src_dir, dst_dir = os.path.join(self.work_dir, 'storage'), os.path.join(self.work_dir, 'hpc')
+        with mock.patch.object(HpcExecutor, 'is_local', new_callable=mock.PropertyMock, return_value=False):
+            src, dst = self._new_executor(src_dir, 'storage'), self._new_executor(dst_dir, 'hpc')
+            data_dir = os.path.join(src_dir, 'data')
+            os.makedirs(os.path.join(data_dir, 'sys-1'))
+            Path(data_dir, 'sys-1', 'type.raw').write_text('0 1')
+            Path(data_dir, 'a.xyz').write_text('1')
+
+            paths = dst.transfer_from(src, [os.path.join(data_dir, 'sys-1'), os.path.join(data_dir, 'a.xyz')])
+            self.assertEqual(Path(paths[0], 'type.raw').read_text(), '0 1')
+            self.assertEqual(os.path.basename(paths[1]), 'a.xyz')
+            self.assertEqual(Path(paths[1]).read_text(), '1')
+            # the data with the same content won't be transferred again
+            with mock.patch.object(HpcExecutor, '_receive_archive') as receive_archive:
+                self.assertEqual(dst.transfer_from(src, [os.path.join(data_dir, 'a.xyz')]), paths[1:])
+                receive_archive.assert_not_called()
+            # receiving the data that is in the store already is fine
+            cas_dir = os.path.join(dst_dir, '.cas')
+            entries = sorted(os.listdir(cas_dir))
+            dst._receive_archive(src, {h: os.path.join(data_dir, 'a.xyz') for h in entries[:1]}, cas_dir)
+            self.assertEqual(sorted(os.listdir(cas_dir)), entries)
+
+
+def _make_tree(base_dir: str, n: int = 3):
+    for i in range(n):
+        os.makedirs(os.path.join(base_dir, f'dir-{i}', 'sub'))
+        Path(base_dir, f'dir-{i}', 'sub', 'data.txt').write_text(f'data {i}')
+        Path(base_dir, f'dir-{i}', 'model_devi.out').write_text(f'devi {i}')
+    Path(base_dir, 'input.txt').write_text('input')
+
+
+def _read_tree(base_dir: str) -> Dict[str, str]:
+    return {os.path.relpath(os.path.join(root, f), base_dir): Path(root, f).read_text()
+            for root, _dirs, files in os.walk(base_dir, followlinks=True) for f in files}
+
+
+class TestConnector(TestCase):
+
+    def setUp(self):
+        import io
+        from unittest import mock
+        # invoke can't read the stdin captured by pytest
+        patcher = mock.patch('sys.stdin', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_upload_download(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as work_dir:
+            data_dir = os.path.join(work_dir, 'data')
+            _make_tree(data_dir)
+            connector = LocalConnector()
+            remote_path = connector.upload(data_dir, os.path.join(work_dir, 'remote'))
+            local_path = connector.download(remote_path, os.path.join(work_dir, 'local'))
+            self.assertEqual(_read_tree(local_path), _read_tree(data_dir))
+
+    def test_archive(self):
+        import tempfile, importlib.util
+        compress_modes = [None, 'gz']
+        if importlib.util.find_spec('zstandard') is not None:
+            compress_modes.append('zstd')
+        for compress in compress_modes:
+            with tempfile.TemporaryDirectory() as work_dir:
+                data_dir = os.path.join(work_dir, 'data')
+                _make_tree(data_dir)
+                connector = LocalConnector()
+                remote_path = connector.upload_archive(data_dir, os.path.join(work_dir, 'remote'), compress=compress)
+                self.assertEqual(_read_tree(remote_path), _read_tree(data_dir), compress)
+                local_path = connector.download_archive(remote_path, os.path.join(work_dir, 'local'), compress=compress)
+                self.assertEqual(_read_tree(local_path), _read_tree(data_dir), compress)
+
+                # filters are applied on both directions
+                remote_path = connector.upload_archive(data_dir, os.path.join(work_dir, 'remote-filtered'), compress=compress,
+                                                       includes=['dir-*'], excludes=['*/sub/*'])
+                self.assertEqual(sorted(_read_tree(remote_path)), [f'dir-{i}/model_devi.out' for i in range(3)])
+                local_path = connector.download_archive(data_dir, os.path.join(work_dir, 'local-filtered'), compress=compress,
+                                                        includes=['*/model_devi.out', '*.txt'], excludes=['dir-1/*'])
+                self.assertEqual(sorted(_read_tree(local_path)), [
+                    'dir-0/model_devi.out', 'dir-0/sub/data.txt', 'dir-2/model_devi.out', 'dir-2/sub/data.txt', 'input.txt'])
+
+    def test_archive_filters(self):
+        import tempfile, subprocess, shutil
+        from unittest import mock
+        from ai2_kit.core.connector import PipeProcess
+        with tempfile.TemporaryDirectory() as work_dir:
+            data_dir = os.path.join(work_dir, 'data')
+            _make_tree(data_dir)
+            Path(data_dir, 'dir-0', 'sub', 'deep').mkdir()
+            Path(data_dir, 'dir-0', 'sub', 'deep', 'data.txt').write_text('deep')
+            connector = LocalConnector()
+
+            def popen_sh(cmd):
+                # the login shell of a remote host may not be bash
+                proc = subprocess.Popen(cmd, shell=True, executable='/bin/sh', stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                return PipeProcess(stdin=proc.stdin, stdout=proc.stdout, wait=proc.wait,  # type: ignore
+                                   close=lambda: (proc.stdout.close(), proc.wait()))  # type: ignore
+
+            with mock.patch.object(connector, 'popen', popen_sh):
+                for includes, excludes, expected in [
+                    (['*/sub/*.txt'], ['dir-1/*'], ['dir-0/sub/data.txt', 'dir-0/sub/deep/data.txt', 'dir-2/sub/data.txt']),
+                    (['dir-0/*'], ['*/deep/*'], ['dir-0/model_devi.out', 'dir-0/sub/data.txt']),
+                ]:
+                    uploaded = connector.upload_archive(data_dir, os.path.join(work_dir, 'remote'),
+                                                        includes=includes, excludes=excludes)
+                    downloaded = connector.download_archive(data_dir, os.path.join(work_dir, 'local'),
+                                                            includes=includes, excludes=excludes)
+                    # both directions share the same matching rule
+                    self.assertEqual(sorted(_read_tree(uploaded)), expected)
+                    self.assertEqual(sorted(_read_tree(downloaded)), expected)
+                    shutil.rmtree(uploaded)
+                    shutil.rmtree(downloaded)
+
+    def test_put_dir(self):
+        import tempfile, shutil
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as work_dir:
+            data_dir = os.path.join(work_dir, 'data')
+            # the paths of so many dirs exceed the size limit of one command line argument
+            _make_tree(data_dir, n=2000)
+            # run the commands and transfer files locally instead of over ssh
+            connector = SshConnector(mock.MagicMock())
+            connector.popen = LocalConnector().popen  # type: ignore
+            connector.put = lambda local, remote: shutil.copy(local, remote)  # type: ignore
+            connector.put_dir(data_dir, os.path.join(work_dir, 'remote'))
+            self.assertEqual(_read_tree(os.path.join(work_dir, 'remote')), _read_tree(data_dir))
+
+    def test_open_pool_connections(self):
+        import threading, time
+        from unittest import mock
+        from concurrent.futures import ThreadPoolExecutor
+        opened = []
+
+        def new_connection(**kwargs):
+            connection = mock.MagicMock(is_connected=False)
+            def open():
+                # the shared gateway is opened by each connection, they must not do it at the same time
+                opened.append(connector._pool_lock.locked())
+                time.sleep(0.01)
+                connection.is_connected = True
+            connection.open.side_effect = open
+            return connection
+
+        with mock.patch('ai2_kit.core.connector.Connection', side_effect=new_connection):
+            connector = SshConnector(new_connection(), max_connections=4)
+            barrier = threading.Barrier(4)
+
+            def borrow(_):
+                with connector._borrow():
+                    barrier.wait(timeout=5)
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(borrow, range(4)))
+        self.assertEqual(opened, [True] * 4)
+
+    def test_glob_many(self):
+        import tempfile
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as work_dir:
+            _make_tree(work_dir, n=3)
+            connector = SshConnector(mock.MagicMock())
+            connector.popen = LocalConnector().popen  # type: ignore
+            # the patterns are too large to be sent as one command line argument
+            patterns = [os.path.join(work_dir, f'dir-{i % 4}', '*.out') for i in range(50_000)]
+            paths_list = connector.glob_many(patterns)
+            self.assertEqual(len(paths_list), len(patterns))
+            self.assertEqual(paths_list[:4], [[os.path.join(work_dir, f'dir-{i}', 'model_devi.out')] for i in range(3)] + [[]])
+
+
+def _set_checkpoints(path, prefix, n):
+    store = open_checkpoint_store(path)
+    for i in range(n):
+        store.set(f'{prefix}/{i}', {'return': i, 'is_awaitable': False, 'info': {'fn_name': 'f', 'call_site': ''}})
+
+
+class TestCheckpoint(TestCase):
+
+    def test_checkpoint_store(self):
+        import tempfile, cloudpickle
+        entry = {'return': [1, 2], 'is_awaitable': False, 'info': {'fn_name': 'f', 'call_site': 'a.py:1'}}
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, 'test.ckpt')
+            store = open_checkpoint_store(path)
+            self.assertIsInstance(store, SqliteCheckpointStore)
+            store.set('iters-000/a', entry)
+            store.set('iters-000/b', entry)
+            store.delete(['iters-000/a'])
+            store = open_checkpoint_store(path)
+            self.assertIsNone(store.get('iters-000/a'))
+            self.assertEqual(store.get('iters-000/b'), entry)
+            self.assertEqual(store.list_info(), [('iters-000/b', entry['info'])])
+
+            # pickle file created by previous versions is still supported
+            legacy_path = os.path.join(work_dir, 'legacy.ckpt')
+            with open(legacy_path, 'wb') as f:
+                cloudpickle.dump({'iters-000/a': entry}, f)
+            store = open_checkpoint_store(legacy_path)
+            self.assertIsInstance(store, PickleCheckpointStore)
+            self.assertEqual(store.get('iters-000/a'), entry)
+
+    def test_checkpoint_store_multiprocess(self):
+        import tempfile, multiprocessing
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, 'test.ckpt')
+            ctx = multiprocessing.get_context('fork')
+            workers = [ctx.Process(target=_set_checkpoints, args=(path, f'p{i}', 20)) for i in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.assertTrue(all(worker.exitcode == 0 for worker in workers))
+            store = open_checkpoint_store(path)
+            self.assertEqual(len(store.list_info()), 80)
+            self.assertEqual(store.get('p3/19')['return'], 19)
+
+    def test_input_hash(self):
+        import tempfile
+        artifact = Artifact.of(url='/data/a', executor='hpc01', attrs={'temp': 300})
+        info = FnInfo('f', (artifact, {'b': 1, 'a': 2}), {}, 'a.py:1')
+        self.assertEqual(hash_inputs(info), hash_inputs(FnInfo('f', (artifact, {'a': 2, 'b': 1}), {}, 'a.py:2')))
+        changed = Artifact.of(url='/data/a', executor='hpc01', attrs={'temp': 400})
+        self.assertNotEqual(hash_inputs(info), hash_inputs(FnInfo('f', (changed, {'a': 2, 'b': 1}), {}, 'a.py:1')))
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            store = open_checkpoint_store(os.path.join(work_dir, 'test.ckpt'))
+            store.set('a', {'return': 0, 'is_awaitable': False, 'info': {'fn_name': 'f', 'call_site': ''}})
+            for key in ['a@1', 'a@2', 'a@3']:
+                store.set(key, {'return': 0, 'is_awaitable': False,
+                                'info': {'fn_name': 'f', 'call_site': '', 'input_hash': True}})
+            store.get('a@1')
+            self.assertEqual(sorted(store.evict(max_entries=2)), ['a@2'])
+            self.assertEqual(sorted(key for key, _ in store.list_info()), ['a', 'a@1', 'a@3'])
+
 
 class TestArtifact(TestCase):
 
@@ -61,4 +548,129 @@ class TestArtifact(TestCase):
             format='',
         )
         dict_obj = artifact.to_dict()
-        Artifact.of(**dict_obj)
\ No newline at end of file
+        Artifact.of(**dict_obj)
+
+    def test_artifact_record(self):
+        import pickle
+        artifact = Artifact.of(url='/data', executor='hpc01', attrs={'lammps': {'temp': 300}})
+        record = ArtifactRecord.from_artifact(artifact)
+        self.assertEqual(record.to_artifact(), artifact)
+        with self.assertRaises(AttributeError):
+            record.url = '/other'  # type: ignore
+        with self.assertRaises(TypeError):
+            record.attrs['a'] = 1  # type: ignore
+
+        records = [record.evolve(url=f'/data/{i}') for i in range(100)]
+        self.assertIs(records[0]._attrs, records[1]._attrs)
+        changed = records[0].with_attrs(ancestor='a')
+        self.assertEqual(dict(changed.attrs), {'lammps': {'temp': 300}, 'ancestor': 'a'})
+        self.assertNotIn('ancestor', records[0].attrs)
+        # the shared attrs is pickled only once
+        loaded = pickle.loads(pickle.dumps(records))
+        self.assertEqual(loaded, records)
+        self.assertIs(loaded[0]._attrs, loaded[99]._attrs)
+
+    def test_artifact_index(self):
+        import tempfile, time
+        with tempfile.TemporaryDirectory() as work_dir:
+            index_path = get_index_path(work_dir)
+            data_dir = os.path.join(work_dir, 'data')
+            os.makedirs(data_dir)
+            Path(data_dir, 'type.raw').write_text('0 0 1')
+            artifacts = [{'url': data_dir, 'format': 'deepmd/npy'}, {'url': os.path.join(work_dir, 'a.xyz')}]
+
+            index_artifacts(index_path, artifacts[:1], frames=[2], formulas=['H2O1'], natoms=[3])
+            record, missing = lookup_artifacts(index_path, artifacts)
+            self.assertEqual((record['frames'], record['formula'], record['natoms']), (2, 'H2O1', 3))
+            self.assertEqual(record['size'], 5)
+            self.assertIsNone(missing)
+
+            # the record is invalid once the data is changed
+            Path(data_dir, 'type.raw').write_text('0 0 1 1')
+            os.utime(os.path.join(data_dir, 'type.raw'), (time.time() + 10, time.time() + 10))
+            self.assertEqual(lookup_artifacts(index_path, artifacts[:1]), [None])
+            Path(artifacts[1]['url']).write_text('1')
+            record, new_record = lookup_artifacts(index_path, artifacts, fill=True)
+            self.assertNotEqual(record['content_hash'], new_record['content_hash'])
+            self.assertIsNone(record['frames'])
+
+    def test_resolve_artifacts(self):
+        import tempfile, io
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as work_dir, mock.patch('sys.stdin', io.StringIO()):
+            for name in ['a.xyz', 'b.xyz', 'c.txt']:
+                Path(work_dir, name).write_text('')
+            config = BaseExecutorConfig.parse_obj({'work_dir': work_dir, 'queue_system': {'local': {}}})
+            resource_manager = ResourceManager({'local': config}, {
+                'xyz': Artifact.of(url=work_dir, includes='*.xyz'),
+                'txt': Artifact.of(url=work_dir, includes='*.txt'),
+                'dir': Artifact.of(url=work_dir),
+            }, 'local')
+            with mock.patch.object(LocalConnector, 'glob_many', autospec=True,
+                                   side_effect=lambda self, patterns: [self.glob(p) for p in patterns]) as glob_many:
+                for _ in range(2):
+                    artifacts = resource_manager.resolve_artifacts(['xyz', 'txt', 'dir'])
+                    self.assertEqual(sorted(os.path.basename(a.url) for a in artifacts[:2]), ['a.xyz', 'b.xyz'])
+                    self.assertEqual([a.url for a in artifacts[2:]], [os.path.join(work_dir, 'c.txt'), work_dir])
+                # all patterns are expanded in one call, and only once
+                glob_many.assert_called_once()
+
+class TestPythonWorker(TestCase):
+
+    def test_python_worker(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as work_dir:
+            worker = PythonWorker(LocalConnector(), 'python', cwd=work_dir, tmp_dir=work_dir)
+            worker.start()
+            self.assertEqual(worker.call(lambda: pow(2, 10), cwd=work_dir), 1024)
+            with self.assertRaises(RuntimeError):
+                worker.call(lambda: pow('a', 'b'), cwd=work_dir)
+            self.assertEqual(worker.call(lambda: pow(2, 3), cwd=work_dir), 8)
+            self.assertEqual(list(worker.iter_call(lambda: (i * i for i in range(4)), cwd=work_dir)), [0, 1, 4, 9])
+            worker.close()
+
+    def test_fn_to_script(self):
+        import tempfile, subprocess
+        with tempfile.TemporaryDirectory() as work_dir:
+            result_path = os.path.join(work_dir, 'result')
+            for codec in ('bz2', 'none'):
+                for threshold in (0, 1 << 20):
+                    script = fn_to_script(lambda: list(range(100)), codec=codec,
+                                          result_path=result_path, result_file_threshold=threshold)
+                    stdout = subprocess.check_output(['python', '-c', script]).decode()
+                    _, r = stdout.rsplit('@', 1)
+                    data = r.strip().encode('ascii')
+                    if threshold == 0:
+                        self.assertEqual(data, b'!')
+                        with open(result_path, 'rb') as f:
+                            data = base64.b64encode(f.read())
+                    self.assertEqual(_load_python_result(LocalConnector(), data, result_path, codec), list(range(100)))
+
+    def test_fn_to_iter_script(self):
+        import subprocess, io
+        script = fn_to_iter_script(lambda: (print(i) or i for i in range(3)))
+        stdout = subprocess.check_output(['python', '-c', script], stderr=subprocess.DEVNULL)
+        self.assertEqual(list(_iter_frames(io.BytesIO(stdout), 'bz2', '')), [0, 1, 2])
+
+
+class TestTrace(TestCase):
+
+    def test_trace(self):
+        import tempfile, json
+        from unittest import mock
+        from ai2_kit.core.trace import enable_trace, dump_trace, trace_span, trace_stage
+        # restore the state of tracing after the test, so that the other tests are not traced
+        patcher = mock.patch('ai2_kit.core.trace._events', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        enable_trace()
+        with trace_stage('iters-000/test'):
+            with trace_span('test.span', 'test', bytes_out=10) as span:
+                span['bytes_in'] = 20
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, 'trace.json')
+            dump_trace(path)
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+        event = [e for e in events if e['name'] == 'test.span'][-1]
+        self.assertEqual(event['args'], {'bytes_out': 10, 'bytes_in': 20, 'stage': 'iters-000/test'})
@@ -1,5 +1,9 @@
-from ai2_kit.core.queue_system import inject_cmd_to_script
-from ai2_kit.core.util import dict_remove_dot_keys
+from ai2_kit.core.queue_system import inject_cmd_to_script, split_script_header, expand_slurm_job_id, parse_elapsed_time
+from ai2_kit.core.queue_system import Slurm, PBS
+from ai2_kit.core.job import JobState
+from ai2_kit.core.util import dict_remove_dot_keys, list_split_by_cost
+from ai2_kit.core.runtime import record_runtimes, predict_costs, load_or_dump_costs
+from ai2_kit.core.script import BashScript, BashStep
 from ai2_kit.domain.dpff import dump_dplr_lammps_data
 from ai2_kit.domain.lammps import get_types_template_vars, get_ensemble
 from unittest import TestCase
@@ -71,6 +75,89 @@ class TestUtil(TestCase):
         out_script = inject_cmd_to_script(in_script, cmd)
         self.assertEqual(out_script, expect_out)
 
+    def test_split_script_header(self):
+        header, body = split_script_header('\n'.join([SLURM_SCRIPT_HEADER, 'echo hello']))
+        self.assertEqual(header, SLURM_SCRIPT_HEADER)
+        self.assertEqual(body, 'echo hello')
+
+    def test_expand_slurm_job_id(self):
+        self.assertEqual(expand_slurm_job_id('123'), ['123'])
+        self.assertEqual(expand_slurm_job_id('123_4'), ['123_4'])
+        self.assertEqual(expand_slurm_job_id('123_[1,3-5%2]'), ['123_1', '123_3', '123_4', '123_5'])
+
+    def test_job_state_repr(self):
+        # the jobs are logged with their state, the default repr of bytes based enum fails in python 3.11+
+        self.assertEqual(repr(JobState.FAILED), '<JobState.FAILED>')
+        self.assertEqual(repr({'state': JobState.COMPLETED}), "{'state': <JobState.COMPLETED>}")
+
+    def test_get_job_cores(self):
+        self.assertEqual(Slurm().get_job_cores('#!/bin/bash\n#SBATCH -N 2\n#SBATCH --ntasks-per-node=16\n#SBATCH -c2\necho'), 64)
+        self.assertEqual(PBS().get_job_cores('#!/bin/bash\n#PBS -l select=2:ncpus=4\n#PBS -l walltime=1:00:00\necho'), 8)
+
+    def test_parse_job_history(self):
+        self.assertEqual(parse_elapsed_time('1-02:03:04'), 93784.0)
+        self.assertEqual(parse_elapsed_time('03:04'), 184.0)
+        self.assertIsNone(parse_elapsed_time(''))
+
+        history = Slurm()._parse_history('\n'.join([
+            '123|TIMEOUT|01:00:00|0:15',
+            '124_1|CANCELLED by 1000|00:00:10|0:0',
+        ]))
+        self.assertIs(history['123'].state, JobState.TIMEOUT)
+        self.assertEqual(history['123'].elapsed, 3600.0)
+        self.assertIs(history['124_1'].state, JobState.CANCELLED)
+
+        history = PBS()._parse_history('{"Jobs": {"125.pbs": {"job_state": "F", "Exit_status": -29, '
+                                       '"resources_used": {"walltime": "00:10:00"}}}}')
+        self.assertIs(history['125.pbs'].state, JobState.TIMEOUT)
+        self.assertEqual(history['125.pbs'].elapsed, 600.0)
+
+    def test_list_split_by_cost(self):
+        chunks = list_split_by_cost(['a', 'b', 'c', 'd', 'e'], [8, 1, 4, 3, 2], 2)
+        self.assertEqual(chunks, [['a', 'b'], ['c', 'd', 'e']])
+
+        record_runtimes('test-stage', [(100, 1)], [50.0])
+        # the same key uses the history, others are estimated by the runtime per atom-step
+        self.assertEqual(predict_costs('test-stage', [(100, 1), (400, 1)]), [50.0, 200.0])
+        self.assertEqual(predict_costs('test-no-history', [(10, 2), (0, 0)]), [20.0, 1.0])
+
+    def test_load_or_dump_costs(self):
+        import tempfile, os
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, 'costs.json')
+            self.assertEqual(load_or_dump_costs(path, [1.0, 2.0]), [1.0, 2.0])
+            # the saved costs are used after restart, even if the prediction is changed
+            self.assertEqual(load_or_dump_costs(path, [3.0, 1.0]), [1.0, 2.0])
+            # unless the tasks are changed
+            self.assertEqual(load_or_dump_costs(path, [3.0]), [3.0])
+
+    def test_parallel_bash_script(self):
+        import subprocess, tempfile, time, os
+        with tempfile.TemporaryDirectory() as work_dir:
+            steps = [BashStep(cmd='sleep 1', cwd=work_dir, checkpoint=f'step-{i}') for i in range(4)]
+            steps.append(BashStep(cmd='exit 3'))
+            script = BashScript(template=None, steps=steps, parallelism=4).render()
+            start = time.time()
+            proc = subprocess.run(['bash', '-c', script])
+            self.assertLess(time.time() - start, 3)
+            self.assertEqual(proc.returncode, 3)
+            for i in range(4):
+                self.assertTrue(os.path.exists(os.path.join(work_dir, f'step-{i}.checkpoint')))
+
+    def test_parallel_bash_script_pinning(self):
+        import subprocess, os
+        cpus = sorted(os.sched_getaffinity(0))
+        steps = [BashStep(cmd='taskset -pc $BASHPID | sed "s/.*: *//"')]
+        # the step is pinned to the first allowed core, which is not necessarily core 0
+        script = BashScript(template=None, steps=steps, parallelism=2, cores_per_step=1).render()
+        proc = subprocess.run(['taskset', '-c', str(cpus[-1]), 'bash', '-c', script], capture_output=True, text=True)
+        self.assertEqual(proc.stdout.strip(), str(cpus[-1]))
+        # and it is warned if there are not enough cores
+        script = BashScript(template=None, steps=steps, parallelism=2, cores_per_step=len(cpus) + 1).render()
+        proc = subprocess.run(['bash', '-c', script], capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0)
+        self.assertIn('fail to pin step 0', proc.stderr)
+
     def test_dump_dplr_lammps_data(self):
         import io
         import ase.io